@@ -11,9 +11,8 @@ class UserProfile(models.Model):
     nickname = models.CharField(null=True, max_length=200)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    # TODO: Right now the is_superstar status can't be changed.
-    #   When a non-superstar is made a superstar,
-    #   all the tweets he posted need to be removed from the NewsFeed table.
+    # 由 NewsFeedService.update_superstar 根据粉丝数自动切换，不要直接修改
+    # 切换的时候需要删除或者回填粉丝的 newsfeeds
     is_superstar = models.BooleanField(default=False)
 
     def __str__(self):
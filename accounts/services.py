@@ -29,3 +29,12 @@ class UserService:
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
         cache.delete(key)
+
+    @classmethod
+    def should_be_superstar(cls, is_superstar, followers_count):
+        """
+        升级和降级使用不同的阈值，粉丝数在两个阈值之间的时候保持不变
+        """
+        if is_superstar:
+            return followers_count >= settings.SUPERSTAR_DEMOTE_THRESHOLD
+        return followers_count >= settings.SUPERSTAR_FOLLOWERS_THRESHOLD
@@ -1,3 +1,5 @@
+from gatekeeper.models import GateKeeper
+from utils.counter_helper import CounterHelper
 from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
 
@@ -9,6 +11,11 @@ def incr_comments_count(sender, instance, created, **kwargs):
     if not created:
         return
 
+    if GateKeeper.is_switch_on('switch_counter_write_behind'):
+        # 只在 redis 里记录增量，由 flush_tweet_counters_task 批量写回数据库
+        CounterHelper.incr(Tweet, instance.tweet_id, 'comments_count')
+        return
+
     # handle new comment
     # queryset.update() doesn't call obj.save() =>
     # doesn't send post_save signal =>
@@ -30,6 +37,10 @@ def decr_comments_count(sender, instance, **kwargs):
     from tweets.models import Tweet
     from django.db.models import F
 
+    if GateKeeper.is_switch_on('switch_counter_write_behind'):
+        CounterHelper.decr(Tweet, instance.tweet_id, 'comments_count')
+        return
+
     # handle comment deletion
     Tweet.objects.filter(id=instance.tweet_id)\
         .update(comments_count=F('comments_count') - 1)
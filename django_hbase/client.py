@@ -1,15 +1,152 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from django.conf import settings
+from thriftpy2.thrift import TException
 
+import asyncio
+import functools
 import happybase
+import os
+import queue
+import socket
+import threading
+import time
+
+
+class HBaseConnectionPool:
+    """
+    有上限的 happybase 连接池，线程安全
+     - checkout / checkin 借出和归还连接，connection() 是对应的 context manager
+     - 同一个线程里嵌套使用 connection() 会复用同一个连接，避免自己把连接池耗尽
+     - 只有连接空闲超过 idle_check_interval 秒才做一次 tables() 探活，而不是每次调用都探活
+    """
+
+    def __init__(self, size, timeout=None, idle_check_interval=30, **connection_kwargs):
+        self.size = size
+        self.timeout = timeout
+        self.idle_check_interval = idle_check_interval
+        self.connection_kwargs = connection_kwargs
+        self._queue = queue.LifoQueue(maxsize=size)
+        self._thread_local = threading.local()
+        # 连接是懒加载的，None 表示这个位置还没有建立连接
+        for _ in range(size):
+            self._queue.put((None, 0))
+
+    def _is_alive(self, conn):
+        try:
+            conn.tables()
+        except (TException, socket.error):
+            return False
+        return True
+
+    def checkout(self):
+        try:
+            conn, last_used_at = self._queue.get(block=True, timeout=self.timeout)
+        except queue.Empty:
+            raise happybase.NoConnectionsAvailable(
+                'No HBase connection available in {} seconds'.format(self.timeout),
+            )
+        try:
+            if conn is not None and time.time() - last_used_at > self.idle_check_interval:
+                if not self._is_alive(conn):
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = happybase.Connection(**self.connection_kwargs)
+        except Exception:
+            # 建立连接失败也要把位置还回去，否则连接池会越用越小
+            self._queue.put((None, 0))
+            raise
+        return conn
+
+    def checkin(self, conn):
+        if conn is None:
+            self._queue.put((None, 0))
+        else:
+            self._queue.put((conn, time.time()))
+
+    @contextmanager
+    def connection(self):
+        # 用引用计数记录当前线程有几处在使用这个连接，例如同时迭代多个 iter_filter 的 generator
+        # 只有最后一个使用者退出的时候才归还连接
+        conn = getattr(self._thread_local, 'connection', None)
+        if conn is None:
+            conn = self.checkout()
+            self._thread_local.connection = conn
+            self._thread_local.ref_count = 0
+        self._thread_local.ref_count += 1
+        try:
+            yield conn
+        except (TException, socket.error):
+            # 连接可能已经坏掉了，标记一下，归还的时候直接丢弃，下次 checkout 的时候重新建立
+            self._thread_local.broken = True
+            raise
+        finally:
+            self._thread_local.ref_count -= 1
+            if self._thread_local.ref_count == 0:
+                self._thread_local.connection = None
+                if getattr(self._thread_local, 'broken', False):
+                    self._thread_local.broken = False
+                    conn.close()
+                    conn = None
+                self.checkin(conn)
 
 
 class HBaseClient:
-    conn = None
+    pool = None
+    pid = None
+    executor = None
+    executor_pid = None
+    lock = threading.Lock()
 
     @classmethod
-    def get_connection(cls):
-        try:
-            cls.conn.tables()
-        except:
-            cls.conn = happybase.Connection(settings.HBASE_HOST)
-        return cls.conn
+    def get_pool(cls):
+        # gunicorn / celery 的 worker 是 fork 出来的，子进程不能和父进程共用 socket
+        # 因此发现进程号变了就重新建立一个连接池
+        pid = os.getpid()
+        if cls.pool is not None and cls.pid == pid:
+            return cls.pool
+        with cls.lock:
+            if cls.pool is None or cls.pid != pid:
+                cls.pool = HBaseConnectionPool(
+                    size=settings.HBASE_POOL_SIZE,
+                    timeout=settings.HBASE_POOL_TIMEOUT,
+                    idle_check_interval=settings.HBASE_POOL_IDLE_CHECK_INTERVAL,
+                    host=settings.HBASE_HOST,
+                )
+                cls.pid = pid
+        return cls.pool
+
+    @classmethod
+    def connection(cls):
+        """
+        with HBaseClient.connection() as conn:
+            conn.table(...)
+        """
+        return cls.get_pool().connection()
+
+    @classmethod
+    def get_executor(cls):
+        """
+        async 接口用来执行阻塞的 Thrift 调用的线程池
+        线程数和连接池大小一致，每个线程最多占用一个连接
+        """
+        pid = os.getpid()
+        if cls.executor is not None and cls.executor_pid == pid:
+            return cls.executor
+        with cls.lock:
+            if cls.executor is None or cls.executor_pid != pid:
+                cls.executor = ThreadPoolExecutor(
+                    max_workers=settings.HBASE_POOL_SIZE,
+                    thread_name_prefix='hbase',
+                )
+                cls.executor_pid = pid
+        return cls.executor
+
+    @classmethod
+    async def run_async(cls, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            cls.get_executor(),
+            functools.partial(func, *args, **kwargs),
+        )
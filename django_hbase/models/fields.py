@@ -1,5 +1,37 @@
+from django_hbase.models.exceptions import BadRowKeyError
+
+import struct
+import zlib
+
+# 有符号 int64 加上这个偏移之后变成无符号数，这样负数的字节序也能保持大小顺序
+SIGN_OFFSET = 1 << 63
+
+
+def pack_integer(value, salted):
+    """
+    binary row key 中的 int 编码成 8 个字节的 big-endian 无符号数，字节序就是大小顺序
+    salted 的时候在前面加 1 个字节的 hash 前缀，作用和 string row key 的 reverse 一样，
+    把连续的 id 打散到不同的 region 上
+    """
+    try:
+        packed = struct.pack('>Q', int(value) + SIGN_OFFSET)
+    except struct.error:
+        raise BadRowKeyError(f"{value} is out of int64 range")
+    if salted:
+        packed = bytes([zlib.crc32(packed) & 0xff]) + packed
+    return packed
+
+
+def unpack_integer(packed, salted):
+    if salted:
+        packed = packed[1:]
+    return struct.unpack('>Q', packed)[0] - SIGN_OFFSET
+
+
 class HBaseField:
     field_type = None
+    # 是否可以定长编码，只有 packable 的 field 可以用在 binary row key 里，需要实现 packed_width / pack / unpack
+    packable = False
 
     def __init__(self, reverse=False, column_family=None):
         self.reverse = reverse
@@ -8,16 +40,71 @@ class HBaseField:
         #   增加 is_required 属性，默认为 true 和 default 属性，默认为 None。
         #   并在 HbaseModel 中做相应的处理，抛出相应的异常信息
 
+    def serialize(self, value):
+        value = str(value)
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def is_ordered(self, value):
+        # serialize 之后的字典序是否和大小顺序一致，where 里的 __lt / __gt 等比较需要这一点
+        return False
+
 
 class IntegerField(HBaseField):
     field_type = 'int'
+    packable = True
 
     def __init__(self, *args, **kwargs):
         super(IntegerField, self).__init__(*args, **kwargs)
 
+    def serialize(self, value):
+        # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
+        # 解决的办法是固定 int 的位数为 16 位 （8的倍数更容易利用空间），不足位补 0
+        value = str(value).rjust(16, '0')
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        return int(super(IntegerField, self).deserialize(value))
+
+    def is_ordered(self, value):
+        # 补 0 到 16 位之后，16 位以内的非负数的字典序就是大小顺序
+        return not self.reverse and 0 <= int(value) < 10 ** 16
+
+    @property
+    def packed_width(self):
+        return 9 if self.reverse else 8
+
+    def pack(self, value):
+        return pack_integer(value, salted=self.reverse)
+
+    def unpack(self, packed):
+        return unpack_integer(packed, salted=self.reverse)
+
 
 class TimestampField(HBaseField):
     field_type = 'timestamp'
+    packable = True
 
     def __init__(self, *args, **kwargs):
         super(TimestampField, self).__init__(*args, **kwargs)
+
+    def deserialize(self, value):
+        return int(super(TimestampField, self).deserialize(value))
+
+    @property
+    def packed_width(self):
+        return 9 if self.reverse else 8
+
+    def pack(self, value):
+        return pack_integer(value, salted=self.reverse)
+
+    def unpack(self, packed):
+        return unpack_integer(packed, salted=self.reverse)
@@ -1,19 +1,248 @@
+from contextlib import contextmanager
 from django.conf import settings
 from django_hbase.client import HBaseClient
-from django_hbase.models import HBaseField, IntegerField, TimestampField
+from django_hbase.models import HBaseField
 from django_hbase.models.exceptions import BadRowKeyError, EmptyColumnError
 
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# table.rows() 一次请求取多少个 row key，太大会让单个 Thrift 请求过重
+MULTI_GET_CHUNK_SIZE = 100
+# table.scan() 每次从 region server 拉取多少行
+SCAN_BATCH_SIZE = 1000
+# HBaseBatch 攒够多少个 put / delete 之后自动发送一次
+MUTATION_BATCH_SIZE = 1000
+# afilter 最多预先读取多少个 instance 等待被消费
+ASYNC_PREFETCH_SIZE = 100
+# afilter 的队列满了的时候，每隔多少秒检查一次调用者是否已经退出
+ASYNC_PUT_TIMEOUT = 1
+# 每一行只返回第一个 cell，并且不返回 value，用于只需要 row key 的 scan
+KEYS_ONLY_FILTER = 'FirstKeyOnlyFilter() AND KeyOnlyFilter()'
+# where 里的 lookup 后缀 => HBase filter 里的比较符
+WHERE_OPERATORS = {
+    '': '=',
+    'ne': '!=',
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+}
+
+
+# 二级索引表里每一行只存一个 column：被索引的那一行的 row key
+INDEX_COLUMN_FAMILY = 'cf'
+INDEX_COLUMN = b'cf:row_key'
+
+
+def quote_filter_string(value):
+    # HBase filter 语言里的字符串用单引号包起来，单引号本身需要写两次
+    return "'{}'".format(value.replace("'", "''"))
+
+# Meta.row_key_format 的取值
+#  - string: 默认值，'val1:val2' 的形式，int 补 0 到 16 位，已有的表都是这种格式
+#  - binary: 每个 int 定长 8 个字节直接拼接，reverse 的 field 加 1 个字节的 hash 前缀
+#    只建议新建的表使用，已有数据的表切换格式之后旧数据会读不出来
+ROW_KEY_FORMAT_STRING = 'string'
+ROW_KEY_FORMAT_BINARY = 'binary'
+
+
+class HBaseModelSchema:
+    """
+    每个 HBaseModel 子类在定义时编译一次的 schema
+    序列化和反序列化都直接查这里的结果，而不是每次都重新扫描 cls.__dict__
+    """
+
+    def __init__(self, model_class):
+        # 按照定义顺序排列的 {key: field}，包括从父类继承的 fields
+        self.fields = {}
+        for klass in reversed(model_class.__mro__):
+            for key, value in klass.__dict__.items():
+                if isinstance(value, HBaseField):
+                    self.fields[key] = value
+        # ((key1, field1), (key2, field2), ...) 按照 Meta.row_key 的顺序
+        self.row_key_fields = tuple(
+            (key, self.fields[key])
+            for key in model_class.Meta.row_key
+        )
+        row_key_format = getattr(model_class.Meta, 'row_key_format', ROW_KEY_FORMAT_STRING)
+        if row_key_format not in (ROW_KEY_FORMAT_STRING, ROW_KEY_FORMAT_BINARY):
+            raise ValueError(f'Unknown row_key_format {row_key_format} in {model_class.__name__}')
+        self.binary_row_key = row_key_format == ROW_KEY_FORMAT_BINARY
+        if self.binary_row_key:
+            # 提前检查一下，binary row key 里只能使用可以定长编码的 field
+            for key, field in self.row_key_fields:
+                if not field.packable:
+                    raise BadRowKeyError(
+                        f'{key} of {model_class.__name__} is a {field.__class__.__name__}, '
+                        f'which cannot be used in a binary row key'
+                    )
+        # Meta.indexes = [('key1', 'key2'), ...] => (((key1, field1), (key2, field2)), ...)
+        self.indexes = tuple(
+            tuple((key, self.fields[key]) for key in index)
+            for index in getattr(model_class.Meta, 'indexes', ())
+        )
+        # {key: column_family}，只包含存在 column 里的 fields
+        self.column_families = {
+            key: field.column_family
+            for key, field in self.fields.items()
+            if field.column_family
+        }
+        # {key: 'cf:key'} 用于写入，{b'cf:key': key} 用于读取
+        self.column_names = {
+            key: '{}:{}'.format(column_family, key)
+            for key, column_family in self.column_families.items()
+        }
+        self.column_keys = {
+            bytes(column_name, encoding='utf-8'): key
+            for key, column_name in self.column_names.items()
+        }
+        self.encoders = {key: field.serialize for key, field in self.fields.items()}
+        self.decoders = {key: field.deserialize for key, field in self.fields.items()}
+
+
+class HBaseBatch:
+    """
+    攒一批 put / delete 一次性发送，攒够 batch_size 个之后自动发送，内存占用是有上限的
+    with HBaseNewsFeed.batch(batch_size=500) as batch:
+        batch.put(newsfeed)
+        batch.delete(user_id=1, created_at=ts)
+    同时会维护 Meta.indexes 里的索引行，每次发送的行数和耗时记录在 timings 里
+    """
+
+    def __init__(self, model_class, batch_size=MUTATION_BATCH_SIZE):
+        self.model_class = model_class
+        self.batch_size = batch_size
+        # [(is_put, row_key, row_data, data), ...] 按照调用顺序发送
+        self.mutations = []
+        # [(mutation_count, seconds), ...]
+        self.timings = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 和 happybase 的 batch 一样，发生异常的时候丢弃还没有发送的数据
+        if exc_type is None:
+            self.send()
+
+    def put(self, instance):
+        self.mutations.append((True, instance.row_key, instance.get_row_data(), instance.__dict__))
+        if len(self.mutations) >= self.batch_size:
+            self.send()
+
+    def delete(self, **kwargs):
+        row_key = self.model_class.serialize_row_key(kwargs)
+        self.mutations.append((False, row_key, None, kwargs))
+        if len(self.mutations) >= self.batch_size:
+            self.send()
+
+    def _fill_index_data(self, mutations):
+        """
+        Returns the data of each delete in {mutations}, with the fields needed by Meta.indexes.
+        delete 的时候缺少索引需要的 fields，先找同一个 batch 里之前 put 的这一行（还没有发送，从 HBase 读不到），
+        剩下的再一次 get_many 从 HBase 读出来
+        """
+        model_class = self.model_class
+        index_keys = set(key for index in model_class.schema.indexes for key, _ in index)
+        # row_key => 这一行在 batch 里最新的数据，被 delete 之后是 {}
+        pending = {}
+        delete_data_list, missing = [], []
+        for is_put, row_key, _, data in mutations:
+            if is_put:
+                pending[row_key] = data
+                continue
+            if any(data.get(key) is None for key in index_keys):
+                if row_key in pending:
+                    data = pending[row_key]
+                else:
+                    missing.append((len(delete_data_list), data))
+            pending[row_key] = {}
+            delete_data_list.append(data)
+        if missing:
+            instances = model_class.get_many([data for _, data in missing])
+            for (position, _), instance in zip(missing, instances):
+                delete_data_list[position] = instance.__dict__ if instance else {}
+        return delete_data_list
+
+    def _get_index_deletes(self, mutations, delete_data_list):
+        """
+        Returns [(index, data_list), ...] of the index rows to delete after the data is sent.
+        同一个 batch 里先 delete 再 put 同一个索引 key（例如取关之后马上又关注）的时候，
+        索引行已经属于后面 put 的那一行，不能删除
+        """
+        index_deletes = []
+        for index in self.model_class.schema.indexes:
+            later_put_keys = set()
+            data_list = []
+            delete_data = iter(reversed(delete_data_list))
+            # 倒着遍历，遇到 delete 的时候 later_put_keys 里正好是它之后 put 的索引 key
+            for is_put, _, _, data in reversed(mutations):
+                if is_put:
+                    later_put_keys.add(self.model_class.get_index_key(index, data))
+                    continue
+                data = next(delete_data)
+                if self.model_class.get_index_key(index, data) not in later_put_keys:
+                    data_list.append(data)
+            index_deletes.append((index, data_list))
+        return index_deletes
+
+    def send(self):
+        if not self.mutations:
+            return
+        start_at = time.time()
+        model_class = self.model_class
+        mutations, self.mutations = self.mutations, []
+
+        puts = [(row_key, data) for is_put, row_key, _, data in mutations if is_put]
+        if model_class.schema.indexes:
+            delete_data_list = self._fill_index_data(mutations)
+            # 索引先于数据写入、晚于数据删除，详见 HBaseModel.put_index_rows
+            model_class.put_index_rows([model_class(**data) for _, data in puts])
+
+        with model_class.get_table() as table:
+            batch = table.batch()
+            for is_put, row_key, row_data, _ in mutations:
+                if is_put:
+                    batch.put(row_key, row_data)
+                else:
+                    batch.delete(row_key)
+            batch.send()
+
+        if model_class.schema.indexes:
+            for index, data_list in self._get_index_deletes(mutations, delete_data_list):
+                model_class.delete_index_rows(data_list, indexes=[index])
+
+        seconds = time.time() - start_at
+        self.timings.append((len(mutations), seconds))
+        logger.debug('HBase batch of %s mutations to %s sent in %.3fs', len(mutations), model_class.get_table_name(), seconds)
+
 
 class HBaseModel:
 
     class Meta:
         table_name = None
         row_key = ()
+        row_key_format = ROW_KEY_FORMAT_STRING
+        # 二级索引，例如 [('from_user_id', 'to_user_id')]，每个索引单独存一张表
+        # 索引里的 fields 组合起来需要是唯一的，否则后写入的会覆盖先写入的
+        indexes = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.schema = HBaseModelSchema(cls)
 
     @classmethod
+    @contextmanager
     def get_table(cls):
-        conn = HBaseClient.get_connection()
-        return conn.table(cls.get_table_name())
+        # table 绑定在连接池借出的连接上，用完之后连接会被归还，所以只能在 with 里使用
+        with HBaseClient.connection() as conn:
+            yield conn.table(cls.get_table_name())
 
     @property
     def row_key(self):
@@ -21,28 +250,24 @@ class HBaseModel:
 
     @classmethod
     def get_field_hash(cls):
-        field_hash = {}
-        for field in cls.__dict__:
-            field_obj = getattr(cls, field)
-            if isinstance(field_obj, HBaseField):
-                field_hash[field] = field_obj
-        return field_hash
+        # 返回的是编译好的 schema 里的 dict，调用者不要修改它
+        return cls.schema.fields
 
     def __init__(self, **kwargs):
-        for key, field in self.get_field_hash().items():
-            value = kwargs.get(key)
-            setattr(self, key, value)
+        for key in self.schema.fields:
+            setattr(self, key, kwargs.get(key))
 
     @classmethod
     def init_from_row(cls, row_key, row_data):
         if not row_data:
             return None
         data = cls.deserialize_row_key(row_key)
+        column_keys = cls.schema.column_keys
+        decoders = cls.schema.decoders
         for column_key, column_value in row_data.items():
-            # remove column family
-            column_key = column_key.decode('utf-8')
-            key = column_key[column_key.find(':') + 1:]
-            data[key] = cls.deserialize_field(key, column_value)
+            # b'cf:key' => key
+            key = column_keys[column_key]
+            data[key] = decoders[key](column_value)
         return cls(**data)
 
     @classmethod
@@ -53,16 +278,20 @@ class HBaseModel:
         {key1: val1, key2: val2} => b"val1:val2"
         {key1: val1, key2: val2, key3: val3} => b"val1:val2:val3"
         """
-        field_hash = cls.get_field_hash()
+        if cls.schema.binary_row_key:
+            return cls.serialize_binary_row_key(data, is_prefix=is_prefix)
+        return cls.serialize_string_key(cls.schema.row_key_fields, data, is_prefix=is_prefix)
+
+    @classmethod
+    def serialize_string_key(cls, key_fields, data, is_prefix=False):
         values = []
-        for key in cls.Meta.row_key:
-            field = field_hash[key]
+        for key, field in key_fields:
             value = data.get(key)
             if value is None:
                 if not is_prefix:
                     raise BadRowKeyError(f"{key} is missing in row key")
                 break
-            value = cls.serialize_field(field, value)
+            value = field.serialize(value)
             if ':' in value:
                 raise BadRowKeyError(f"{key} should not contain ':' in value: {value}")
             values.append(value)
@@ -75,75 +304,181 @@ class HBaseModel:
         "val1:val2" => {'key1': val1, 'key2': val2, 'key3': None}
         "val1:val2:val3" => {'key1': val1, 'key2': val2, 'key3': val3}
         """
+        if cls.schema.binary_row_key:
+            return cls.deserialize_binary_row_key(row_key)
+
         data = {}
         if isinstance(row_key, bytes):
             row_key = row_key.decode('utf-8')
 
-        # val1:val2 => val1:val2: 方便每次 find(':') 都能找到一个 val
-        row_key = row_key + ':'
-        for key in cls.Meta.row_key:
-            index = row_key.find(':')
-            if index == -1:
+        for (key, field), value in zip(cls.schema.row_key_fields, row_key.split(':')):
+            data[key] = field.deserialize(value)
+        return data
+
+    @classmethod
+    def serialize_binary_row_key(cls, data, is_prefix=False):
+        """
+        {key1: val1, key2: val2} => pack(val1) + pack(val2)
+        每个 field 都是定长的，因此不需要分隔符
+        """
+        values = []
+        for key, field in cls.schema.row_key_fields:
+            value = data.get(key)
+            if value is None:
+                if not is_prefix:
+                    raise BadRowKeyError(f"{key} is missing in row key")
+                break
+            values.append(field.pack(value))
+        return b''.join(values)
+
+    @classmethod
+    def deserialize_binary_row_key(cls, row_key):
+        data = {}
+        offset = 0
+        for key, field in cls.schema.row_key_fields:
+            if offset >= len(row_key):
                 break
-            data[key] = cls.deserialize_field(key, row_key[:index])
-            row_key = row_key[index + 1:]
+            width = field.packed_width
+            if offset + width > len(row_key):
+                raise BadRowKeyError(f"row key {row_key} is too short for {key}")
+            data[key] = field.unpack(row_key[offset: offset + width])
+            offset += width
         return data
 
     @classmethod
     def serialize_field(cls, field, value):
-        value = str(value)
-        if isinstance(field, IntegerField):
-            # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
-            # 解决的办法是固定 int 的位数为 16 位 （8的倍数更容易利用空间），不足位补 0
-            value = str(value)
-            while len(value) < 16:
-                value = '0' + value
-        if field.reverse:
-            value = value[::-1]
-        return value
+        return field.serialize(value)
 
     @classmethod
     def deserialize_field(cls, key, value):
-        field = cls.get_field_hash()[key]
-        if field.reverse:
-            value = value[::-1]
-        if field.field_type in [IntegerField.field_type, TimestampField.field_type]:
-            return int(value)
-        return value
+        return cls.schema.decoders[key](value)
 
     @classmethod
     def serialize_row_data(cls, data):
         row_data = {}
-        field_hash = cls.get_field_hash()
-        for key, field in field_hash.items():
-            if not field.column_family:
-                continue
-            column_key = '{}:{}'.format(field.column_family, key)
+        encoders = cls.schema.encoders
+        for key, column_name in cls.schema.column_names.items():
             column_value = data.get(key)
             if column_value is None:
                 continue
-            row_data[column_key] = cls.serialize_field(field, column_value)
+            row_data[column_name] = encoders[key](column_value)
         return row_data
 
-    def save(self, batch=None):
+    def get_row_data(self):
         row_data = self.serialize_row_data(self.__dict__)
         # 如果 row_data 为空，即没有任何 column key values 需要存储 hbase 会直接不存储
         # 这个 row_key，因此我们可以 raise 一个 exception 提醒调用者，避免存储空值
         if len(row_data) == 0:
             raise EmptyColumnError()
+        return row_data
+
+    def save(self, batch=None):
+        """
+        batch: HBaseModel.batch() 返回的 HBaseBatch，不传的时候直接写入
+        """
         if batch:
-            batch.put(self.row_key, row_data)
-        else:
-            table = self.get_table()
+            batch.put(self)
+            return
+        row_data = self.get_row_data()
+        self.put_index_rows([self])
+        with self.get_table() as table:
             table.put(self.row_key, row_data)
 
     @classmethod
-    def get(cls, **kwargs):
+    def get_index_table_name(cls, index):
+        keys = [key for key, _ in index]
+        return '{}_index_{}'.format(cls.get_table_name(), '_'.join(keys))
+
+    @classmethod
+    def get_index_key(cls, index, data):
+        """
+        {key1: val1, key2: val2} => b"val1:val2"，索引里的 field 缺失时返回 None，表示不需要索引
+        """
+        if any(data.get(key) is None for key, _ in index):
+            return None
+        return cls.serialize_string_key(index, data)
+
+    @classmethod
+    def put_index_rows(cls, instances):
+        """
+        HBase 没有跨行的事务，因此索引先于数据写入、晚于数据删除
+        这样索引最多只会多出几行指向不存在的数据，get_by_index 会检查并忽略这些行
+        """
+        for index in cls.schema.indexes:
+            with HBaseClient.connection() as conn:
+                batch = conn.table(cls.get_index_table_name(index)).batch()
+                for instance in instances:
+                    index_key = cls.get_index_key(index, instance.__dict__)
+                    if index_key is not None:
+                        batch.put(index_key, {INDEX_COLUMN: instance.row_key})
+                batch.send()
+
+    @classmethod
+    def delete_index_rows(cls, data_list, indexes=None):
+        for index in indexes or cls.schema.indexes:
+            with HBaseClient.connection() as conn:
+                batch = conn.table(cls.get_index_table_name(index)).batch()
+                for data in data_list:
+                    index_key = cls.get_index_key(index, data)
+                    if index_key is not None:
+                        batch.delete(index_key)
+                batch.send()
+
+    @classmethod
+    def get_by_index(cls, **kwargs):
+        """
+        通过 Meta.indexes 里的某个索引查找，kwargs 需要正好是这个索引里的所有 fields
+        HBaseFollowing.get_by_index(from_user_id=1, to_user_id=2)
+        """
+        for index in cls.schema.indexes:
+            if set(kwargs) == set(key for key, _ in index):
+                break
+        else:
+            raise ValueError(f'No index on {sorted(kwargs)} in {cls.__name__}')
+
+        index_key = cls.serialize_string_key(index, kwargs)
+        with HBaseClient.connection() as conn:
+            index_row = conn.table(cls.get_index_table_name(index)).row(index_key)
+            if not index_row:
+                return None
+            row_key = index_row[INDEX_COLUMN]
+            row = conn.table(cls.get_table_name()).row(row_key)
+        instance = cls.init_from_row(row_key, row)
+        # 数据已经被删除或者被修改过的时候，索引可能是过期的
+        if instance is None:
+            return None
+        for key, field in index:
+            if field.serialize(getattr(instance, key)) != field.serialize(kwargs[key]):
+                return None
+        return instance
+
+    @classmethod
+    def get(cls, columns=None, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row = table.row(row_key)
+        with cls.get_table() as table:
+            row = table.row(row_key, columns=cls.get_column_names(columns))
         return cls.init_from_row(row_key, row)
 
+    @classmethod
+    def get_many(cls, keys, chunk_size=MULTI_GET_CHUNK_SIZE, columns=None):
+        """
+        keys: a list of row key dicts, e.g. [{'key1': val1, 'key2': val2}, ...]
+        return: a list of instances in the same order as keys, None for misses
+        """
+        row_keys = [cls.serialize_row_key(key) for key in keys]
+        column_names = cls.get_column_names(columns)
+        row_data_hash = {}
+        # 每 chunk_size 个 row key 合并成一次 table.rows() 请求，而不是每个 key 一次 table.row()
+        with cls.get_table() as table:
+            for index in range(0, len(row_keys), chunk_size):
+                rows = table.rows(row_keys[index: index + chunk_size], columns=column_names)
+                for row_key, row_data in rows:
+                    row_data_hash[row_key] = row_data
+        return [
+            cls.init_from_row(row_key, row_data_hash.get(row_key))
+            for row_key in row_keys
+        ]
+
     @classmethod
     def create(cls, batch=None, **kwargs):
         instance = cls(**kwargs)
@@ -151,15 +486,27 @@ class HBaseModel:
         return instance
 
     @classmethod
-    def batch_create(cls, batch_data):
-        table = cls.get_table()
-        batch = table.batch()
-        results = []
-        for data in batch_data:
-            results.append(cls.create(batch=batch, **data))
-        batch.send()
+    def batch(cls, batch_size=MUTATION_BATCH_SIZE):
+        return HBaseBatch(cls, batch_size=batch_size)
+
+    @classmethod
+    def batch_create(cls, batch_data, batch_size=MUTATION_BATCH_SIZE):
+        results = [cls(**data) for data in batch_data]
+        with cls.batch(batch_size=batch_size) as batch:
+            for instance in results:
+                batch.put(instance)
         return results
 
+    @classmethod
+    def batch_delete(cls, keys, batch_size=MUTATION_BATCH_SIZE):
+        """
+        keys: a list of row key dicts, e.g. [{'key1': val1, 'key2': val2}, ...]
+        """
+        with cls.batch(batch_size=batch_size) as batch:
+            for key in keys:
+                batch.delete(**key)
+        return len(keys)
+
     @classmethod
     def get_table_name(cls):
         if not cls.Meta.table_name:
@@ -172,23 +519,35 @@ class HBaseModel:
     def drop_table(cls):
         if not settings.TESTING:
             raise Exception('You cannot drop table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        conn.delete_table(cls.get_table_name(), True)
+        with HBaseClient.connection() as conn:
+            conn.delete_table(cls.get_table_name(), True)
+            for index in cls.schema.indexes:
+                conn.delete_table(cls.get_index_table_name(index), True)
+
+    @classmethod
+    def create_index_tables(cls):
+        # 给已经上线的 table 加索引的时候也需要调用，只会创建不存在的索引表，不会修改已有的数据
+        with HBaseClient.connection() as conn:
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            for index in cls.schema.indexes:
+                index_table_name = cls.get_index_table_name(index)
+                if index_table_name not in tables:
+                    conn.create_table(index_table_name, {INDEX_COLUMN_FAMILY: dict()})
 
     @classmethod
     def create_table(cls):
         if not settings.TESTING:
             raise Exception('You cannot create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        tables = [table.decode('utf-8') for table in conn.tables()]
-        if cls.get_table_name() in tables:
-            return
-        column_families = {
-            field.column_family: dict()
-            for key, field in cls.get_field_hash().items()
-            if field.column_family is not None
-        }
-        conn.create_table(cls.get_table_name(), column_families)
+        cls.create_index_tables()
+        with HBaseClient.connection() as conn:
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            if cls.get_table_name() in tables:
+                return
+            column_families = {
+                column_family: dict()
+                for column_family in cls.schema.column_families.values()
+            }
+            conn.create_table(cls.get_table_name(), column_families)
 
     # TODO <HOMEWORK> implement a get_or_create method, return (instance, created)
 
@@ -203,25 +562,271 @@ class HBaseModel:
         return cls.serialize_row_key(data, is_prefix=True)
 
     @classmethod
-    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False):
+    def get_column_names(cls, columns):
+        """
+        ['key1', 'key2'] => [b'cf:key1', b'cf:key2']
+        只能选择存在 column 里的 fields，row key 里的 fields 总是会返回
+        """
+        if columns is None:
+            return None
+        column_names = []
+        for key in columns:
+            if key not in cls.schema.column_names:
+                raise ValueError(f'{key} is not a column of {cls.__name__}')
+            column_names.append(cls.schema.column_names[key])
+        return column_names
+
+    @classmethod
+    def compile_where(cls, where):
+        """
+        把 column 上的条件编译成 HBase 的 SingleColumnValueFilter，在 region server 上过滤
+        {'key1': val1} => "SingleColumnValueFilter('cf', 'key1', =, 'binary:val1', true, true)"
+        {'key1__gt': val1, 'key2': val2} => "... AND ..."
+        key 不存在的行会被直接过滤掉
+        """
+        filters = []
+        for lookup, value in where.items():
+            key, _, operator = lookup.partition('__')
+            if operator not in WHERE_OPERATORS:
+                raise ValueError(f'Unsupported lookup {lookup} in where')
+            if key not in cls.schema.column_families:
+                raise ValueError(f'{key} is not a column of {cls.__name__}')
+            field = cls.schema.fields[key]
+            if operator not in ('', 'ne') and field.reverse:
+                # reverse 之后字典序和大小顺序不一致，只能做相等比较
+                raise ValueError(f'{key} is reversed and only supports = and != in where')
+            if operator not in ('', 'ne') and not field.is_ordered(value):
+                # binary comparator 按照字节比较，例如没有补 0 的 TimestampField 上 '9' > '10'
+                raise ValueError(f'{key} does not support range lookups on {value!r} in where')
+            filters.append("SingleColumnValueFilter({}, {}, {}, {}, true, true)".format(
+                quote_filter_string(cls.schema.column_families[key]),
+                quote_filter_string(key),
+                WHERE_OPERATORS[operator],
+                quote_filter_string('binary:' + field.serialize(value)),
+            ))
+        return ' AND '.join(filters)
+
+    @classmethod
+    def _scan(
+        cls,
+        start=None,
+        stop=None,
+        prefix=None,
+        limit=None,
+        reverse=False,
+        batch_size=SCAN_BATCH_SIZE,
+        columns=None,
+        keys_only=False,
+        where=None,
+    ):
+        """
+        返回 HBase scan 出来的原始 (row_key, row_data)
+        """
         # serialize tuple to str
         row_start = cls.serialize_row_key_from_tuple(start)
         row_stop = cls.serialize_row_key_from_tuple(stop)
         row_prefix = cls.serialize_row_key_from_tuple(prefix)
 
-        # scan table
-        table = cls.get_table()
-        rows = table.scan(row_start, row_stop, row_prefix, limit=limit, reverse=reverse)
+        if where:
+            # SingleColumnValueFilter 需要读到条件里的 column 才能做判断
+            where_columns = [lookup.partition('__')[0] for lookup in where]
+            if keys_only:
+                columns = where_columns
+            elif columns is not None:
+                columns = list(columns) + [key for key in where_columns if key not in columns]
+            scan_filter = cls.compile_where(where)
+        elif keys_only:
+            columns = None
+            scan_filter = KEYS_ONLY_FILTER
+        else:
+            scan_filter = None
+
+        with cls.get_table() as table:
+            yield from table.scan(
+                row_start,
+                row_stop,
+                row_prefix,
+                columns=cls.get_column_names(columns),
+                filter=scan_filter,
+                limit=limit,
+                reverse=reverse,
+                batch_size=batch_size,
+            )
+
+    @classmethod
+    def iter_filter(
+        cls,
+        start=None,
+        stop=None,
+        prefix=None,
+        limit=None,
+        reverse=False,
+        batch_size=SCAN_BATCH_SIZE,
+        columns=None,
+        keys_only=False,
+        where=None,
+    ):
+        """
+        和 filter 一样的参数，但是返回 generator，一边从 HBase scan 一边反序列化
+        内存里最多只有 batch_size 行数据，适合 scan 结果非常大的场景，比如 fan-out 时读取所有粉丝
+        注意在迭代结束之前，当前线程会一直占用连接池里的一个连接
 
-        # deserialize to instance list
-        results = []
+        columns: 只读取这些 column，例如 ['to_user_id']
+        keys_only: 只读取 row key，返回的 instance 里只有 row key 里的 fields
+        where: column 上的条件，例如 {'to_user_id': 42}，详见 compile_where
+        """
+        rows = cls._scan(
+            start=start,
+            stop=stop,
+            prefix=prefix,
+            limit=limit,
+            reverse=reverse,
+            batch_size=batch_size,
+            columns=columns,
+            keys_only=keys_only,
+            where=where,
+        )
         for row_key, row_data in rows:
-            instance = cls.init_from_row(row_key, row_data)
-            results.append(instance)
-        return results
+            if keys_only:
+                # 只需要 row key，不需要反序列化 column
+                yield cls(**cls.deserialize_row_key(row_key))
+            else:
+                yield cls.init_from_row(row_key, row_data)
+
+    @classmethod
+    def filter(
+        cls,
+        start=None,
+        stop=None,
+        prefix=None,
+        limit=None,
+        reverse=False,
+        columns=None,
+        keys_only=False,
+        where=None,
+    ):
+        # scan table and deserialize to instance list
+        return list(cls.iter_filter(
+            start=start,
+            stop=stop,
+            prefix=prefix,
+            limit=limit,
+            reverse=reverse,
+            columns=columns,
+            keys_only=keys_only,
+            where=where,
+        ))
+
+    @classmethod
+    def count(cls, start=None, stop=None, prefix=None, where=None):
+        """
+        只在 region server 上读取 row key，不反序列化任何数据
+        """
+        rows = cls._scan(start=start, stop=stop, prefix=prefix, keys_only=True, where=where)
+        return sum(1 for _ in rows)
+
+    @classmethod
+    async def aget(cls, columns=None, **kwargs):
+        """
+        async 版本的 get，在线程池里执行，可以和其他 IO 一起 asyncio.gather
+        """
+        return await HBaseClient.run_async(cls.get, columns=columns, **kwargs)
+
+    @classmethod
+    async def aget_many(cls, keys, chunk_size=MULTI_GET_CHUNK_SIZE, columns=None):
+        return await HBaseClient.run_async(cls.get_many, keys, chunk_size=chunk_size, columns=columns)
+
+    @classmethod
+    async def acount(cls, start=None, stop=None, prefix=None, where=None):
+        return await HBaseClient.run_async(cls.count, start=start, stop=stop, prefix=prefix, where=where)
+
+    @classmethod
+    async def afilter(cls, **kwargs):
+        """
+        async 版本的 iter_filter，参数相同
+        async for instance in HBaseFollower.afilter(prefix=(user_id,)):
+            ...
+        整个 scan 在线程池的同一个线程里执行（连接是按线程借出的），通过一个有上限的队列把结果交给调用者
+        提前退出的时候调用 aclose()，等 scan 的线程结束、连接归还之后才返回，
+        否则要等到 generator 被回收的时候才会停止 scan
+        """
+        loop = asyncio.get_running_loop()
+        # 线程里的队列，produce 不依赖 loop 就可以放入，调用者消费得慢的时候不会无限读取
+        items = queue.Queue(maxsize=ASYNC_PREFETCH_SIZE)
+        ready = asyncio.Event()
+        stopped = threading.Event()
+        finished = object()
+
+        def put(item):
+            """
+            队列满了就等待，调用者提前退出或者 loop 已经关闭的时候放弃并返回 False
+            不会一直阻塞，线程和它借出的连接总是能被释放
+            """
+            while not stopped.is_set():
+                try:
+                    items.put(item, timeout=ASYNC_PUT_TIMEOUT)
+                except queue.Full:
+                    if loop.is_closed():
+                        return False
+                    continue
+                try:
+                    loop.call_soon_threadsafe(ready.set)
+                except RuntimeError:
+                    # loop 已经关闭，不会再有人消费
+                    return False
+                return True
+            return False
+
+        def produce():
+            try:
+                for instance in cls.iter_filter(**kwargs):
+                    if not put(instance):
+                        break
+            finally:
+                put(finished)
+
+        future = loop.run_in_executor(HBaseClient.get_executor(), produce)
+        try:
+            while True:
+                try:
+                    instance = items.get_nowait()
+                except queue.Empty:
+                    ready.clear()
+                    # clear 之后再检查一次，避免错过在这之前放入的 instance
+                    if items.empty():
+                        await ready.wait()
+                    continue
+                if instance is finished:
+                    break
+                yield instance
+            # scan 出错的时候在这里抛出异常
+            await future
+        finally:
+            # 调用者提前退出的时候，通知 produce 停止，并且清空队列，阻塞在 put 里的 produce 马上就能返回
+            stopped.set()
+            while True:
+                try:
+                    items.get_nowait()
+                except queue.Empty:
+                    break
+            # 等 produce 结束，线程和连接都归还之后再返回。提前退出的时候不抛出 scan 的异常
+            await asyncio.wait([future])
 
     @classmethod
     def delete(cls, **kwargs):
+        """
+        kwargs 里需要有 row key 的所有 fields
+        有索引的 model 如果 kwargs 里缺少索引需要的 fields，会先读一次这一行来找到要删除的索引
+        """
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        return table.delete(row_key)
+        index_data = kwargs
+        if cls.schema.indexes:
+            index_keys = set(key for index in cls.schema.indexes for key, _ in index)
+            if any(kwargs.get(key) is None for key in index_keys):
+                with cls.get_table() as table:
+                    instance = cls.init_from_row(row_key, table.row(row_key))
+                index_data = instance.__dict__ if instance else {}
+        with cls.get_table() as table:
+            result = table.delete(row_key)
+        cls.delete_index_rows([index_data])
+        return result
@@ -7,7 +7,6 @@ from friendships.api.serializers import (
 )
 from friendships.models import HBaseFollowing, HBaseFollower, Friendship
 from friendships.services import FriendshipService
-from gatekeeper.models import GateKeeper
 from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
@@ -62,7 +61,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
     @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True))
     def followings(self, request, pk):
-        if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+        if FriendshipService.use_hbase(int(pk)):
             page = self.paginator.paginate_hbase(HBaseFollowing, (pk,), request)
         else:
             friendships = Friendship.objects.filter(from_user_id=pk).order_by('-created_at')
@@ -74,7 +73,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
     @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True))
     def followers(self, request, pk):
-        if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+        if FriendshipService.use_hbase(int(pk)):
             page = self.paginator.paginate_hbase(HBaseFollower, (pk,), request)
         else:
             friendships = Friendship.objects.filter(to_user_id=pk).order_by('-created_at')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from friendships.models import HBaseFollowing
+from gatekeeper.models import GateKeeper
+
+
+class Command(BaseCommand):
+    help = 'Create the (from_user_id, to_user_id) index table of HBaseFollowing and backfill it from the followings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        HBaseFollowing.create_index_tables()
+
+        # 新的 followings 在创建的时候已经写入了索引，这里只需要补上之前的
+        # scan 的过程中被删除的 followings 会多出一行索引，get_by_index 会检查并忽略
+        indexed_count, followings = 0, []
+        for following in HBaseFollowing.iter_filter(batch_size=batch_size):
+            followings.append(following)
+            if len(followings) >= batch_size:
+                HBaseFollowing.put_index_rows(followings)
+                indexed_count += len(followings)
+                followings = []
+        if followings:
+            HBaseFollowing.put_index_rows(followings)
+            indexed_count += len(followings)
+
+        # 所有的 followings 都有索引了，FriendshipService.get_follow_instance 不再需要退回到 scan
+        GateKeeper.turn_on('following_index_backfilled')
+        self.stdout.write('{} followings indexed.'.format(indexed_count))
@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand
+from django_hbase.models import HBaseField, IntegerField, TimestampField
+from friendships.models import HBaseFollowing
+
+import time
+
+
+# 编译 schema 之前的实现：每次调用都重新扫描 cls.__dict__，用来和现在的 init_from_row 对比
+def legacy_get_field_hash(model_class):
+    field_hash = {}
+    for field in model_class.__dict__:
+        field_obj = getattr(model_class, field)
+        if isinstance(field_obj, HBaseField):
+            field_hash[field] = field_obj
+    return field_hash
+
+
+def legacy_deserialize_field(model_class, key, value):
+    field = legacy_get_field_hash(model_class)[key]
+    if field.reverse:
+        value = value[::-1]
+    if field.field_type in [IntegerField.field_type, TimestampField.field_type]:
+        return int(value)
+    return value
+
+
+def legacy_deserialize_row_key(model_class, row_key):
+    data = {}
+    if isinstance(row_key, bytes):
+        row_key = row_key.decode('utf-8')
+    row_key = row_key + ':'
+    for key in model_class.Meta.row_key:
+        index = row_key.find(':')
+        if index == -1:
+            break
+        data[key] = legacy_deserialize_field(model_class, key, row_key[:index])
+        row_key = row_key[index + 1:]
+    return data
+
+
+def legacy_init_from_row(model_class, row_key, row_data):
+    if not row_data:
+        return None
+    data = legacy_deserialize_row_key(model_class, row_key)
+    for column_key, column_value in row_data.items():
+        column_key = column_key.decode('utf-8')
+        key = column_key[column_key.find(':') + 1:]
+        data[key] = legacy_deserialize_field(model_class, key, column_value)
+    instance = model_class.__new__(model_class)
+    for key in legacy_get_field_hash(model_class):
+        setattr(instance, key, data.get(key))
+    return instance
+
+
+class Command(BaseCommand):
+    help = 'Compare init_from_row with the compiled schema against rescanning the class on every call'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        size, repeat = options['size'], options['repeat']
+        created_at = int(time.time() * 1000000)
+        # 和 happybase scan 返回的一样，row key 和 row data 都是 bytes，不需要连接 HBase
+        rows = []
+        for i in range(1, size + 1):
+            following = HBaseFollowing(from_user_id=i, to_user_id=i + 1, created_at=created_at + i)
+            row_data = {
+                column_name.encode('utf-8'): value.encode('utf-8')
+                for column_name, value in following.get_row_data().items()
+            }
+            rows.append((following.row_key, row_data))
+
+        legacy_instances = [legacy_init_from_row(HBaseFollowing, *row) for row in rows]
+        instances = [HBaseFollowing.init_from_row(*row) for row in rows]
+        if [i.__dict__ for i in legacy_instances] != [i.__dict__ for i in instances]:
+            self.stderr.write('The two paths return different instances')
+            return
+
+        self.benchmark('legacy', lambda row: legacy_init_from_row(HBaseFollowing, *row), rows, repeat)
+        self.benchmark('schema', lambda row: HBaseFollowing.init_from_row(*row), rows, repeat)
+
+    def benchmark(self, name, init_from_row, rows, repeat):
+        # 每一轮都反序列化所有的 rows，取最快的一轮
+        best_time = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for row in rows:
+                init_from_row(row)
+            best_time = min(best_time, time.perf_counter() - start)
+        self.stdout.write('init_from_row x {} HBaseFollowing rows with {}: {:.1f}ms'.format(
+            len(rows),
+            name,
+            best_time * 1000,
+        ))
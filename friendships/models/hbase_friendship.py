@@ -8,6 +8,7 @@ class HBaseFollowing(models.HBaseModel):
      - A 关注的所有人按照关注时间排序
      - A 在某个时间段内关注的人有哪些
      - A 在某个时间点之后/之前关注的前 X 个人是谁
+     - A 是否关注了 B（通过 (from_user_id, to_user_id) 索引）
     """
     # row key
     from_user_id = models.IntegerField(reverse=True)
@@ -18,6 +19,8 @@ class HBaseFollowing(models.HBaseModel):
     class Meta:
         table_name = 'twitter_followings'
         row_key = ('from_user_id', 'created_at')
+        # 用于 has_followed / unfollow 直接查找 A 是否关注了 B，而不需要 scan A 的所有 followings
+        indexes = [('from_user_id', 'to_user_id')]
 
 
 class HBaseFollower(models.HBaseModel):
@@ -1,48 +1,312 @@
+from accounts.models import UserProfile
+from accounts.services import UserService
 from django.conf import settings
 from django.core.cache import caches
+from django.db.models import Q
 from friendships.models import HBaseFollowing, HBaseFollower, Friendship
 from gatekeeper.models import GateKeeper
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import (
+    FOLLOWED_SUPERSTARS_PATTERN,
+    FOLLOWED_SUPERSTARS_VERSION_PATTERN,
+    FOLLOWERS_COUNT_PATTERN,
+    FOLLOWINGS_PATTERN,
+)
+from utils.redis_client import RedisClient
+from utils.redis_stores import get_script
+from utils.shadow_helper import ShadowHelper
+from utils.time_constants import MAX_TIMESTAMP
+from utils.time_helpers import from_timestamp, to_timestamp
 
 import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# 粉丝数的 cache 存在的时候才更新，不存在的时候下次读取再从数据库 load
+INCR_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+# 修改 followed superstars，cache 存在的时候才更新，不存在的时候只增加 version
+# KEYS[1]: set, KEYS[2]: version, ARGV[1]: 'add' or 'remove', ARGV[2]: superstar id, ARGV[3]: expire time
+UPDATE_FOLLOWED_SUPERSTARS_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[1] == 'add' then
+    redis.call('SADD', KEYS[1], ARGV[2])
+else
+    redis.call('SREM', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# 重建 followed superstars 的 cache，读取数据库期间 version 变了的话说明有并发的修改，放弃写入
+# KEYS[1]: set, KEYS[2]: version, ARGV[1]: version before loading, ARGV[2]: expire time, ARGV[3...]: ids
+SAVE_FOLLOWED_SUPERSTARS_SCRIPT = """
+local version = redis.call('GET', KEYS[2]) or ''
+if version ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SADD', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
 
 class FriendshipService:
+    """
+    switch_friendship_to_hbase 按照用户放量，决定每个用户从哪个 backend 读取以及主要写到哪里
+    一条 friendship 同时属于 from_user 和 to_user，两个人可能在不同的 backend 上，
+    所以 percent 在 0 和 100 之间的时候需要打开 switch_friendship_dual_write，两个 backend 同时写入
+    shadow_friendship_reads 放量的用户会同时读取另一个 backend，比较结果和延迟
+    following_index_backfilled 由 backfill_following_index 在补完索引之后打开，之后索引查不到的时候不再 scan
+    """
 
     @classmethod
-    def get_follower_ids(cls, to_user_id):
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+    def use_hbase(cls, user_id):
+        return GateKeeper.in_gk('switch_friendship_to_hbase', user_id)
+
+    @classmethod
+    def read(cls, name, user_id, load, normalize=None):
+        """
+        load(use_hbase) 从指定的 backend 读取
+        """
+        use_hbase = cls.use_hbase(user_id)
+        if not GateKeeper.in_gk('shadow_friendship_reads', user_id):
+            return load(use_hbase)
+        return ShadowHelper.compare_reads(
+            'friendship_{}'.format(name),
+            lambda: load(use_hbase),
+            lambda: load(not use_hbase),
+            normalize=normalize,
+        )
+
+    @classmethod
+    def write(cls, name, user_id, save):
+        """
+        save(use_hbase) 写入指定的 backend，返回用户所在的 backend 的结果
+        """
+        use_hbase = cls.use_hbase(user_id)
+        if not GateKeeper.is_switch_on('switch_friendship_dual_write'):
+            return save(use_hbase)
+        return ShadowHelper.dual_write(
+            'friendship_{}'.format(name),
+            lambda: save(use_hbase),
+            lambda: save(not use_hbase),
+        )
+
+    @classmethod
+    def _get_follower_ids(cls, to_user_id, use_hbase):
+        if not use_hbase:
             friendships = Friendship.objects.filter(to_user_id=to_user_id)
         else:
-            friendships = HBaseFollower.filter(prefix=(to_user_id,))
+            friendships = HBaseFollower.filter(prefix=(to_user_id,), columns=['from_user_id'])
         return [friendship.from_user_id for friendship in friendships]
 
     @classmethod
-    def get_followed_superstars(cls, user):
+    def get_follower_ids(cls, to_user_id):
+        return cls.read(
+            'follower_ids',
+            to_user_id,
+            lambda use_hbase: cls._get_follower_ids(to_user_id, use_hbase),
+            normalize=sorted,
+        )
+
+    @classmethod
+    def iter_follower_ids(cls, to_user_id):
         """
-        Returns the superstars followed by user.
-        return: a list of User objects
+        和 get_follower_ids 一样，但是一边读一边返回，不会把所有粉丝一次性 load 到内存里
         """
-        friendships = Friendship.objects.filter(
-            from_user=user,
-            to_user__userprofile__is_superstar=True,
-        ).prefetch_related('to_user')
-        return [friendship.to_user for friendship in friendships]
+        if not cls.use_hbase(to_user_id):
+            follower_ids = Friendship.objects.filter(
+                to_user_id=to_user_id,
+            ).values_list('from_user_id', flat=True).iterator()
+            yield from follower_ids
+            return
+        for friendship in HBaseFollower.iter_filter(prefix=(to_user_id,), columns=['from_user_id']):
+            yield friendship.from_user_id
 
     @classmethod
-    def get_following_user_id_set(cls, from_user_id):
-        # <TODO> cache in redis set
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+    def get_follower_ids_page(cls, to_user_id, use_hbase, cursor=None, limit=100):
+        """
+        按照关注时间的顺序读取一页粉丝，用于可以中断和恢复的 fan-out
+        cursor: 上一页返回的 next_cursor，None 表示从头开始，不同 backend 的 cursor 不通用
+        Returns (follower_ids, next_cursor), next_cursor is None if there are no more followers.
+        next_cursor 可以被 json 序列化，方便保存在 checkpoint 里
+        """
+        if not use_hbase:
+            friendships = Friendship.objects.filter(to_user_id=to_user_id)
+            if cursor is not None:
+                created_at, friendship_id = from_timestamp(cursor[0]), cursor[1]
+                # 走 (to_user, created_at) 的索引，created_at 相同的时候用 id 区分
+                friendships = friendships.filter(
+                    Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=friendship_id)
+                )
+            rows = list(friendships.order_by('created_at', 'id').values_list(
+                'created_at',
+                'id',
+                'from_user_id',
+            )[:limit])
+            follower_ids = [from_user_id for _, _, from_user_id in rows]
+            if len(rows) < limit:
+                return follower_ids, None
+            return follower_ids, [to_timestamp(rows[-1][0]), rows[-1][1]]
+
+        # row key 是 (to_user_id, created_at)，同一个人的粉丝的 created_at 不会重复
+        if cursor is None:
+            friendships = HBaseFollower.filter(prefix=(to_user_id,), limit=limit, columns=['from_user_id'])
+        else:
+            friendships = HBaseFollower.filter(
+                start=(to_user_id, cursor + 1),
+                stop=(to_user_id, MAX_TIMESTAMP),
+                limit=limit,
+                columns=['from_user_id'],
+            )
+        follower_ids = [friendship.from_user_id for friendship in friendships]
+        if len(friendships) < limit:
+            return follower_ids, None
+        return follower_ids, friendships[-1].created_at
+
+    @classmethod
+    def iter_follower_id_batches(cls, to_user_id, batch_size):
+        batch_ids = []
+        for follower_id in cls.iter_follower_ids(to_user_id):
+            batch_ids.append(follower_id)
+            if len(batch_ids) == batch_size:
+                yield batch_ids
+                batch_ids = []
+        if batch_ids:
+            yield batch_ids
+
+    @classmethod
+    def _get_follower_count(cls, to_user_id, use_hbase):
+        if not use_hbase:
+            return Friendship.objects.filter(to_user_id=to_user_id).count()
+        return HBaseFollower.count(prefix=(to_user_id,))
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        # 从数据库读取准确的粉丝数
+        return cls.read(
+            'follower_count',
+            to_user_id,
+            lambda use_hbase: cls._get_follower_count(to_user_id, use_hbase),
+        )
+
+    @classmethod
+    def get_cached_follower_count(cls, to_user_id):
+        conn = RedisClient.get_connection('counters')
+        key = FOLLOWERS_COUNT_PATTERN.format(user_id=to_user_id)
+        count = conn.get(key)
+        if count is not None:
+            return int(count)
+        count = cls.get_follower_count(to_user_id)
+        conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME, nx=True)
+        return count
+
+    @classmethod
+    def set_cached_follower_count(cls, to_user_id, count):
+        conn = RedisClient.get_connection('counters')
+        key = FOLLOWERS_COUNT_PATTERN.format(user_id=to_user_id)
+        conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME)
+
+    @classmethod
+    def on_follow_changed(cls, from_user_id, to_user_id, delta):
+        """
+        更新粉丝数和 {from_user_id} 关注的 superstars 的 cache，粉丝数越过 superstar 的阈值的时候在后台迁移
+        只是触发条件，真正迁移之前会用数据库里准确的粉丝数再判断一次
+        """
+        # import placed inside to avoid circular dependency
+        from newsfeeds.tasks import update_superstar_task
+
+        conn = RedisClient.get_connection('counters')
+        incr_script = get_script(conn, INCR_IF_EXISTS_SCRIPT)
+        count = incr_script(
+            keys=[FOLLOWERS_COUNT_PATTERN.format(user_id=to_user_id)],
+            args=[delta],
+            client=conn,
+        )
+        if count is None:
+            count = cls.get_cached_follower_count(to_user_id)
+        is_superstar = UserService.get_profile_through_cache(to_user_id).is_superstar
+        # 取消关注的时候不管是不是 superstar 都删除，正在降级的 superstar 也不会残留
+        if delta < 0 or is_superstar:
+            cls.update_followed_superstar_ids(from_user_id, to_user_id, is_following=delta > 0)
+        if UserService.should_be_superstar(is_superstar, int(count)) != is_superstar:
+            update_superstar_task.delay(to_user_id)
+
+    @classmethod
+    def get_followed_superstar_keys(cls, user_id):
+        return [
+            FOLLOWED_SUPERSTARS_PATTERN.format(user_id=user_id),
+            FOLLOWED_SUPERSTARS_VERSION_PATTERN.format(user_id=user_id),
+        ]
+
+    @classmethod
+    def _load_followed_superstar_ids(cls, user_id):
+        # followings 可能在 HBase 里，不能直接和 UserProfile join
+        return set(UserProfile.objects.filter(
+            user_id__in=cls.get_following_user_id_set(user_id),
+            is_superstar=True,
+        ).values_list('user_id', flat=True))
+
+    @classmethod
+    def get_followed_superstar_ids(cls, user_id):
+        """
+        Returns the set of ids of the superstars followed by {user_id}.
+        大部分用户没有关注 superstar，空集合也会被 cache，读 newsfeed 的时候只需要一次 SMEMBERS
+        """
+        conn = RedisClient.get_connection('timeline', user_id)
+        key, version_key = cls.get_followed_superstar_keys(user_id)
+        superstar_ids = conn.smembers(key)
+        if superstar_ids:
+            return set(int(superstar_id) for superstar_id in superstar_ids) - {0}
+
+        version = conn.get(version_key) or b''
+        superstar_ids = cls._load_followed_superstar_ids(user_id)
+        save_script = get_script(conn, SAVE_FOLLOWED_SUPERSTARS_SCRIPT)
+        save_script(
+            keys=[key, version_key],
+            args=[version, settings.REDIS_KEY_EXPIRE_TIME, 0, *superstar_ids],
+            client=conn,
+        )
+        return superstar_ids
+
+    @classmethod
+    def update_followed_superstar_ids(cls, user_id, superstar_id, is_following):
+        """
+        follow / unfollow superstar，以及 superstar 状态切换的时候调用
+        """
+        conn = RedisClient.get_connection('timeline', user_id)
+        update_script = get_script(conn, UPDATE_FOLLOWED_SUPERSTARS_SCRIPT)
+        update_script(
+            keys=cls.get_followed_superstar_keys(user_id),
+            args=['add' if is_following else 'remove', superstar_id, settings.REDIS_KEY_EXPIRE_TIME],
+            client=conn,
+        )
+
+    @classmethod
+    def _get_following_user_id_set(cls, from_user_id, use_hbase):
+        if not use_hbase:
             friendships = Friendship.objects.filter(from_user_id=from_user_id)
         else:
-            friendships = HBaseFollowing.filter(prefix=(from_user_id,))
-        user_id_set = set([
-            fs.to_user_id
-            for fs in friendships
-        ])
-        return user_id_set
+            friendships = HBaseFollowing.filter(prefix=(from_user_id,), columns=['to_user_id'])
+        return set([fs.to_user_id for fs in friendships])
+
+    @classmethod
+    def get_following_user_id_set(cls, from_user_id):
+        # <TODO> cache in redis set
+        return cls.read(
+            'following_user_id_set',
+            from_user_id,
+            lambda use_hbase: cls._get_following_user_id_set(from_user_id, use_hbase),
+        )
 
     @classmethod
     def invalidate_following_cache(cls, from_user_id):
@@ -51,18 +315,21 @@ class FriendshipService:
 
     @classmethod
     def get_follow_instance(cls, from_user_id, to_user_id):
-        followings = HBaseFollowing.filter(prefix=(from_user_id,))
-        for follow in followings:
-            if follow.to_user_id == to_user_id:
-                return follow
-        return None
+        # 通过 (from_user_id, to_user_id) 索引直接查找，而不需要 scan 所有的 followings
+        instance = HBaseFollowing.get_by_index(from_user_id=from_user_id, to_user_id=to_user_id)
+        if instance is not None or GateKeeper.is_switch_on('following_index_backfilled'):
+            return instance
+        # 加索引之前创建的 followings 没有索引，backfill_following_index 跑完之前退回到 scan
+        followings = HBaseFollowing.filter(
+            prefix=(from_user_id,),
+            where={'to_user_id': to_user_id},
+            limit=1,
+        )
+        return followings[0] if followings else None
 
     @classmethod
-    def has_followed(cls, from_user_id, to_user_id):
-        if from_user_id == to_user_id:
-            return False
-
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+    def _has_followed(cls, from_user_id, to_user_id, use_hbase):
+        if not use_hbase:
             return Friendship.objects.filter(
                 from_user_id=from_user_id,
                 to_user_id=to_user_id,
@@ -72,11 +339,18 @@ class FriendshipService:
         return instance is not None
 
     @classmethod
-    def follow(cls, from_user_id, to_user_id):
+    def has_followed(cls, from_user_id, to_user_id):
         if from_user_id == to_user_id:
-            return None
+            return False
+        return cls.read(
+            'has_followed',
+            from_user_id,
+            lambda use_hbase: cls._has_followed(from_user_id, to_user_id, use_hbase),
+        )
 
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+    @classmethod
+    def _follow(cls, from_user_id, to_user_id, use_hbase):
+        if not use_hbase:
             # create data in mysql
             return Friendship.objects.create(
                 from_user_id=from_user_id,
@@ -97,11 +371,20 @@ class FriendshipService:
         )
 
     @classmethod
-    def unfollow(cls, from_user_id, to_user_id):
+    def follow(cls, from_user_id, to_user_id):
         if from_user_id == to_user_id:
-            return 0
+            return None
+        instance = cls.write(
+            'follow',
+            from_user_id,
+            lambda use_hbase: cls._follow(from_user_id, to_user_id, use_hbase),
+        )
+        cls.on_follow_changed(from_user_id, to_user_id, 1)
+        return instance
 
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+    @classmethod
+    def _unfollow(cls, from_user_id, to_user_id, use_hbase):
+        if not use_hbase:
             deleted, _ = Friendship.objects.filter(
                 from_user_id=from_user_id,
                 to_user_id=to_user_id,
@@ -112,13 +395,38 @@ class FriendshipService:
         if instance is None:
             return 0
 
-        HBaseFollowing.delete(from_user_id=from_user_id, created_at=instance.created_at)
+        HBaseFollowing.delete(
+            from_user_id=from_user_id,
+            created_at=instance.created_at,
+            to_user_id=to_user_id,
+        )
         HBaseFollower.delete(to_user_id=to_user_id, created_at=instance.created_at)
         return 1
 
     @classmethod
-    def get_following_count(cls, from_user_id):
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+    def unfollow(cls, from_user_id, to_user_id):
+        if from_user_id == to_user_id:
+            return 0
+        deleted = cls.write(
+            'unfollow',
+            from_user_id,
+            lambda use_hbase: cls._unfollow(from_user_id, to_user_id, use_hbase),
+        )
+        if deleted:
+            cls.on_follow_changed(from_user_id, to_user_id, -1)
+        return deleted
+
+    @classmethod
+    def _get_following_count(cls, from_user_id, use_hbase):
+        if not use_hbase:
             return Friendship.objects.filter(from_user_id=from_user_id).count()
-        followings = HBaseFollowing.filter(prefix=(from_user_id,))
-        return len(followings)
+        # 只需要数一下有多少行，不需要读取任何 column
+        return HBaseFollowing.count(prefix=(from_user_id,))
+
+    @classmethod
+    def get_following_count(cls, from_user_id):
+        return cls.read(
+            'following_count',
+            from_user_id,
+            lambda use_hbase: cls._get_following_count(from_user_id, use_hbase),
+        )
@@ -1,8 +1,27 @@
-from django_hbase.models import EmptyColumnError, BadRowKeyError
-from friendships.models import HBaseFollowing, HBaseFollower
+from accounts.models import UserProfile
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.test import override_settings
+from django_hbase.client import HBaseClient
+from django_hbase.models import (
+    BadRowKeyError,
+    EmptyColumnError,
+    HBaseField,
+    HBaseModel,
+    HBaseModelSchema,
+    IntegerField,
+    TimestampField,
+)
+from django_hbase.models.hbase_models import ASYNC_PREFETCH_SIZE, ASYNC_PUT_TIMEOUT
+from friendships.models import Friendship, HBaseFollowing, HBaseFollower
 from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from io import StringIO
 from testing.testcases import TestCase
+from utils.metrics_helper import MetricsHelper
+from utils.redis_client import RedisClient
 
+import asyncio
 import time
 
 
@@ -36,6 +55,116 @@ class FriendshipServiceTests(TestCase):
         user_id_set = FriendshipService.get_following_user_id_set(self.linghu.id)
         self.assertEqual(user_id_set, {user1.id, user2.id})
 
+    def test_backfill_following_index(self):
+        user1 = self.create_user('user1')
+        for to_user in [user1, self.dongxie]:
+            self.create_friendship(from_user=self.linghu, to_user=to_user)
+        # 加索引之前创建的 followings 没有索引
+        HBaseFollowing.delete_index_rows([
+            {'from_user_id': self.linghu.id, 'to_user_id': user1.id},
+            {'from_user_id': self.linghu.id, 'to_user_id': self.dongxie.id},
+        ])
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=self.linghu.id, to_user_id=user1.id), None)
+
+        # backfill 之前退回到 scan
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, user1.id), True)
+        self.assertEqual(FriendshipService.has_followed(user1.id, self.linghu.id), False)
+        self.assertEqual(FriendshipService.unfollow(self.linghu.id, self.dongxie.id), 1)
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, self.dongxie.id), False)
+
+        out = StringIO()
+        call_command('backfill_following_index', stdout=out)
+        self.assertEqual(out.getvalue(), '1 followings indexed.\n')
+        self.assertEqual(GateKeeper.is_switch_on('following_index_backfilled'), True)
+        instance = HBaseFollowing.get_by_index(from_user_id=self.linghu.id, to_user_id=user1.id)
+        self.assertEqual(instance.to_user_id, user1.id)
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, user1.id), True)
+
+        # backfill 之后只查索引
+        HBaseFollowing.delete_index_rows([{'from_user_id': self.linghu.id, 'to_user_id': user1.id}])
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, user1.id), False)
+
+    def test_rollout_and_shadow_reads(self):
+        GateKeeper.set_kv('switch_friendship_to_hbase', 'percent', 50)
+        GateKeeper.turn_on('switch_friendship_dual_write')
+        users = [self.create_user('user{}'.format(i)) for i in range(10)]
+        for user in users:
+            self.create_friendship(from_user=user, to_user=self.linghu)
+
+        # 不管每个用户在哪个 backend 上，两边都有完整的数据
+        follower_ids = sorted(user.id for user in users)
+        self.assertEqual(sorted(FriendshipService._get_follower_ids(self.linghu.id, True)), follower_ids)
+        self.assertEqual(sorted(FriendshipService._get_follower_ids(self.linghu.id, False)), follower_ids)
+        self.assertEqual(MetricsHelper.get('shadow:friendship_follow')['calls'], 10)
+
+        GateKeeper.turn_on('shadow_friendship_reads')
+        self.assertEqual(sorted(FriendshipService.get_follower_ids(self.linghu.id)), follower_ids)
+        metrics = MetricsHelper.get('shadow:friendship_follower_ids')
+        self.assertEqual(metrics['calls'], 1)
+        self.assertEqual(metrics['mismatches'], 0)
+        self.assertIn('shadow_seconds', metrics)
+
+        # 两边的数据不一致的时候记录 mismatch，返回的还是 primary 的结果
+        Friendship.objects.filter(from_user_id=users[0].id).delete()
+        follower_ids = FriendshipService.get_follower_ids(self.linghu.id)
+        self.assertEqual(len(follower_ids), 9 if not FriendshipService.use_hbase(self.linghu.id) else 10)
+        self.assertEqual(MetricsHelper.get('shadow:friendship_follower_ids')['mismatches'], 1)
+
+    @override_settings(SUPERSTAR_DEMOTE_THRESHOLD=0)
+    def test_followed_superstar_ids(self):
+        star = self.create_user('star')
+        profile, _ = UserProfile.objects.get_or_create(user=star)
+        profile.is_superstar = True
+        profile.save()
+
+        # 空集合也会被 cache
+        self.assertEqual(FriendshipService.get_followed_superstar_ids(self.linghu.id), set())
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_followed_superstar_ids(self.linghu.id), set())
+
+        # follow / unfollow 的时候直接更新 cache
+        self.create_friendship(self.linghu, star)
+        self.create_friendship(self.linghu, self.dongxie)
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_followed_superstar_ids(self.linghu.id), {star.id})
+        FriendshipService.unfollow(self.linghu.id, star.id)
+        self.assertEqual(FriendshipService.get_followed_superstar_ids(self.linghu.id), set())
+
+        # 重建 cache 的过程中有并发的修改，放弃写入，下次读取的时候重新 load
+        conn = RedisClient.get_connection('timeline', self.linghu.id)
+        key, version_key = FriendshipService.get_followed_superstar_keys(self.linghu.id)
+        conn.delete(key)
+        load = FriendshipService.__dict__['_load_followed_superstar_ids']
+
+        def load_with_concurrent_follow(cls, user_id):
+            superstar_ids = load.__func__(cls, user_id)
+            FriendshipService.follow(self.linghu.id, star.id)
+            return superstar_ids
+
+        FriendshipService._load_followed_superstar_ids = classmethod(load_with_concurrent_follow)
+        try:
+            self.assertEqual(FriendshipService.get_followed_superstar_ids(self.linghu.id), set())
+        finally:
+            FriendshipService._load_followed_superstar_ids = load
+        self.assertEqual(conn.exists(key), False)
+        self.assertEqual(FriendshipService.get_followed_superstar_ids(self.linghu.id), {star.id})
+
+
+class HBaseEvent(HBaseModel):
+    """
+    binary row key 的 model，只在测试里使用
+    """
+    # row key
+    user_id = IntegerField(reverse=True)
+    created_at = TimestampField()
+    # column key
+    happened_at = TimestampField(column_family='cf')
+
+    class Meta:
+        table_name = 'events'
+        row_key = ('user_id', 'created_at')
+        row_key_format = 'binary'
+
 
 class HBaseTests(TestCase):
 
@@ -43,6 +172,96 @@ class HBaseTests(TestCase):
     def ts_now(self):
         return int(time.time() * 1000000)
 
+    def test_connection_pool(self):
+        pool = HBaseClient.get_pool()
+        self.assertIs(pool, HBaseClient.get_pool())
+
+        with HBaseClient.connection() as conn1:
+            # nested checkouts in the same thread share one connection
+            with HBaseClient.connection() as conn2:
+                self.assertIs(conn1, conn2)
+        # the connection is returned to the pool and reused
+        with HBaseClient.connection() as conn3:
+            self.assertIs(conn1, conn3)
+            conn3.tables()
+
+    def test_schema(self):
+        schema = HBaseFollowing.schema
+        self.assertEqual(list(schema.fields), ['from_user_id', 'created_at', 'to_user_id'])
+        self.assertEqual([key for key, _ in schema.row_key_fields], ['from_user_id', 'created_at'])
+        self.assertEqual(schema.column_names, {'to_user_id': 'cf:to_user_id'})
+        self.assertEqual(schema.column_keys, {b'cf:to_user_id': 'to_user_id'})
+        # every model class compiles its own schema
+        self.assertEqual(HBaseFollower.schema.column_names, {'from_user_id': 'cf:from_user_id'})
+
+        row_key = HBaseFollowing.serialize_row_key({'from_user_id': 12, 'created_at': 34})
+        self.assertEqual(row_key, b'2100000000000000:34')
+        self.assertEqual(
+            HBaseFollowing.deserialize_row_key(row_key),
+            {'from_user_id': 12, 'created_at': 34},
+        )
+
+    def test_binary_row_key_fields(self):
+        field = TimestampField()
+        self.assertEqual(field.packed_width, 8)
+        packed = [field.pack(value) for value in [-5, 0, 3, 10, 1627000000000000]]
+        # byte order is the same as the numeric order, negative numbers included
+        self.assertEqual(packed, sorted(packed))
+        self.assertEqual([field.unpack(value) for value in packed], [-5, 0, 3, 10, 1627000000000000])
+
+        # reversed fields get a one byte hash prefix instead of being reversed
+        field = IntegerField(reverse=True)
+        self.assertEqual(field.packed_width, 9)
+        self.assertEqual(len(field.pack(12)), 9)
+        self.assertEqual(field.pack(12)[1:], IntegerField().pack(12))
+        self.assertEqual(field.unpack(field.pack(12)), 12)
+
+        try:
+            field.pack(1 << 64)
+            exception_raised = False
+        except BadRowKeyError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+        # fields without a fixed width encoding are refused when the schema is compiled
+        class BadEvent:
+            name = HBaseField()
+
+            class Meta:
+                row_key = ('name',)
+                row_key_format = 'binary'
+
+        try:
+            HBaseModelSchema(BadEvent)
+            exception_raised = False
+        except BadRowKeyError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_binary_row_key_model(self):
+        for created_at in [3000, 5, 200, 10]:
+            HBaseEvent.create(user_id=1, created_at=created_at, happened_at=created_at * 2)
+        HBaseEvent.create(user_id=12, created_at=7, happened_at=1)
+
+        row_key = HBaseEvent.serialize_row_key({'user_id': 1, 'created_at': 5})
+        self.assertEqual(row_key, IntegerField(reverse=True).pack(1) + TimestampField().pack(5))
+        self.assertEqual(HBaseEvent.deserialize_row_key(row_key), {'user_id': 1, 'created_at': 5})
+
+        event = HBaseEvent.get(user_id=1, created_at=10)
+        self.assertEqual(event.user_id, 1)
+        self.assertEqual(event.happened_at, 20)
+        self.assertEqual(HBaseEvent.get(user_id=1, created_at=11), None)
+
+        # rows are in numeric order even if the values have different digit lengths
+        events = HBaseEvent.filter(prefix=(1,))
+        self.assertEqual([e.created_at for e in events], [5, 10, 200, 3000])
+        events = HBaseEvent.filter(prefix=(1,), reverse=True, limit=3)
+        self.assertEqual([e.created_at for e in events], [3000, 200, 10])
+        events = HBaseEvent.filter(start=(1, 6), stop=(1, 1000))
+        self.assertEqual([e.created_at for e in events], [10, 200])
+        events = HBaseEvent.filter(prefix=(12,))
+        self.assertEqual([(e.user_id, e.created_at, e.happened_at) for e in events], [(12, 7, 1)])
+
     def test_save_and_get(self):
         timestamp = self.ts_now
         following = HBaseFollowing(from_user_id=123, to_user_id=34, created_at=timestamp)
@@ -63,6 +282,259 @@ class HBaseTests(TestCase):
         instance = HBaseFollowing.get(from_user_id=123, created_at=self.ts_now)
         self.assertEqual(instance, None)
 
+    def test_get_many(self):
+        ts1 = HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=self.ts_now).created_at
+        ts2 = HBaseFollowing.create(from_user_id=1, to_user_id=3, created_at=self.ts_now).created_at
+        ts3 = HBaseFollowing.create(from_user_id=2, to_user_id=4, created_at=self.ts_now).created_at
+
+        keys = [
+            {'from_user_id': 2, 'created_at': ts3},
+            {'from_user_id': 1, 'created_at': self.ts_now},
+            {'from_user_id': 1, 'created_at': ts1},
+            {'from_user_id': 1, 'created_at': ts2},
+        ]
+        # results keep the order of keys, None for missing rows
+        instances = HBaseFollowing.get_many(keys)
+        self.assertEqual(len(instances), 4)
+        self.assertEqual(instances[0].to_user_id, 4)
+        self.assertEqual(instances[1], None)
+        self.assertEqual(instances[2].to_user_id, 2)
+        self.assertEqual(instances[3].to_user_id, 3)
+
+        # chunk size should not change the results
+        instances = HBaseFollowing.get_many(keys, chunk_size=1)
+        self.assertEqual(
+            [instance and instance.to_user_id for instance in instances],
+            [4, None, 2, 3],
+        )
+        self.assertEqual(HBaseFollowing.get_many([]), [])
+
+    def test_iter_filter(self):
+        for to_user_id in range(2, 7):
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=self.ts_now)
+
+        # rows are loaded lazily
+        followings = HBaseFollowing.iter_filter(prefix=(1,), batch_size=2)
+        self.assertEqual(next(followings).to_user_id, 2)
+        self.assertEqual([f.to_user_id for f in followings], [3, 4, 5, 6])
+
+        followings = HBaseFollowing.iter_filter(prefix=(1,), limit=3, reverse=True)
+        self.assertEqual([f.to_user_id for f in followings], [6, 5, 4])
+
+        # projection only changes the columns, row key fields are always returned
+        followings = list(HBaseFollowing.iter_filter(prefix=(1,), columns=['to_user_id']))
+        self.assertEqual(len(followings), 5)
+        self.assertEqual(followings[0].from_user_id, 1)
+        self.assertEqual(followings[0].to_user_id, 2)
+
+    def test_projection_and_keys_only(self):
+        ts = self.ts_now
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=ts)
+        HBaseFollowing.create(from_user_id=1, to_user_id=3, created_at=self.ts_now)
+
+        instance = HBaseFollowing.get(from_user_id=1, created_at=ts, columns=['to_user_id'])
+        self.assertEqual(instance.to_user_id, 2)
+        instances = HBaseFollowing.get_many([{'from_user_id': 1, 'created_at': ts}], columns=['to_user_id'])
+        self.assertEqual(instances[0].to_user_id, 2)
+
+        # keys only scans return the row key fields only
+        followings = HBaseFollowing.filter(prefix=(1,), keys_only=True)
+        self.assertEqual(len(followings), 2)
+        self.assertEqual(followings[0].from_user_id, 1)
+        self.assertEqual(followings[0].created_at, ts)
+        self.assertEqual(followings[0].to_user_id, None)
+
+        # row key fields cannot be projected
+        try:
+            HBaseFollowing.filter(prefix=(1,), columns=['from_user_id'])
+            exception_raised = False
+        except ValueError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_where_and_count(self):
+        for to_user_id in [2, 3, 10, 3]:
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=self.ts_now)
+        HBaseFollowing.create(from_user_id=2, to_user_id=3, created_at=self.ts_now)
+
+        followings = HBaseFollowing.filter(prefix=(1,), where={'to_user_id': 3})
+        self.assertEqual([f.to_user_id for f in followings], [3, 3])
+        followings = HBaseFollowing.filter(prefix=(1,), where={'to_user_id__gt': 2})
+        self.assertEqual([f.to_user_id for f in followings], [3, 10, 3])
+        # values with different digit lengths compare numerically
+        followings = HBaseFollowing.filter(prefix=(1,), where={'to_user_id__gte': 9})
+        self.assertEqual([f.to_user_id for f in followings], [10])
+        followings = HBaseFollowing.filter(prefix=(1,), where={'to_user_id__lt': 10})
+        self.assertEqual([f.to_user_id for f in followings], [2, 3, 3])
+        followings = HBaseFollowing.filter(prefix=(1,), where={'to_user_id__ne': 3}, keys_only=True)
+        self.assertEqual(len(followings), 2)
+        self.assertEqual(followings[0].to_user_id, None)
+
+        self.assertEqual(HBaseFollowing.count(prefix=(1,)), 4)
+        self.assertEqual(HBaseFollowing.count(prefix=(1,), where={'to_user_id': 3}), 2)
+        self.assertEqual(HBaseFollowing.count(prefix=(3,)), 0)
+        self.assertEqual(HBaseFollowing.count(), 5)
+
+        try:
+            HBaseFollowing.filter(where={'to_user_id__in': [1, 2]})
+            exception_raised = False
+        except ValueError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+        # timestamps are not zero padded, range lookups on them are refused
+        self.assertEqual(
+            HBaseEvent.compile_where({'happened_at': 9}),
+            "SingleColumnValueFilter('cf', 'happened_at', =, 'binary:9', true, true)",
+        )
+        try:
+            HBaseEvent.compile_where({'happened_at__gt': 9})
+            exception_raised = False
+        except ValueError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+        # negative numbers are not zero padded either
+        try:
+            HBaseFollowing.compile_where({'to_user_id__lt': -1})
+            exception_raised = False
+        except ValueError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_index(self):
+        ts = self.ts_now
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=ts)
+        HBaseFollowing.batch_create([
+            {'from_user_id': 1, 'to_user_id': 3, 'created_at': self.ts_now},
+            {'from_user_id': 4, 'to_user_id': 2, 'created_at': self.ts_now},
+        ])
+
+        instance = HBaseFollowing.get_by_index(from_user_id=1, to_user_id=2)
+        self.assertEqual(instance.created_at, ts)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=1, to_user_id=3).to_user_id, 3)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=4, to_user_id=2).from_user_id, 4)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=2, to_user_id=1), None)
+
+        # index rows are removed together with the data
+        HBaseFollowing.delete(from_user_id=1, created_at=ts)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=1, to_user_id=2), None)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=1, to_user_id=3).to_user_id, 3)
+
+        # an outdated index row is ignored
+        following = HBaseFollowing.get_by_index(from_user_id=4, to_user_id=2)
+        following.to_user_id = 5
+        following.save()
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=4, to_user_id=2), None)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=4, to_user_id=5).to_user_id, 5)
+
+        # only declared indexes can be used
+        try:
+            HBaseFollowing.get_by_index(to_user_id=2)
+            exception_raised = False
+        except ValueError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_batch(self):
+        timestamps = [self.ts_now for _ in range(5)]
+        followings = HBaseFollowing.batch_create([
+            {'from_user_id': 1, 'to_user_id': index + 2, 'created_at': ts}
+            for index, ts in enumerate(timestamps)
+        ], batch_size=2)
+        self.assertEqual(len(followings), 5)
+        self.assertEqual(HBaseFollowing.count(prefix=(1,)), len(set(timestamps)))
+
+        # mixed puts and deletes, flushed every 2 mutations
+        with HBaseFollowing.batch(batch_size=2) as batch:
+            batch.delete(from_user_id=1, created_at=followings[0].created_at)
+            HBaseFollowing.create(batch=batch, from_user_id=3, to_user_id=4, created_at=self.ts_now)
+            batch.delete(from_user_id=1, created_at=followings[1].created_at)
+            self.assertEqual(len(batch.timings), 1)
+        self.assertEqual([count for count, _ in batch.timings], [2, 1])
+        self.assertEqual(HBaseFollowing.count(prefix=(3,)), 1)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=1, to_user_id=2), None)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=3, to_user_id=4).to_user_id, 4)
+
+        deleted = HBaseFollowing.batch_delete([
+            {'from_user_id': following.from_user_id, 'created_at': following.created_at}
+            for following in followings
+        ])
+        self.assertEqual(deleted, 5)
+        self.assertEqual(HBaseFollowing.count(prefix=(1,)), 0)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=1, to_user_id=6), None)
+
+        # unfollow and follow again in the same batch, the index row belongs to the new row
+        ts = self.ts_now
+        HBaseFollowing.create(from_user_id=7, to_user_id=8, created_at=ts)
+        with HBaseFollowing.batch() as batch:
+            batch.delete(from_user_id=7, created_at=ts)
+            HBaseFollowing.create(batch=batch, from_user_id=7, to_user_id=8, created_at=ts + 1)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id=7, to_user_id=8).created_at, ts + 1)
+
+        # follow and unfollow in the same batch, the index row of the unsent put is deleted too
+        ts = self.ts_now
+        with HBaseFollowing.batch() as batch:
+            HBaseFollowing.create(batch=batch, from_user_id=9, to_user_id=10, created_at=ts)
+            batch.delete(from_user_id=9, created_at=ts)
+        self.assertEqual(HBaseFollowing.count(prefix=(9,)), 0)
+        index = HBaseFollowing.schema.indexes[0]
+        index_key = HBaseFollowing.get_index_key(index, {'from_user_id': 9, 'to_user_id': 10})
+        with HBaseClient.connection() as conn:
+            self.assertEqual(conn.table(HBaseFollowing.get_index_table_name(index)).row(index_key), {})
+
+    def test_async(self):
+        ts = self.ts_now
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=ts)
+        HBaseFollowing.create(from_user_id=1, to_user_id=3, created_at=self.ts_now)
+        HBaseFollower.create(from_user_id=1, to_user_id=2, created_at=ts)
+
+        async def load():
+            return await asyncio.gather(
+                HBaseFollowing.aget(from_user_id=1, created_at=ts),
+                HBaseFollower.aget_many([{'to_user_id': 2, 'created_at': ts}]),
+                HBaseFollowing.acount(prefix=(1,)),
+            )
+
+        following, followers, count = async_to_sync(load)()
+        self.assertEqual(following.to_user_id, 2)
+        self.assertEqual(followers[0].from_user_id, 1)
+        self.assertEqual(count, 2)
+
+        async def load_followings(limit=None):
+            to_user_ids = []
+            async for following in HBaseFollowing.afilter(prefix=(1,)):
+                to_user_ids.append(following.to_user_id)
+                if limit and len(to_user_ids) == limit:
+                    break
+            return to_user_ids
+
+        self.assertEqual(async_to_sync(load_followings)(), [2, 3])
+        # stopping early does not leak the scan
+        self.assertEqual(async_to_sync(load_followings)(limit=1), [2])
+
+        # stopping early while the prefetch queue is full still returns the connection to the pool
+        HBaseFollowing.batch_create([
+            {'from_user_id': 2, 'to_user_id': index, 'created_at': ts + index}
+            for index in range(ASYNC_PREFETCH_SIZE + 50)
+        ])
+
+        async def load_first_following():
+            followings = HBaseFollowing.afilter(prefix=(2,))
+            try:
+                async for following in followings:
+                    # wait until the producer is blocked on the full queue
+                    await asyncio.sleep(0.5)
+                    return following.to_user_id
+            finally:
+                await followings.aclose()
+
+        start = time.time()
+        self.assertEqual(async_to_sync(load_first_following)(), 0)
+        # aclose waits for the producer, which returns without waiting for ASYNC_PUT_TIMEOUT
+        self.assertLess(time.time() - start, 0.5 + ASYNC_PUT_TIMEOUT)
+        pool = HBaseClient.get_pool()
+        self.assertEqual(pool._queue.qsize(), pool.size)
+
     def test_create_and_get(self):
         # missing column data, cannot store in hbase
         try:
@@ -0,0 +1,15 @@
+from gatekeeper.models import GateKeeper
+
+
+class GateKeeperSnapshotMiddleware:
+    """
+    每个请求开始的时候取一个 gatekeeper 的快照，请求里所有的分支读到的开关都是一致的
+    并且整个请求最多只需要一次 redis 读取
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with GateKeeper.snapshot():
+            return self.get_response(request)
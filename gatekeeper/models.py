@@ -1,26 +1,123 @@
+from contextlib import contextmanager
+from django.conf import settings
 from utils.redis_client import RedisClient
 
+import contextvars
+import hashlib
+import threading
+import time
+import uuid
+
+# 所有 gatekeeper 的名字
+NAMES_KEY = 'gatekeeper:names'
+# 任何 gatekeeper 被修改的时候都会换成一个新的随机值，进程内的 cache 通过它判断是否过期
+VERSION_KEY = 'gatekeeper:version'
+DEFAULT_GK = {'percent': 0, 'description': ''}
+# 按照用户放量的时候分成 100 个 bucket
+NUM_BUCKETS = 100
+
+
+def parse_gk(redis_hash):
+    if not redis_hash:
+        return DEFAULT_GK
+    return {
+        'percent': int(redis_hash.get(b'percent', 0)),
+        'description': str(redis_hash.get(b'description', '')),
+    }
+
+
+class GateKeeperCache:
+    """
+    某一个 version 下所有 gatekeeper 的快照
+    """
+
+    def __init__(self, version, gks):
+        self.version = version
+        self.gks = gks
+        self.checked_at = time.time()
+
 
 class GateKeeper:
+    # 进程内的 cache，最多每 GATEKEEPER_CACHE_TTL 秒检查一次 version
+    cache = None
+    lock = threading.Lock()
+    # 当前请求的快照，同一个请求里所有的 gatekeeper 都从同一个快照里读取，保证一致
+    request_snapshot = contextvars.ContextVar('gatekeeper_snapshot', default=None)
 
     @classmethod
-    def get(cls, gk_name):
-        conn = RedisClient.get_connection()
-        name = f'gatekeeper:{gk_name}'
-        if not conn.exists(name):
-            return {'percent': 0, 'description': ''}
-
-        redis_hash = conn.hgetall(name)
-        return {
-            'percent': int(redis_hash.get(b'percent', 0)),
-            'description': str(redis_hash.get(b'description', '')),
+    def get_name(cls, gk_name):
+        return f'gatekeeper:{gk_name}'
+
+    @classmethod
+    def load_all(cls, conn):
+        """
+        在一个 MULTI 里读取所有的 gatekeeper 和 version，得到一个一致的快照
+        读取期间有新的 gatekeeper 被创建的话重新读取
+        """
+        gk_names = conn.smembers(NAMES_KEY)
+        while True:
+            pipe = conn.pipeline(transaction=True)
+            pipe.get(VERSION_KEY)
+            pipe.smembers(NAMES_KEY)
+            for gk_name in gk_names:
+                pipe.hgetall(cls.get_name(gk_name.decode()))
+            version, current_gk_names, *redis_hashes = pipe.execute()
+            if current_gk_names == gk_names:
+                break
+            gk_names = current_gk_names
+        gks = {
+            gk_name.decode(): parse_gk(redis_hash)
+            for gk_name, redis_hash in zip(gk_names, redis_hashes)
         }
+        return GateKeeperCache(version, gks)
+
+    @classmethod
+    def get_cache(cls):
+        cache = cls.cache
+        if cache is not None and time.time() - cache.checked_at < settings.GATEKEEPER_CACHE_TTL:
+            return cache
+
+        conn = RedisClient.get_connection('gatekeeper')
+        # version 没有变化的时候只需要一次 GET
+        if cache is not None and conn.get(VERSION_KEY) == cache.version:
+            cache.checked_at = time.time()
+            return cache
+        with cls.lock:
+            cls.cache = cls.load_all(conn)
+        return cls.cache
+
+    @classmethod
+    @contextmanager
+    def snapshot(cls):
+        """
+        with GateKeeper.snapshot():
+            ...  # 这里面读到的 gatekeeper 都来自同一个快照
+        """
+        token = cls.request_snapshot.set(cls.get_cache())
+        try:
+            yield
+        finally:
+            cls.request_snapshot.reset(token)
+
+    @classmethod
+    def get(cls, gk_name):
+        cache = cls.request_snapshot.get() or cls.get_cache()
+        if gk_name not in cache.gks:
+            # 不在 gatekeeper:names 里的 gatekeeper，例如还没有被设置过的，直接读取一次
+            conn = RedisClient.get_connection('gatekeeper')
+            cache.gks[gk_name] = parse_gk(conn.hgetall(cls.get_name(gk_name)))
+        return dict(cache.gks[gk_name])
 
     @classmethod
     def set_kv(cls, gk_name, key, value):
-        conn = RedisClient.get_connection()
-        name = f'gatekeeper:{gk_name}'
-        conn.hset(name, key, value)
+        conn = RedisClient.get_connection('gatekeeper')
+        pipe = conn.pipeline(transaction=True)
+        pipe.hset(cls.get_name(gk_name), key, value)
+        pipe.sadd(NAMES_KEY, gk_name)
+        pipe.set(VERSION_KEY, uuid.uuid4().hex)
+        pipe.execute()
+        # 本进程马上可以读到新的值，其他进程最多 GATEKEEPER_CACHE_TTL 秒之后读到
+        cls.cache = None
 
     @classmethod
     def is_switch_on(cls, gk_name):
@@ -30,6 +127,21 @@ class GateKeeper:
     def turn_on(cls, gk_name):
         cls.set_kv(gk_name, 'percent', 100)
 
+    @classmethod
+    def get_bucket(cls, gk_name, user_id):
+        """
+        user_id 是连续的，直接 % 100 的话新注册的用户会集中在一起，而且所有 gatekeeper 放量的都是同一批用户
+        用 gk_name 和 user_id 一起 hash，同一个用户在同一个 gatekeeper 里的 bucket 永远不变，
+        调大 percent 的时候已经放量的用户不会被移出去
+        """
+        digest = hashlib.md5('{}:{}'.format(gk_name, user_id).encode()).digest()
+        return int.from_bytes(digest[:8], 'big') % NUM_BUCKETS
+
     @classmethod
     def in_gk(cls, gk_name, user_id):
-        return user_id % 100 < cls.get(gk_name)['percent']
+        percent = cls.get(gk_name)['percent']
+        if percent >= NUM_BUCKETS:
+            return True
+        if percent <= 0:
+            return False
+        return cls.get_bucket(gk_name, user_id) < percent
@@ -1,5 +1,6 @@
 from testing.testcases import TestCase
-from gatekeeper.models import GateKeeper
+from gatekeeper.models import GateKeeper, VERSION_KEY
+from utils.redis_client import RedisClient
 
 
 class GateKeeperTests(TestCase):
@@ -15,8 +16,60 @@ class GateKeeperTests(TestCase):
 
         GateKeeper.set_kv('gk_name', 'percent', 20)
         self.assertEqual(GateKeeper.is_switch_on('gk_name'), False)
-        self.assertEqual(GateKeeper.in_gk('gk_name', 1), True)
+        self.assertEqual(
+            GateKeeper.in_gk('gk_name', 1),
+            GateKeeper.get_bucket('gk_name', 1) < 20,
+        )
 
         GateKeeper.set_kv('gk_name', 'percent', 100)
         self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
         self.assertEqual(GateKeeper.in_gk('gk_name', 1), True)
+
+    def test_local_cache(self):
+        conn = RedisClient.get_connection('gatekeeper')
+        GateKeeper.set_kv('gk_name', 'percent', 20)
+        with self.settings(GATEKEEPER_CACHE_TTL=60):
+            self.assertEqual(GateKeeper.get('gk_name')['percent'], 20)
+
+            # 其他进程修改了 gatekeeper，在 TTL 之内还是读到进程内 cache 的值
+            conn.hset('gatekeeper:gk_name', 'percent', 50)
+            conn.set(VERSION_KEY, 'another version')
+            self.assertEqual(GateKeeper.get('gk_name')['percent'], 20)
+
+            # TTL 过了之后发现 version 变了，重新读取
+            GateKeeper.cache.checked_at = 0
+            self.assertEqual(GateKeeper.get('gk_name')['percent'], 50)
+
+            # version 没有变化的时候继续使用 cache
+            conn.hset('gatekeeper:gk_name', 'percent', 70)
+            GateKeeper.cache.checked_at = 0
+            self.assertEqual(GateKeeper.get('gk_name')['percent'], 50)
+
+        # 同一个快照里读到的值不变
+        with GateKeeper.snapshot():
+            conn.hset('gatekeeper:gk_name', 'percent', 100)
+            conn.set(VERSION_KEY, 'the latest version')
+            self.assertEqual(GateKeeper.get('gk_name')['percent'], 50)
+            self.assertEqual(GateKeeper.is_switch_on('gk_name'), False)
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
+
+    def test_in_gk_stable_hashing(self):
+        user_ids = range(1, 2001)
+        GateKeeper.set_kv('gk_name', 'percent', 20)
+        in_gk_20 = {user_id for user_id in user_ids if GateKeeper.in_gk('gk_name', user_id)}
+        # 大约 20% 的用户，并且不是连续的 user_id
+        self.assertTrue(300 < len(in_gk_20) < 500)
+        self.assertNotEqual(in_gk_20, {user_id for user_id in user_ids if user_id % 100 < 20})
+
+        # 调大 percent 之后已经放量的用户还在里面
+        GateKeeper.set_kv('gk_name', 'percent', 50)
+        in_gk_50 = {user_id for user_id in user_ids if GateKeeper.in_gk('gk_name', user_id)}
+        self.assertTrue(in_gk_20 < in_gk_50)
+
+        # 不同的 gatekeeper 放量的是不同的用户
+        GateKeeper.set_kv('another_gk', 'percent', 20)
+        in_another_gk = {user_id for user_id in user_ids if GateKeeper.in_gk('another_gk', user_id)}
+        self.assertNotEqual(in_gk_20, in_another_gk)
+
+        GateKeeper.set_kv('gk_name', 'percent', 0)
+        self.assertEqual(any(GateKeeper.in_gk('gk_name', user_id) for user_id in user_ids), False)
@@ -1,3 +1,5 @@
+from gatekeeper.models import GateKeeper
+from utils.counter_helper import CounterHelper
 from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
 
@@ -14,6 +16,11 @@ def incr_likes_count(sender, instance, created, **kwargs):
         # TODO HOMEWORK 给 Comment 使用类似的方法进行 likes_count 的统计
         return
 
+    if GateKeeper.is_switch_on('switch_counter_write_behind'):
+        # 只在 redis 里记录增量，由 flush_tweet_counters_task 批量写回数据库
+        CounterHelper.incr(Tweet, instance.object_id, 'likes_count')
+        return
+
     Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
     # It's not necessary to invalidate cached tweet in memcached
     # because likes_count will come from the separately cached counts in redis.
@@ -35,6 +42,10 @@ def decr_likes_count(sender, instance, **kwargs):
         # TODO HOMEWORK 给 Comment 使用类似的方法进行 likes_count 的统计
         return
 
+    if GateKeeper.is_switch_on('switch_counter_write_behind'):
+        CounterHelper.decr(Tweet, instance.object_id, 'likes_count')
+        return
+
     # handle tweet likes cancel
     Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
     # It's not necessary to invalidate cached tweet in memcached
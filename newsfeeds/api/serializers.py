@@ -1,11 +1,22 @@
 from rest_framework import serializers
-from tweets.api.serializers import TweetSerializer
+from tweets.api.serializers import TweetSerializer, prefetch_counts
+
+
+class NewsFeedListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        newsfeeds = list(data)
+        prefetch_counts(self.context, [newsfeed.cached_tweet for newsfeed in newsfeeds])
+        return super(NewsFeedListSerializer, self).to_representation(newsfeeds)
 
 
 class NewsFeedSerializer(serializers.Serializer):
     tweet = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = NewsFeedListSerializer
+
     def update(self, instance, validated_data):
         pass
 
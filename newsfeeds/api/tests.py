@@ -4,6 +4,7 @@ from newsfeeds.models import NewsFeed, HBaseNewsFeed
 from newsfeeds.services import NewsFeedService
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from tweets.services import TweetService
 from utils.paginations import EndlessPagination
 
 
@@ -230,6 +231,34 @@ class NewsFeedApiTests(TestCase):
         self.clear_cache()
         _test_newsfeeds_after_new_feed_pushed()
 
+    def test_superstar_past_redis_list_limit(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        page_size = 20
+        user = self.create_user('user')
+        with self.settings(SUPERSTAR_FOLLOWERS_THRESHOLD=1, SUPERSTAR_DEMOTE_THRESHOLD=1):
+            self.create_friendship(self.linghu, self.dongxie)
+            self.dongxie.profile.refresh_from_db()
+            self.assertEqual(self.dongxie.profile.is_superstar, True)
+
+            # superstar 的 tweets 和普通的 newsfeeds 交替出现，两边都超过了 cache 的长度限制
+            tweet_ids = []
+            for i in range(list_limit + page_size):
+                tweet = self.create_tweet(self.dongxie, f'superstar tweet{i}')
+                tweet_ids.append(tweet.id)
+                tweet = self.create_tweet(user, f'feed{i}')
+                self.create_newsfeed(self.linghu, tweet)
+                tweet_ids.append(tweet.id)
+            tweet_ids = tweet_ids[::-1]
+            self.assertEqual(len(TweetService.get_cached_tweets(self.dongxie.id)), list_limit)
+
+            results = self._paginate_to_get_newsfeeds(self.linghu_client)
+            self.assertEqual([result['tweet']['id'] for result in results], tweet_ids)
+
+            # cache expired
+            self.clear_cache()
+            results = self._paginate_to_get_newsfeeds(self.linghu_client)
+            self.assertEqual([result['tweet']['id'] for result in results], tweet_ids)
+
 
 # class NewsFeedPushPlusPullApiTests(TestCase):
 #
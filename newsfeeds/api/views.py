@@ -1,12 +1,11 @@
 from django.utils.decorators import method_decorator
-from gatekeeper.models import GateKeeper
 from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
 from newsfeeds.services import NewsFeedService
 from ratelimit.decorators import ratelimit
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
-from utils.paginations import EndlessPagination
+from utils.paginations import EndlessPagination, parse_created_at
 
 
 class NewsFeedViewSet(viewsets.GenericViewSet):
@@ -18,16 +17,34 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user', rate='5/s', method='GET', block=True))
     def list(self, request):
-        normal_feeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        superstar_feeds = NewsFeedService.get_superstar_newsfeeds(request.user)
-        feeds = NewsFeedService.merge_feeds(normal_feeds, superstar_feeds)
-        page = self.paginator.paginate_cached_list(feeds, request)
+        created_at__gt, created_at__lt = None, None
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = parse_created_at(request.query_params['created_at__gt'])
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parse_created_at(request.query_params['created_at__lt'])
+        superstar_sources = NewsFeedService.get_superstar_feed_sources(
+            request.user,
+            created_at__gt=created_at__gt,
+            created_at__lt=created_at__lt,
+        )
+        if superstar_sources:
+            # 上翻页返回所有更新的数据，下翻页只需要多读一条来判断有没有下一页
+            # 每个 source 的 cache 读到头之后都会从数据库继续读取，合并的结果不会被 cache 的长度限制截断
+            limit = None if created_at__gt is not None else self.paginator.page_size + 1
+            normal_source = NewsFeedService.iter_newsfeeds(request.user.id, created_at__gt, created_at__lt)
+            feeds = NewsFeedService.merge_feeds(normal_source, *superstar_sources, limit=limit)
+            page = self.paginator.paginate_ordered_list(feeds, request)
+        else:
+            # 没有 superstar 的时候直接在 redis list 上分页，只需要读取一页的数据
+            normal_feeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
+            page = self.paginator.paginate_cached_list(normal_feeds, request)
         if page is None:
-            if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            if NewsFeedService.use_hbase(request.user.id):
                 page = self.paginator.paginate_hbase(HBaseNewsFeed, (request.user.id,), request)
             else:
                 queryset = NewsFeed.objects.filter(user=request.user)
                 page = self.paginate_queryset(queryset)
+        page = NewsFeedService.hydrate_newsfeeds(request.user.id, page)
 
         serializer = NewsFeedSerializer(
             page,
@@ -1,3 +1,14 @@
 from django.conf import settings
+from utils.time_constants import ONE_HOUR
 
 FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+# 同一条 tweet 同时在队列里的 batch task 最多有多少个，大 V 发 tweet 的时候不会把 newsfeeds 队列占满
+FANOUT_MAX_IN_FLIGHT = 10 if not settings.TESTING else 2
+# fan-out 超过这么久没有进展，认为 batch task 丢了，由 resume_stalled_fanouts_task 重新发出
+FANOUT_STALL_TIMEOUT = 10 * 60  # in seconds
+FANOUT_CHECKPOINT_EXPIRE_TIME = 24 * ONE_HOUR  # in seconds
+# 读取一页粉丝并记录 checkpoint 的锁，超时之后自动释放
+FANOUT_LOCK_TIMEOUT = 60  # in seconds
+FANOUT_MAX_RETRIES = 5
+# 合并 superstar 的 timeline 时，cache 读到头之后每次从数据库读取多少条
+TIMELINE_FALLBACK_BATCH_SIZE = 100 if not settings.TESTING else 3
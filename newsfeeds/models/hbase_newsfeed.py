@@ -18,6 +18,9 @@ class HBaseNewsFeed(models.HBaseModel):
 
     @property
     def cached_tweet(self):
+        # NewsFeedService.hydrate_newsfeeds 批量读取的 tweet
+        if getattr(self, 'prefetched_tweet', None) is not None:
+            return self.prefetched_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
     @property
@@ -25,6 +25,9 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
+        # NewsFeedService.hydrate_newsfeeds 批量读取的 tweet
+        if getattr(self, 'prefetched_tweet', None) is not None:
+            return self.prefetched_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
 
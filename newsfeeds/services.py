@@ -1,36 +1,142 @@
+from accounts.models import UserProfile
+from accounts.services import UserService
+from django.conf import settings
 from django.contrib.auth.models import User
 from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
+from newsfeeds.constants import (
+    FANOUT_BATCH_SIZE,
+    FANOUT_CHECKPOINT_EXPIRE_TIME,
+    FANOUT_LOCK_TIMEOUT,
+    FANOUT_MAX_IN_FLIGHT,
+    FANOUT_STALL_TIMEOUT,
+    TIMELINE_FALLBACK_BATCH_SIZE,
+)
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
 from newsfeeds.tasks import fanout_newsfeeds_main_task
 from tweets.models import Tweet
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from tweets.services import TweetService
+from twitter.cache import (
+    FANOUT_ACTIVE_KEY,
+    FANOUT_BATCHES_PATTERN,
+    FANOUT_CHECKPOINT_PATTERN,
+    SUPERSTAR_MIGRATION_PATTERN,
+    USER_NEWSFEEDS_PATTERNS,
+)
+from utils.memcached_helper import MemcachedHelper
+from utils.paginations import iter_with_fallback
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
-from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.redis_serializers import (
+    CompactModelSerializer,
+    DjangoModelSerializer,
+    HBaseModelSerializer,
+    IdOnlySerializer,
+    TimelineRef,
+)
+from utils.redis_stores import RedisListStore, RedisSortedSetStore
+from utils.shadow_helper import ShadowHelper
+from utils.time_constants import ONE_HOUR
+from utils.time_helpers import from_timestamp, to_timestamp
+
+import functools
+import heapq
+import json
+import time
+
+
+def load_newsfeeds(user_id, limit, use_hbase):
+    if use_hbase:
+        return HBaseNewsFeed.filter(prefix=(user_id,), limit=limit, reverse=True)
+    return NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')[:limit]
+
+
+def iter_older_newsfeeds(user_id, use_hbase, created_at__gt, created_at__lt):
+    # 按 -created_at 分批读取 created_at 在 (created_at__gt, created_at__lt) 之间的 newsfeeds
+    while True:
+        if use_hbase:
+            # reverse scan 的 start 包含在结果里，stop 不包含
+            start = (user_id, created_at__lt - 1)
+            stop = (user_id,) if created_at__gt is None else (user_id, created_at__gt)
+            newsfeeds = HBaseNewsFeed.filter(
+                start=start,
+                stop=stop,
+                limit=TIMELINE_FALLBACK_BATCH_SIZE,
+                reverse=True,
+            )
+        else:
+            queryset = NewsFeed.objects.filter(user_id=user_id, created_at__lt=created_at__lt)
+            if created_at__gt is not None:
+                queryset = queryset.filter(created_at__gt=created_at__gt)
+            newsfeeds = list(queryset.order_by('-created_at')[:TIMELINE_FALLBACK_BATCH_SIZE])
+        yield from newsfeeds
+        if len(newsfeeds) < TIMELINE_FALLBACK_BATCH_SIZE:
+            return
+        created_at__lt = newsfeeds[-1].created_at
+
+
+def iter_older_tweets(user_id, created_at__gt, created_at__lt):
+    # 和 iter_older_newsfeeds 一样，tweets 只存在 MySQL 里
+    while True:
+        queryset = Tweet.objects.filter(user_id=user_id, created_at__lt=created_at__lt)
+        if created_at__gt is not None:
+            queryset = queryset.filter(created_at__gt=created_at__gt)
+        tweets = list(queryset.only('id', 'created_at').order_by('-created_at')[:TIMELINE_FALLBACK_BATCH_SIZE])
+        yield from tweets
+        if len(tweets) < TIMELINE_FALLBACK_BATCH_SIZE:
+            return
+        created_at__lt = tweets[-1].created_at
+
+
+def normalize_newsfeeds(newsfeeds):
+    # MySQL 和 HBase 的 created_at 类型不同，统一成时间戳再比较
+    return [
+        (newsfeed.tweet_id, NewsFeedService.get_created_at(newsfeed.created_at, use_hbase=True))
+        for newsfeed in newsfeeds
+    ]
 
 
 def lazy_load_newsfeeds(user_id):
     def _lazy_load(limit):
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            return HBaseNewsFeed.filter(prefix=(user_id,), limit=limit, reverse=True)
-        return NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')[:limit]
+        use_hbase = NewsFeedService.use_hbase(user_id)
+        if not GateKeeper.in_gk('shadow_newsfeed_reads', user_id):
+            return load_newsfeeds(user_id, limit, use_hbase)
+        return ShadowHelper.compare_reads(
+            'newsfeed_load',
+            lambda: list(load_newsfeeds(user_id, limit, use_hbase)),
+            lambda: list(load_newsfeeds(user_id, limit, not use_hbase)),
+            normalize=normalize_newsfeeds,
+        )
     return _lazy_load
 
 
 class NewsFeedService:
+    """
+    switch_newsfeed_to_hbase 按照用户放量，每个用户的 newsfeeds 只在一个 backend 上读写
+    打开 switch_newsfeed_dual_write 之后同时写入另一个 backend，方便随时调整 percent 或者回滚
+    shadow_newsfeed_reads 放量的用户从数据库 load newsfeeds 的时候会同时读取另一个 backend，比较结果和延迟
+    """
+
+    @classmethod
+    def use_hbase(cls, user_id):
+        return GateKeeper.in_gk('switch_newsfeed_to_hbase', user_id)
+
+    @classmethod
+    def get_created_at(cls, created_at, use_hbase):
+        """
+        HBase 的 created_at 是微秒时间戳，MySQL 的是 datetime，转换成 {use_hbase} 对应的类型
+        """
+        if use_hbase:
+            return created_at if isinstance(created_at, int) else to_timestamp(created_at)
+        return from_timestamp(created_at) if isinstance(created_at, int) else created_at
 
     @classmethod
     def fanout_to_followers(cls, tweet):
         if tweet.user.profile.is_superstar:
             return
 
-        # print(f'type(tweet.created_at): {type(tweet.created_at)}')  # <class 'datetime.datetime'>
-        # print(f'tweet.created_at: {tweet.created_at}')  # 2021-07-23 16:18:10.208012+00:00
-
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            fanout_newsfeeds_main_task.delay(tweet.id, tweet.timestamp, tweet.user_id)
-        else:
-            fanout_newsfeeds_main_task.delay(tweet.id, tweet.created_at, tweet.user_id)
+        # followers 可能在不同的 backend 上，统一传时间戳，写入的时候再按照每个 follower 的 backend 转换
+        fanout_newsfeeds_main_task.delay(tweet.id, tweet.timestamp, tweet.user_id)
 
     @classmethod
     def inject_newsfeeds(cls, user_id, followed_user_id):
@@ -45,8 +151,7 @@ class NewsFeedService:
         NewsFeed.objects.bulk_create(newsfeeds)
 
         # invalidate redis cache
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        RedisHelper.invalidate_cache(key)
+        cls.invalidate_newsfeeds_cache(user_id)
 
     @classmethod
     def remove_newsfeeds(cls, user_id, followed_user_id):
@@ -67,89 +172,598 @@ class NewsFeedService:
         ).delete()
 
         # invalidate redis cache
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        RedisHelper.invalidate_cache(key)
+        cls.invalidate_newsfeeds_cache(user_id)
+
+    @classmethod
+    def iter_superstar_newsfeeds(cls, user_id, superstar_id, created_at__gt=None, created_at__lt=None):
+        """
+        把 superstar 的 tweets cache 按顺序转换成 {user_id} 的 newsfeeds，只读取用到的部分
+        superstar 的 tweets cache 被所有粉丝共享，基本上总是 cache hit
+        cache 里只有最新的 REDIS_LIST_LENGTH_LIMIT 条 tweets，读完之后从数据库继续读取更早的 tweets
+        created_at 会转换成 {user_id} 的 newsfeed 所在的 backend 的类型，方便和普通的 newsfeeds 合并
+        """
+        use_hbase = cls.use_hbase(user_id)
+        newsfeed_class = HBaseNewsFeed if use_hbase else NewsFeed
+        # tweets cache 里的 created_at 是 datetime
+        if created_at__gt is not None:
+            created_at__gt = cls.get_created_at(created_at__gt, use_hbase=False)
+        if created_at__lt is not None:
+            created_at__lt = cls.get_created_at(created_at__lt, use_hbase=False)
+        tweets = iter_with_fallback(
+            TweetService.get_cached_tweets(superstar_id),
+            functools.partial(iter_older_tweets, superstar_id),
+            created_at__gt,
+            created_at__lt,
+        )
+        for tweet in tweets:
+            created_at = cls.get_created_at(tweet.created_at, use_hbase)
+            if isinstance(tweet, TimelineRef):
+                yield TimelineRef(tweet.object_id, created_at)
+            else:
+                yield newsfeed_class(user_id=user_id, tweet_id=tweet.id, created_at=created_at)
 
     @classmethod
-    def get_superstar_newsfeeds(cls, user):
+    def iter_newsfeeds(cls, user_id, created_at__gt=None, created_at__lt=None):
         """
-        Returns newsfeeds of tweets posted by the superstars followed by {user}.
+        按 -created_at 顺序返回 {user_id} 的 newsfeeds，先读 cache，cache 读到头之后从数据库或者 HBase 继续读取
+        和 iter_superstar_newsfeeds 一起做 k-way merge，所有 source 都不会因为 cache 的长度限制被截断
         """
-        # superstars: a list of User objects
-        superstars = FriendshipService.get_followed_superstars(user)
+        use_hbase = cls.use_hbase(user_id)
+        if created_at__gt is not None:
+            created_at__gt = cls.get_created_at(created_at__gt, use_hbase)
+        if created_at__lt is not None:
+            created_at__lt = cls.get_created_at(created_at__lt, use_hbase)
+        return iter_with_fallback(
+            cls.get_cached_newsfeeds(user_id),
+            functools.partial(iter_older_newsfeeds, user_id, use_hbase),
+            created_at__gt,
+            created_at__lt,
+        )
+
+    @classmethod
+    def get_superstar_feed_sources(cls, user, created_at__gt=None, created_at__lt=None):
+        """
+        Returns one iterator of newsfeeds per superstar followed by {user}, each ordered by -created_at.
+        """
+        superstar_ids = FriendshipService.get_followed_superstar_ids(user.id)
         if user.profile.is_superstar:
-            superstars.append(user)
-        superstar_ids = [superstar.id for superstar in superstars]
-        superstars_tweets = Tweet.objects.filter(
-            user_id__in=superstar_ids
-        ).order_by('-created_at')
-        newsfeeds = [
-            NewsFeed(tweet=tweet, user=user, created_at=tweet.created_at)
-            for tweet in superstars_tweets
+            superstar_ids.add(user.id)
+        return [
+            cls.iter_superstar_newsfeeds(user.id, superstar_id, created_at__gt, created_at__lt)
+            for superstar_id in sorted(superstar_ids)
         ]
-        return newsfeeds
 
     @classmethod
-    def merge_feeds(cls, normal_feeds, superstar_feeds):
+    def get_superstar_newsfeeds(cls, user, created_at__gt=None, created_at__lt=None, limit=None):
+        """
+        Returns newsfeeds of tweets posted by the superstars followed by {user},
+        with created_at in (created_at__gt, created_at__lt), at most {limit} newest ones.
+        """
+        sources = cls.get_superstar_feed_sources(user, created_at__gt, created_at__lt)
+        return cls.merge_feeds(*sources, limit=limit)
+
+    @classmethod
+    def get_tweet_id(cls, newsfeed):
+        if isinstance(newsfeed, TimelineRef):
+            return newsfeed.object_id
+        return newsfeed.tweet_id
+
+    @classmethod
+    def merge_feeds(cls, *feed_sources, limit=None):
         """
-        normal_feeds: a queryset of NewsFeed objects ordered by -created_at
-        superstar_feeds: a list of NewsFeed objects ordered by -created_at
-        return: a list of NewsFeed objects
+        feed_sources: iterables of newsfeeds, each ordered by -created_at,
+            e.g. the cached newsfeeds and one iterator per followed superstar
+        return: a list of at most {limit} newsfeeds ordered by -created_at
+        用 heapq.merge 做 k-way merge，每个 source 只被读取到需要的位置，
+        得到 limit 个之后就停止，一页的代价是 O(page * log k)，和 superstar 发过多少 tweet 无关
+        superstar 迁移的过程中同一条 tweet 可能同时出现在多个 source 里，只保留一条
         """
         feeds = []
-        i, j = 0, 0
-        while i < len(normal_feeds) and j < len(superstar_feeds):
-            if normal_feeds[i].created_at >= superstar_feeds[j].created_at:
-                feeds.append(normal_feeds[i])
-                i += 1
+        tweet_ids = set()
+        merged_feeds = heapq.merge(*feed_sources, key=lambda feed: feed.created_at, reverse=True)
+        for feed in merged_feeds:
+            if limit is not None and len(feeds) >= limit:
+                break
+            tweet_id = cls.get_tweet_id(feed)
+            if tweet_id in tweet_ids:
+                continue
+            tweet_ids.add(tweet_id)
+            feeds.append(feed)
+        return feeds
+
+    @classmethod
+    def get_backends(cls, user_id):
+        """
+        Returns the values of use_hbase whose backends hold the newsfeeds of {user_id}.
+        """
+        use_hbase = cls.use_hbase(user_id)
+        if GateKeeper.is_switch_on('switch_newsfeed_dual_write'):
+            return [use_hbase, not use_hbase]
+        return [use_hbase]
+
+    @classmethod
+    def update_superstar(cls, user_id):
+        """
+        根据准确的粉丝数切换 {user_id} 的 superstar 状态，并且迁移粉丝的 newsfeeds
+        同一个用户同时只有一个迁移在执行，拿不到锁直接返回，之后粉丝数变化的时候会再次触发
+        Returns True if the status changed.
+        """
+        conn = RedisClient.get_connection()
+        lock = RedisHelper.try_lock(
+            conn,
+            SUPERSTAR_MIGRATION_PATTERN.format(user_id=user_id),
+            timeout=ONE_HOUR,
+        )
+        if lock is None:
+            return False
+        try:
+            followers_count = FriendshipService.get_follower_count(user_id)
+            # 顺便修正 cache 里的粉丝数
+            FriendshipService.set_cached_follower_count(user_id, followers_count)
+            profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
+            is_superstar = UserService.should_be_superstar(profile.is_superstar, followers_count)
+            if is_superstar == profile.is_superstar:
+                return False
+            if is_superstar:
+                cls.promote_superstar(profile)
             else:
-                feeds.append(superstar_feeds[j])
-                j += 1
+                cls.demote_superstar(profile)
+            return True
+        finally:
+            RedisHelper.release_lock(lock)
 
-        while i < len(normal_feeds):
-            feeds.append(normal_feeds[i])
-            i += 1
+    @classmethod
+    def promote_superstar(cls, profile):
+        """
+        先切换状态，之后的 tweet 不再 fan-out，再删除粉丝 newsfeeds 里已经 fan-out 的 tweet
+        删除完成之前同一条 tweet 会同时出现在 push 和 pull 两边，由 merge_feeds 去重
+        只删除最近的 SUPERSTAR_BACKFILL_LIMIT 条，和 demote 回填的范围一样，更旧的留给 merge_feeds 去重
+        """
+        profile.is_superstar = True
+        profile.save()
 
-        while j < len(superstar_feeds):
-            feeds.append(superstar_feeds[j])
-            j += 1
+        tweets = cls.get_recent_tweets(profile.user_id)
+        for follower_ids in FriendshipService.iter_follower_id_batches(profile.user_id, FANOUT_BATCH_SIZE):
+            for follower_id in follower_ids:
+                FriendshipService.update_followed_superstar_ids(follower_id, profile.user_id, is_following=True)
+                for use_hbase in cls.get_backends(follower_id):
+                    cls.remove_tweets_from_newsfeeds(follower_id, tweets, use_hbase)
+                cls.invalidate_newsfeeds_cache(follower_id)
 
-        return feeds
+    @classmethod
+    def remove_tweets_from_newsfeeds(cls, user_id, tweets, use_hbase):
+        for start in range(0, len(tweets), FANOUT_BATCH_SIZE):
+            batch_tweets = tweets[start: start + FANOUT_BATCH_SIZE]
+            if not use_hbase:
+                NewsFeed.objects.filter(
+                    user_id=user_id,
+                    tweet_id__in=[tweet.id for tweet in batch_tweets],
+                ).delete()
+                continue
+
+            # fan-out 的时候 newsfeed 的 created_at 就是 tweet 的 timestamp，可以直接拼出 row key
+            # 先读一下 tweet_id，确认是这条 tweet 再删除
+            keys = [{'user_id': user_id, 'created_at': tweet.timestamp} for tweet in batch_tweets]
+            newsfeeds = HBaseNewsFeed.get_many(keys, columns=['tweet_id'])
+            HBaseNewsFeed.batch_delete([
+                key
+                for key, newsfeed, tweet in zip(keys, newsfeeds, batch_tweets)
+                if newsfeed is not None and newsfeed.tweet_id == tweet.id
+            ])
 
     @classmethod
-    def get_cached_newsfeeds(cls, user_id):
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            serializer = HBaseModelSerializer
+    def demote_superstar(cls, profile):
+        """
+        先回填最近的 tweets，再切换状态，最后回填两次之间发的 tweets
+        回填之前 pull 的一边还在，粉丝不会有看不到的 tweet，回填是幂等的，重复写入没有关系
+        """
+        tweets = cls.get_recent_tweets(profile.user_id)
+        cls.backfill_newsfeeds(profile.user_id, tweets)
+
+        profile.is_superstar = False
+        profile.save()
+        for follower_ids in FriendshipService.iter_follower_id_batches(profile.user_id, FANOUT_BATCH_SIZE):
+            for follower_id in follower_ids:
+                FriendshipService.update_followed_superstar_ids(follower_id, profile.user_id, is_following=False)
+
+        new_tweets = cls.get_recent_tweets(
+            profile.user_id,
+            created_at__gt=tweets[0].created_at if tweets else None,
+        )
+        cls.backfill_newsfeeds(profile.user_id, new_tweets)
+
+    @classmethod
+    def get_recent_tweets(cls, user_id, created_at__gt=None):
+        # 最多 SUPERSTAR_BACKFILL_LIMIT 条，从新到旧
+        tweets = Tweet.objects.filter(user_id=user_id)
+        if created_at__gt is not None:
+            tweets = tweets.filter(created_at__gt=created_at__gt)
+        return list(tweets.only('id', 'created_at').order_by('-created_at')[:settings.SUPERSTAR_BACKFILL_LIMIT])
+
+    @classmethod
+    def backfill_newsfeeds(cls, user_id, tweets):
+        if not tweets:
+            return
+        for follower_ids in FriendshipService.iter_follower_id_batches(user_id, FANOUT_BATCH_SIZE):
+            # tweets 也要分批，每次 batch_create 最多 FANOUT_BATCH_SIZE 个 newsfeeds
+            tweets_per_batch = max(1, FANOUT_BATCH_SIZE // len(follower_ids))
+            for start in range(0, len(tweets), tweets_per_batch):
+                batch_params = [
+                    {'user_id': follower_id, 'tweet_id': tweet.id, 'created_at': tweet.timestamp}
+                    for follower_id in follower_ids
+                    for tweet in tweets[start: start + tweets_per_batch]
+                ]
+                # 旧的 tweet push 到 cache 的最前面会打乱顺序，直接让 cache 失效
+                cls.batch_create(batch_params, push_to_cache=False, ignore_conflicts=True)
+            for follower_id in follower_ids:
+                cls.invalidate_newsfeeds_cache(follower_id)
+
+    @classmethod
+    def get_cache_layout(cls, user_id):
+        """
+        Returns (key, store, serializer) of the newsfeeds timeline of {user_id}.
+        """
+        use_zset = GateKeeper.is_switch_on('switch_timeline_to_zset')
+        use_hbase = cls.use_hbase(user_id)
+        store = RedisSortedSetStore if use_zset else RedisListStore
+        if GateKeeper.is_switch_on('switch_timeline_to_id_only'):
+            cache_format = 'id_only'
+            serializer = IdOnlySerializer(id_field='tweet_id', created_at_as_timestamp=use_hbase)
+        elif use_hbase:
+            # CompactModelSerializer 只支持 Django model
+            cache_format, serializer = 'full', HBaseModelSerializer
+        elif GateKeeper.is_switch_on('switch_timeline_to_compact'):
+            cache_format, serializer = 'compact', CompactModelSerializer.for_model(NewsFeed)
         else:
-            serializer = DjangoModelSerializer
-        return RedisHelper.load_objects(key, lazy_load_newsfeeds(user_id), serializer=serializer)
+            cache_format, serializer = 'full', DjangoModelSerializer
+        pattern = USER_NEWSFEEDS_PATTERNS[(cache_format, use_zset, 'hbase' if use_hbase else 'db')]
+        return pattern.format(user_id=user_id), store, serializer
+
+    @classmethod
+    def invalidate_newsfeeds_cache(cls, user_id):
+        # 所有版本的 cache 都删掉，避免切换 gatekeeper 之后读到过期的数据
+        RedisHelper.invalidate_cache(
+            *[pattern.format(user_id=user_id) for pattern in USER_NEWSFEEDS_PATTERNS.values()],
+            shard_key=user_id,
+        )
+
+    @classmethod
+    def get_cached_newsfeeds(cls, user_id):
+        """
+        Returns a list-like of newsfeeds, or of TimelineRef in id-only mode.
+        Use hydrate_newsfeeds on the paginated result to get newsfeed objects.
+        """
+        key, store, serializer = cls.get_cache_layout(user_id)
+        return RedisHelper.load_objects(
+            key,
+            lazy_load_newsfeeds(user_id),
+            serializer=serializer,
+            store=store,
+            shard_key=user_id,
+        )
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, lazy_load_newsfeeds(newsfeed.user_id))
+        key, store, serializer = cls.get_cache_layout(newsfeed.user_id)
+        RedisHelper.push_object(
+            key,
+            newsfeed,
+            lazy_load_newsfeeds(newsfeed.user_id),
+            store=store,
+            serializer=serializer,
+            shard_key=newsfeed.user_id,
+        )
+        # 和 TweetService.push_tweet_to_cache 一样，其他 layout 的 key 会缺少这条 newsfeed，直接删掉
+        RedisHelper.invalidate_cache(
+            *[
+                pattern.format(user_id=newsfeed.user_id)
+                for pattern in USER_NEWSFEEDS_PATTERNS.values()
+                if pattern.format(user_id=newsfeed.user_id) != key
+            ],
+            shard_key=newsfeed.user_id,
+        )
 
     @classmethod
-    def create(cls, **kwargs):
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+    def hydrate_newsfeeds(cls, user_id, newsfeeds):
+        """
+        把一页里的 TimelineRef 换成 newsfeed，newsfeed 本身不需要读取存储，
+        整页的 tweet 用一次 memcached get_many 读取并放到 newsfeed 上，已经被删除的 tweet 会被跳过
+        """
+        if cls.use_hbase(user_id):
+            newsfeed_class = HBaseNewsFeed
+        else:
+            newsfeed_class = NewsFeed
+        newsfeeds = [
+            newsfeed_class(user_id=user_id, tweet_id=newsfeed.object_id, created_at=newsfeed.created_at)
+            if isinstance(newsfeed, TimelineRef) else newsfeed
+            for newsfeed in newsfeeds
+        ]
+        tweet_map = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        hydrated_newsfeeds = []
+        for newsfeed in newsfeeds:
+            if newsfeed.tweet_id not in tweet_map:
+                continue
+            newsfeed.prefetched_tweet = tweet_map[newsfeed.tweet_id]
+            hydrated_newsfeeds.append(newsfeed)
+        return hydrated_newsfeeds
+
+    @classmethod
+    def _create(cls, use_hbase, **kwargs):
+        kwargs['created_at'] = cls.get_created_at(kwargs['created_at'], use_hbase)
+        if use_hbase:
             newsfeed = HBaseNewsFeed.create(**kwargs)
             # 需要手动触发 cache 更改，因为没有 listener 监听 hbase create
             cls.push_newsfeed_to_cache(newsfeed)
         else:
-            # if not isinstance(kwargs['created_at'], datetime):
-            #     kwargs['created_at'] = datetime.fromtimestamp(int(kwargs['created_at']) / 10 ** 6, tz=pytz.utc)
             newsfeed = NewsFeed.objects.create(**kwargs)
         return newsfeed
 
     @classmethod
-    def batch_create(cls, batch_params):
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            newsfeeds = HBaseNewsFeed.batch_create(batch_params)
+    def _batch_create(cls, batch_params, use_hbase, ignore_conflicts=False):
+        """
+        只写入 {use_hbase} 对应的 backend，不 push 到 cache
+        HBase 里同样的 row key 会被覆盖，本身就是幂等的
+        """
+        if not batch_params:
+            return []
+        batch_params = [
+            dict(params, created_at=cls.get_created_at(params['created_at'], use_hbase))
+            for params in batch_params
+        ]
+        if use_hbase:
+            return HBaseNewsFeed.batch_create(batch_params)
+        newsfeeds = [NewsFeed(**params) for params in batch_params]
+        NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=ignore_conflicts)
+        return newsfeeds
+
+    @classmethod
+    def create(cls, **kwargs):
+        use_hbase = cls.use_hbase(kwargs['user_id'])
+        if not GateKeeper.is_switch_on('switch_newsfeed_dual_write'):
+            return cls._create(use_hbase, **kwargs)
+        # 另一个 backend 用 bulk create 写入，不会触发 post_save 把它 push 到用户的 cache 里
+        return ShadowHelper.dual_write(
+            'newsfeed_create',
+            lambda: cls._create(use_hbase, **kwargs),
+            lambda: cls._batch_create([kwargs], not use_hbase),
+        )
+
+    @classmethod
+    def batch_create(cls, batch_params, push_to_cache=True, ignore_conflicts=False):
+        # 按照每个 follower 所在的 backend 分开写入
+        hbase_params, mysql_params = [], []
+        for params in batch_params:
+            if cls.use_hbase(params['user_id']):
+                hbase_params.append(params)
+            else:
+                mysql_params.append(params)
+
+        def create_newsfeeds():
+            return (
+                cls._batch_create(hbase_params, True, ignore_conflicts)
+                + cls._batch_create(mysql_params, False, ignore_conflicts)
+            )
+
+        if not GateKeeper.is_switch_on('switch_newsfeed_dual_write'):
+            newsfeeds = create_newsfeeds()
         else:
-            newsfeeds = [NewsFeed(**params) for params in batch_params]
-            NewsFeed.objects.bulk_create(newsfeeds)
+            newsfeeds = ShadowHelper.dual_write(
+                'newsfeed_batch_create',
+                create_newsfeeds,
+                lambda: (
+                    cls._batch_create(hbase_params, False, ignore_conflicts)
+                    + cls._batch_create(mysql_params, True, ignore_conflicts)
+                ),
+            )
+        if not push_to_cache:
+            return newsfeeds
         # bulk create does not trigger post_save signal, so push newsfeeds to cache manually
         for newsfeed in newsfeeds:
             cls.push_newsfeed_to_cache(newsfeed)
         return newsfeeds
+
+
+class FanoutService:
+    """
+    一条 tweet 的 fan-out 是一条可以中断和恢复的流水线
+     - 用 cursor 一页一页地读取粉丝，每页 FANOUT_BATCH_SIZE 个，不需要把所有粉丝 load 到内存里
+     - 同一条 tweet 最多有 FANOUT_MAX_IN_FLIGHT 个 batch 在执行，一个 batch 完成之后才读取下一页，
+       大 V 发 tweet 的时候不会一下子在 newsfeeds 队列里放几千个 task，其他 tweet 的 fan-out 可以穿插执行
+     - cursor 和读取了但是还没有写完的 batches 都记录在 redis 里，worker 重启之后可以继续
+     - 写入 newsfeeds 是幂等的，batch task 被重复执行不会产生重复的 newsfeeds
+    """
+
+    @classmethod
+    def get_keys(cls, tweet_id):
+        return (
+            FANOUT_CHECKPOINT_PATTERN.format(tweet_id=tweet_id),
+            FANOUT_BATCHES_PATTERN.format(tweet_id=tweet_id),
+        )
+
+    @classmethod
+    def start(cls, tweet_id, created_at, tweet_user_id):
+        """
+        创建 checkpoint，已经存在的话（例如 main task 被重试）保留原来的进度
+        created_at: 微秒时间戳
+        """
+        conn = RedisClient.get_connection()
+        key, _ = cls.get_keys(tweet_id)
+        checkpoint = {
+            'tweet_user_id': tweet_user_id,
+            'created_at': created_at,
+            # 中途切换 backend 的话 cursor 就不能用了，一直使用开始时的 backend
+            'use_hbase': int(FriendshipService.use_hbase(tweet_user_id)),
+            'cursor': json.dumps(None),
+            'finished': 0,
+            'next_batch': 0,
+            'followers': 0,
+            'updated_at': time.time(),
+        }
+        pipe = conn.pipeline(transaction=True)
+        for field, value in checkpoint.items():
+            pipe.hsetnx(key, field, value)
+        pipe.expire(key, FANOUT_CHECKPOINT_EXPIRE_TIME)
+        pipe.sadd(FANOUT_ACTIVE_KEY, tweet_id)
+        pipe.execute()
+
+    @classmethod
+    def get_checkpoint(cls, conn, tweet_id):
+        """
+        Returns (checkpoint, in_flight), or None if the fan-out is not running.
+        in_flight 是已经读取但是还没有写完的 batch 的个数
+        """
+        key, batches_key = cls.get_keys(tweet_id)
+        pipe = conn.pipeline(transaction=True)
+        pipe.hgetall(key)
+        pipe.hlen(batches_key)
+        checkpoint, in_flight = pipe.execute()
+        if not checkpoint:
+            return None
+        checkpoint = {field.decode(): value.decode() for field, value in checkpoint.items()}
+        return checkpoint, in_flight
+
+    @classmethod
+    def claim_batch(cls, conn, tweet_id, checkpoint):
+        """
+        读取下一页粉丝，记录成一个还没有完成的 batch，同时移动 cursor
+        Returns (batch_index, follower_ids).
+        """
+        key, batches_key = cls.get_keys(tweet_id)
+        follower_ids, next_cursor = FriendshipService.get_follower_ids_page(
+            int(checkpoint['tweet_user_id']),
+            checkpoint['use_hbase'] == '1',
+            cursor=json.loads(checkpoint['cursor']),
+            limit=FANOUT_BATCH_SIZE,
+        )
+        batch_index = int(checkpoint['next_batch'])
+        pipe = conn.pipeline(transaction=True)
+        if follower_ids:
+            pipe.hset(batches_key, batch_index, json.dumps(follower_ids))
+            pipe.expire(batches_key, FANOUT_CHECKPOINT_EXPIRE_TIME)
+        pipe.hset(key, mapping={
+            'cursor': json.dumps(next_cursor),
+            'finished': int(next_cursor is None),
+            'next_batch': batch_index + 1 if follower_ids else batch_index,
+            'followers': int(checkpoint['followers']) + len(follower_ids),
+            'updated_at': time.time(),
+        })
+        pipe.execute()
+        return batch_index, follower_ids
+
+    @classmethod
+    def get_batch(cls, tweet_id, batch_index):
+        """
+        Returns (follower_ids, created_at) of the batch, or None if it is already done.
+        """
+        conn = RedisClient.get_connection()
+        key, batches_key = cls.get_keys(tweet_id)
+        pipe = conn.pipeline(transaction=True)
+        pipe.hget(batches_key, batch_index)
+        pipe.hget(key, 'created_at')
+        follower_ids, created_at = pipe.execute()
+        if follower_ids is None or created_at is None:
+            return None
+        return json.loads(follower_ids), int(created_at)
+
+    @classmethod
+    def finish_batch(cls, tweet_id, batch_index):
+        conn = RedisClient.get_connection()
+        key, batches_key = cls.get_keys(tweet_id)
+        pipe = conn.pipeline(transaction=True)
+        pipe.hdel(batches_key, batch_index)
+        pipe.hset(key, 'updated_at', time.time())
+        pipe.execute()
+
+    @classmethod
+    def needs_advance(cls, conn, tweet_id):
+        state = cls.get_checkpoint(conn, tweet_id)
+        if state is None:
+            return False
+        checkpoint, in_flight = state
+        if checkpoint['finished'] == '1':
+            return in_flight == 0
+        return in_flight < FANOUT_MAX_IN_FLIGHT
+
+    @classmethod
+    def advance(cls, tweet_id):
+        """
+        读取粉丝并发出 batch task，直到 in-flight 的 batch 达到上限或者所有粉丝都读完了
+        每个 batch 完成之后都会调用一次，空出来的位置马上被下一页填上
+        所有粉丝都读完并且所有 batch 都完成之后删除 checkpoint
+        Returns (follower_count, batch_count) of the batches sent by this call.
+        """
+        # import placed inside to avoid circular dependency
+        from newsfeeds.tasks import fanout_newsfeeds_batch_task
+
+        conn = RedisClient.get_connection()
+        key, batches_key = cls.get_keys(tweet_id)
+        follower_count, batch_count = 0, 0
+        while True:
+            lock = RedisHelper.try_lock(conn, key, timeout=FANOUT_LOCK_TIMEOUT)
+            if lock is None:
+                # 其他 worker 正在读取，它释放锁之后会再检查一次
+                break
+            try:
+                while True:
+                    state = cls.get_checkpoint(conn, tweet_id)
+                    if state is None:
+                        break
+                    checkpoint, in_flight = state
+                    if checkpoint['finished'] == '1':
+                        if in_flight == 0:
+                            cls.complete(conn, tweet_id)
+                        break
+                    if in_flight >= FANOUT_MAX_IN_FLIGHT:
+                        break
+                    batch_index, follower_ids = cls.claim_batch(conn, tweet_id, checkpoint)
+                    if follower_ids:
+                        fanout_newsfeeds_batch_task.delay(tweet_id, batch_index)
+                        follower_count += len(follower_ids)
+                        batch_count += 1
+            finally:
+                RedisHelper.release_lock(lock)
+            # 持有锁的时候完成的 batch 调用 advance 会拿不到锁，这里再检查一次，避免流水线停下来
+            if not cls.needs_advance(conn, tweet_id):
+                break
+        return follower_count, batch_count
+
+    @classmethod
+    def complete(cls, conn, tweet_id):
+        pipe = conn.pipeline(transaction=True)
+        pipe.delete(*cls.get_keys(tweet_id))
+        pipe.srem(FANOUT_ACTIVE_KEY, tweet_id)
+        pipe.execute()
+
+    @classmethod
+    def resume_stalled(cls):
+        """
+        超过 FANOUT_STALL_TIMEOUT 没有进展的 fan-out，重新发出所有还没有完成的 batches 并继续读取
+        原来的 batch task 如果还在执行，重复写入也没有关系
+        Returns the number of resumed fan-outs.
+        """
+        # import placed inside to avoid circular dependency
+        from newsfeeds.tasks import fanout_newsfeeds_batch_task
+
+        conn = RedisClient.get_connection()
+        resumed_count = 0
+        for tweet_id in conn.smembers(FANOUT_ACTIVE_KEY):
+            tweet_id = int(tweet_id)
+            state = cls.get_checkpoint(conn, tweet_id)
+            if state is None:
+                # checkpoint 过期了
+                conn.srem(FANOUT_ACTIVE_KEY, tweet_id)
+                continue
+            checkpoint, _ = state
+            if time.time() - float(checkpoint['updated_at']) < FANOUT_STALL_TIMEOUT:
+                continue
+
+            key, batches_key = cls.get_keys(tweet_id)
+            conn.hset(key, 'updated_at', time.time())
+            for batch_index in conn.hkeys(batches_key):
+                fanout_newsfeeds_batch_task.delay(tweet_id, int(batch_index))
+            cls.advance(tweet_id)
+            resumed_count += 1
+        return resumed_count
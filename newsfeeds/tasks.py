@@ -1,66 +1,78 @@
 from celery import shared_task
 from dateutil import parser
-from friendships.services import FriendshipService
-from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.constants import FANOUT_MAX_RETRIES
 from utils.time_constants import ONE_HOUR
+from utils.time_helpers import to_timestamp
 
 
-@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
+# acks_late: worker 在执行过程中挂掉的话，task 会被重新投递，batch 的写入是幂等的
+@shared_task(
+    routing_key='newsfeeds',
+    time_limit=ONE_HOUR,
+    acks_late=True,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=FANOUT_MAX_RETRIES,
+)
+def fanout_newsfeeds_batch_task(tweet_id, batch_index):
     # import placed inside to avoid circular dependency
-    from newsfeeds.services import NewsFeedService
+    from newsfeeds.services import FanoutService, NewsFeedService
 
-    # if not GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-    #     created_at = datetime.fromtimestamp(created_at / 10 ** 6, tz=pytz.utc)
-    try:
-        created_at = parser.isoparse(created_at)
-    except TypeError:
-        pass
+    batch = FanoutService.get_batch(tweet_id, batch_index)
+    if batch is None:
+        return 'Batch {} of tweet {} is already done.'.format(batch_index, tweet_id)
 
+    follower_ids, created_at = batch
     batch_params = [
         {'user_id': follower_id, 'created_at': created_at, 'tweet_id': tweet_id}
         for follower_id in follower_ids
     ]
-    newsfeeds = NewsFeedService.batch_create(batch_params)
+    newsfeeds = NewsFeedService.batch_create(batch_params, ignore_conflicts=True)
+    FanoutService.finish_batch(tweet_id, batch_index)
+    # 空出了一个位置，继续读取下一页粉丝
+    FanoutService.advance(tweet_id)
     return "{} newsfeeds created.".format(len(newsfeeds))
 
 
-@shared_task(routing_key='default', time_limit=ONE_HOUR)
+@shared_task(routing_key='default', time_limit=ONE_HOUR, acks_late=True)
 def fanout_newsfeeds_main_task(tweet_id, created_at, tweet_user_id):
-    # print('type(created_at): ', type(created_at)) # type(created_at) is int
-    # print(f'type(created_at): {type(created_at)}') # type(created_at) is str
-    # print(f'created_at: {created_at}') # created_at is 2021-07-23T15:32:06.657243Z
-    # from newsfeeds.models import NewsFeed
-    # NewsFeed.objects.create(tweet_id=tweet_id, user_id=tweet_user_id, created_at=created_at) # created_at can be str
-
     # import placed inside to avoid circular dependency
-    from newsfeeds.services import NewsFeedService
+    from newsfeeds.services import FanoutService, NewsFeedService
 
-    # if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-    #     created_at_param = created_at
-    # else:
-    #     created_at_param = datetime.fromtimestamp(created_at / 10 ** 6, tz=pytz.utc)
     try:
         created_at = parser.isoparse(created_at)
     except TypeError:
         pass
+    created_at = to_timestamp(created_at)
 
-    # 将推给自己的 Newsfeed 率先创建，确保自己能最快看到
-    NewsFeedService.create(
-        user_id=tweet_user_id,
-        tweet_id=tweet_id,
-        created_at=created_at,
+    # 将推给自己的 Newsfeed 率先创建，确保自己能最快看到，task 被重试的时候不会重复创建
+    NewsFeedService.batch_create(
+        [{'user_id': tweet_user_id, 'tweet_id': tweet_id, 'created_at': created_at}],
+        ignore_conflicts=True,
     )
 
-    # 获得所有的 follower ids，按照 batch size 拆分开
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, created_at, batch_ids)
-        index += FANOUT_BATCH_SIZE
-
+    # 只发出第一批 batches，之后每个 batch 完成的时候再读取下一页粉丝
+    FanoutService.start(tweet_id, created_at, tweet_user_id)
+    follower_count, batch_count = FanoutService.advance(tweet_id)
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+        follower_count,
+        batch_count,
     )
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def resume_stalled_fanouts_task():
+    # import placed inside to avoid circular dependency
+    from newsfeeds.services import FanoutService
+
+    resumed_count = FanoutService.resume_stalled()
+    return '{} stalled fanouts resumed.'.format(resumed_count)
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def update_superstar_task(user_id):
+    # import placed inside to avoid circular dependency
+    from newsfeeds.services import NewsFeedService
+
+    changed = NewsFeedService.update_superstar(user_id)
+    return 'Superstar status of user {} {}.'.format(user_id, 'changed' if changed else 'unchanged')
@@ -1,10 +1,14 @@
+from accounts.models import UserProfile
+from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
-from newsfeeds.services import NewsFeedService
+from newsfeeds.services import FanoutService, NewsFeedService, lazy_load_newsfeeds
 from newsfeeds.tasks import fanout_newsfeeds_main_task
 from testing.testcases import TestCase
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from twitter.cache import FANOUT_ACTIVE_KEY
+from utils.metrics_helper import MetricsHelper
 from utils.redis_client import RedisClient
+from utils.redis_serializers import TimelineRef
 
 
 class NewsFeedServiceTests(TestCase):
@@ -41,7 +45,7 @@ class NewsFeedServiceTests(TestCase):
         self.clear_cache()
         conn = RedisClient.get_connection()
 
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.linghu.id)
+        key, _, _ = NewsFeedService.get_cache_layout(self.linghu.id)
         self.assertEqual(conn.exists(key), False)
         # load to redis
         feed2 = self.create_newsfeed(self.linghu, self.create_tweet(self.linghu))
@@ -51,6 +55,168 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
         self.assertEqual([f.created_at for f in feeds], [feed2.created_at, feed1.created_at])
 
+    def test_id_only_newsfeeds(self):
+        GateKeeper.turn_on('switch_timeline_to_id_only')
+        tweets = [self.create_tweet(self.dongxie, 'tweet{}'.format(i)) for i in range(3)]
+        newsfeeds = [self.create_newsfeed(self.linghu, tweet) for tweet in tweets][::-1]
+
+        # timeline 里只有 tweet_id 和 created_at
+        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([f.object_id for f in cached_newsfeeds], [f.tweet_id for f in newsfeeds])
+        self.assertEqual([f.created_at for f in cached_newsfeeds], [f.created_at for f in newsfeeds])
+
+        # hydrate 之后拿到 newsfeed 和最新的 tweet
+        tweets[0].content = 'updated'
+        tweets[0].save()
+        hydrated_newsfeeds = NewsFeedService.hydrate_newsfeeds(self.linghu.id, list(cached_newsfeeds))
+        self.assertEqual([f.tweet_id for f in hydrated_newsfeeds], [f.tweet_id for f in newsfeeds])
+        self.assertEqual(hydrated_newsfeeds[-1].cached_tweet.content, 'updated')
+
+        # 被删除的 tweet 会被跳过
+        tweets[1].delete()
+        hydrated_newsfeeds = NewsFeedService.hydrate_newsfeeds(self.linghu.id, list(cached_newsfeeds))
+        self.assertEqual([f.tweet_id for f in hydrated_newsfeeds], [tweets[2].id, tweets[0].id])
+
+    def test_per_user_rollout(self):
+        GateKeeper.set_kv('switch_newsfeed_to_hbase', 'percent', 50)
+        users = [self.create_user('user{}'.format(i)) for i in range(10)]
+        hbase_users = [user for user in users if NewsFeedService.use_hbase(user.id)]
+        mysql_users = [user for user in users if not NewsFeedService.use_hbase(user.id)]
+        tweet = self.create_tweet(self.linghu)
+        NewsFeedService.batch_create([
+            {'user_id': user.id, 'tweet_id': tweet.id, 'created_at': tweet.timestamp}
+            for user in users
+        ])
+        # 每个用户的 newsfeed 只写到自己所在的 backend
+        for user in hbase_users:
+            self.assertEqual(len(HBaseNewsFeed.filter(prefix=(user.id,))), 1)
+            self.assertEqual(NewsFeed.objects.filter(user_id=user.id).count(), 0)
+        for user in mysql_users:
+            self.assertEqual(len(HBaseNewsFeed.filter(prefix=(user.id,))), 0)
+            self.assertEqual(NewsFeed.objects.filter(user_id=user.id).count(), 1)
+        for user in users:
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(user.id)
+            self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweet.id])
+
+        # dual write 之后两个 backend 的数据一致，shadow read 不会有 mismatch
+        GateKeeper.turn_on('switch_newsfeed_dual_write')
+        GateKeeper.turn_on('shadow_newsfeed_reads')
+        user = users[0]
+        tweet = self.create_tweet(self.linghu)
+        NewsFeedService.create(user_id=user.id, tweet_id=tweet.id, created_at=tweet.timestamp)
+        self.assertEqual(len(HBaseNewsFeed.filter(prefix=(user.id,))), 2 if user in hbase_users else 1)
+        self.assertEqual(NewsFeed.objects.filter(user_id=user.id).count(), 1 if user in hbase_users else 2)
+
+        another_user = self.create_user('another_user')
+        NewsFeedService.create(user_id=another_user.id, tweet_id=tweet.id, created_at=tweet.timestamp)
+        newsfeeds = lazy_load_newsfeeds(another_user.id)(10)
+        self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweet.id])
+        metrics = MetricsHelper.get('shadow:newsfeed_load')
+        self.assertEqual(metrics['calls'], 1)
+        self.assertEqual(metrics['mismatches'], 0)
+
+    def test_switch_user_backend(self):
+        GateKeeper.turn_on('switch_newsfeed_dual_write')
+        tweets = [self.create_tweet(self.dongxie, 'tweet{}'.format(i)) for i in range(2)]
+        for tweet in tweets:
+            self.create_newsfeed(self.linghu, tweet)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([type(f) for f in newsfeeds], [HBaseNewsFeed, HBaseNewsFeed])
+
+        # 用户被切换到 MySQL 之后不会用 DjangoModelSerializer 去读 HBase 的 cache
+        GateKeeper.set_kv('switch_newsfeed_to_hbase', 'percent', 0)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([type(f) for f in newsfeeds], [NewsFeed, NewsFeed])
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweets[1].id, tweets[0].id])
+
+        # 切换回来之后读到的还是 HBase 的 newsfeeds
+        GateKeeper.turn_on('switch_newsfeed_to_hbase')
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([type(f) for f in newsfeeds], [HBaseNewsFeed, HBaseNewsFeed])
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweets[1].id, tweets[0].id])
+
+    def test_switch_cache_layout_back(self):
+        tweet1 = self.create_tweet(self.dongxie, 'tweet1')
+        self.create_newsfeed(self.linghu, tweet1)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet1.id])
+        key, _, _ = NewsFeedService.get_cache_layout(self.linghu.id)
+
+        # 切换到 sorted set 的时候 push 的 newsfeed 不会写到旧的 key 里，旧的 key 会被删掉
+        GateKeeper.turn_on('switch_timeline_to_zset')
+        tweet2 = self.create_tweet(self.dongxie, 'tweet2')
+        self.create_newsfeed(self.linghu, tweet2)
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.exists(key), False)
+
+        # 切换回来之后不会读到缺少 tweet2 的旧数据
+        GateKeeper.set_kv('switch_timeline_to_zset', 'percent', 0)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet2.id, tweet1.id])
+
+    def test_merge_feeds(self):
+        consumed = []
+
+        def source(*created_ats):
+            for created_at in created_ats:
+                consumed.append(created_at)
+                yield TimelineRef(created_at, created_at)
+
+        feeds = NewsFeedService.merge_feeds(
+            source(10, 7, 4, 1),
+            source(9, 6, 3),
+            # 同一条 tweet 在两个 source 里出现，只保留一条
+            source(8, 7, 2),
+            limit=4,
+        )
+        self.assertEqual([feed.object_id for feed in feeds], [10, 9, 8, 7])
+        # 每个 source 只读取到需要的位置
+        self.assertEqual(sorted(consumed), [4, 6, 7, 7, 8, 9, 10])
+
+        feeds = NewsFeedService.merge_feeds([], source(3, 2), source(1))
+        self.assertEqual([feed.object_id for feed in feeds], [3, 2, 1])
+
+    def test_superstar_migration(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(3)]
+        with self.settings(SUPERSTAR_FOLLOWERS_THRESHOLD=3, SUPERSTAR_DEMOTE_THRESHOLD=2):
+            for follower in followers[:2]:
+                self.create_friendship(follower, self.dongxie)
+            tweets = [self.create_tweet(self.dongxie, 'tweet{}'.format(i)) for i in range(2)]
+            for tweet in tweets:
+                NewsFeedService.fanout_to_followers(tweet)
+            self.assertEqual(len(HBaseNewsFeed.filter(prefix=(followers[0].id,))), 2)
+
+            # 粉丝数达到阈值，自动变成 superstar，已经 fan-out 的 newsfeeds 被删除
+            self.create_friendship(followers[2], self.dongxie)
+            self.assertEqual(UserProfile.objects.get(user=self.dongxie).is_superstar, True)
+            self.assertEqual(len(HBaseNewsFeed.filter(prefix=(followers[0].id,))), 0)
+
+            # 粉丝读取的时候 pull，只读取一页的范围
+            newsfeeds = NewsFeedService.get_superstar_newsfeeds(followers[0], limit=1)
+            self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweets[1].id])
+            newsfeeds = NewsFeedService.get_superstar_newsfeeds(
+                followers[0],
+                created_at__lt=tweets[1].timestamp,
+            )
+            self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweets[0].id])
+            newsfeeds = NewsFeedService.merge_feeds(
+                NewsFeedService.get_cached_newsfeeds(followers[0].id),
+                NewsFeedService.get_superstar_newsfeeds(followers[0]),
+            )
+            self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweets[1].id, tweets[0].id])
+
+            # 在两个阈值之间的时候保持不变
+            FriendshipService.unfollow(followers[2].id, self.dongxie.id)
+            self.assertEqual(UserProfile.objects.get(user=self.dongxie).is_superstar, True)
+
+            # 粉丝数降到 SUPERSTAR_DEMOTE_THRESHOLD 以下，回填 newsfeeds
+            FriendshipService.unfollow(followers[1].id, self.dongxie.id)
+            self.assertEqual(UserProfile.objects.get(user=self.dongxie).is_superstar, False)
+            newsfeeds = HBaseNewsFeed.filter(prefix=(followers[0].id,), reverse=True)
+            self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweets[1].id, tweets[0].id])
+            self.assertEqual(len(HBaseNewsFeed.filter(prefix=(followers[1].id,))), 0)
+            self.assertEqual(NewsFeedService.get_superstar_newsfeeds(followers[0]), [])
+
 
 class NewsFeedTaskTests(TestCase):
 
@@ -101,3 +267,43 @@ class NewsFeedTaskTests(TestCase):
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
         self.assertEqual(len(cached_list), 3)
+
+    def test_resume_fanout(self):
+        def count_newsfeeds():
+            return NewsFeed.objects.count() + len(HBaseNewsFeed.filter())
+
+        for i in range(7):
+            user = self.create_user(f'user{i}')
+            self.create_friendship(user, self.linghu)
+        tweet = self.create_tweet(self.linghu, 'tweet 1')
+
+        # 两个 batch 被读取之后 worker 挂掉了，in-flight 的 batch 已经达到上限，不会继续读取
+        conn = RedisClient.get_connection()
+        FanoutService.start(tweet.id, tweet.timestamp, self.linghu.id)
+        for _ in range(2):
+            checkpoint, _ = FanoutService.get_checkpoint(conn, tweet.id)
+            FanoutService.claim_batch(conn, tweet.id, checkpoint)
+        self.assertEqual(FanoutService.advance(tweet.id), (0, 0))
+        self.assertEqual(count_newsfeeds(), 0)
+
+        # 还没有超时
+        self.assertEqual(FanoutService.resume_stalled(), 0)
+        checkpoint, in_flight = FanoutService.get_checkpoint(conn, tweet.id)
+        self.assertEqual(in_flight, 2)
+        self.assertEqual(checkpoint['followers'], '6')
+
+        # 超时之后重新发出没有完成的 batches，并且继续读取剩下的粉丝
+        key, _ = FanoutService.get_keys(tweet.id)
+        conn.hset(key, 'updated_at', 0)
+        self.assertEqual(FanoutService.resume_stalled(), 1)
+        self.assertEqual(count_newsfeeds(), 7)
+        self.assertIsNone(FanoutService.get_checkpoint(conn, tweet.id))
+        self.assertEqual(conn.scard(FANOUT_ACTIVE_KEY), 0)
+        self.assertIsNone(FanoutService.get_batch(tweet.id, 0))
+
+        # main task 被重试不会产生重复的 newsfeeds
+        for _ in range(2):
+            msg = fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.linghu.id)
+            self.assertEqual(msg, '7 newsfeeds going to fanout, 3 batches created.')
+            self.assertEqual(count_newsfeeds(), 7 + 1)
+        self.assertEqual(conn.scard(FANOUT_ACTIVE_KEY), 0)
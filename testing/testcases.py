@@ -61,7 +61,7 @@ class TestCase(DjangoTestCase):
         return Tweet.objects.create(user=user, content=content)
 
     def create_newsfeed(self, user, tweet):
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+        if NewsFeedService.use_hbase(user.id):
             created_at = tweet.timestamp
         else:
             created_at = tweet.created_at
@@ -9,6 +9,27 @@ from tweets.models import Tweet
 from tweets.services import TweetService
 from utils.redis_helper import RedisHelper
 
+COUNT_ATTRS = ('likes_count', 'comments_count')
+
+
+def prefetch_counts(context, tweets):
+    """
+    一页的 tweets 和它们 retweet 的 tweets 的 counts 用一次 RedisHelper.get_counts 读取，
+    放在 context 里给 BaseTweetSerializer 使用
+    """
+    tweets = [tweet for tweet in tweets if tweet is not None]
+    tweets += [tweet.retweet_from for tweet in tweets if tweet.retweet_from_id is not None]
+    counts = context.setdefault('prefetched_counts', {})
+    counts.update(RedisHelper.get_counts(tweets, COUNT_ATTRS))
+
+
+class TweetListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        tweets = list(data)
+        prefetch_counts(self.context, tweets)
+        return super(TweetListSerializer, self).to_representation(tweets)
+
 
 class BaseTweetSerializer(serializers.ModelSerializer):
     user = UserSerializerForTweet(source='cached_user')
@@ -19,6 +40,7 @@ class BaseTweetSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Tweet
+        list_serializer_class = TweetListSerializer
         fields = (
             'id',
             'user',
@@ -30,11 +52,17 @@ class BaseTweetSerializer(serializers.ModelSerializer):
             'photo_urls',
         )
 
+    def get_count(self, obj, attr):
+        counts = self.context.get('prefetched_counts', {}).get(obj.id, {})
+        if attr in counts:
+            return counts[attr]
+        return RedisHelper.get_count(obj, attr)
+
     def get_likes_count(self, obj):
-        return RedisHelper.get_count(obj, 'likes_count')
+        return self.get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self.get_count(obj, 'comments_count')
 
     def get_has_liked(self, obj):
         return LikeService.has_liked(self.context['request'].user, obj)
@@ -55,6 +83,7 @@ class TweetSerializer(BaseTweetSerializer):
 
     class Meta:
         model = Tweet
+        list_serializer_class = TweetListSerializer
         fields = (
             'id',
             'user',
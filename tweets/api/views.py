@@ -42,6 +42,7 @@ class TweetViewSet(viewsets.GenericViewSet):
         if page is None:
             queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
             page = self.paginate_queryset(queryset)
+        page = TweetService.hydrate_tweets(page)
         serializer = TweetSerializer(
             page,
             many=True,
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.models import NewsFeed
+from tweets.models import Tweet
+from utils.redis_serializers import CompactModelSerializer, DjangoModelSerializer
+from utils.time_helpers import utc_now
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compare DjangoModelSerializer and CompactModelSerializer on redis cached lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        size, repeat = options['size'], options['repeat']
+        created_at = utc_now()
+        tweets = [
+            Tweet(id=i, user_id=1, content='tweet content {}'.format(i), created_at=created_at)
+            for i in range(1, size + 1)
+        ]
+        newsfeeds = [
+            NewsFeed(id=i, user_id=1, tweet_id=i, created_at=created_at)
+            for i in range(1, size + 1)
+        ]
+        for model_class, objects in [(Tweet, tweets), (NewsFeed, newsfeeds)]:
+            for serializer in [DjangoModelSerializer, CompactModelSerializer.for_model(model_class)]:
+                self.benchmark(model_class, objects, serializer, repeat)
+
+    def benchmark(self, model_class, objects, serializer, repeat):
+        # 每一轮都是整个 list 的 serialize + deserialize，取最快的一轮
+        serialize_time, deserialize_time = float('inf'), float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            serialized_list = [serializer.serialize(obj) for obj in objects]
+            serialize_time = min(serialize_time, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for serialized_data in serialized_list:
+                serializer.deserialize(serialized_data)
+            deserialize_time = min(deserialize_time, time.perf_counter() - start)
+
+        total_bytes = sum(len(serialized_data) for serialized_data in serialized_list)
+        serializer_name = getattr(serializer, '__name__', serializer.__class__.__name__)
+        self.stdout.write('{} x {} with {}: serialize {:.1f}ms, deserialize {:.1f}ms, {} bytes'.format(
+            model_class.__name__,
+            len(objects),
+            serializer_name,
+            serialize_time * 1000,
+            deserialize_time * 1000,
+            total_bytes,
+        ))
@@ -0,0 +1,98 @@
+from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from likes.models import Like
+from tweets.models import Tweet
+from utils.counter_helper import CounterHelper, FLUSH_LOCK_TIMEOUT
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+
+class Command(BaseCommand):
+    help = 'Recompute likes_count and comments_count of tweets from the likes and comments tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only print the tweets to fix')
+
+    def handle(self, *args, **options):
+        batch_size, dry_run = options['batch_size'], options['dry_run']
+        # 先把 write-behind 计数器累积的增量写回数据库
+        if not dry_run:
+            CounterHelper.flush(Tweet)
+
+        # 整个过程都持有 flush 的锁，读取数据库里的 counts 和读取增量之间、以及写入修正的值之前不会有 flush 写回增量
+        # 只会推迟 flush，读取 count 的 cache 不受影响
+        lock = CounterHelper.lock_flush(Tweet, blocking_timeout=FLUSH_LOCK_TIMEOUT)
+        if lock is None:
+            raise CommandError('Timed out waiting for the counter flush to finish')
+        try:
+            fixed_count = self.reconcile(lock, batch_size, dry_run)
+        finally:
+            RedisHelper.release_lock(lock)
+        self.stdout.write('{} tweets {}.'.format(fixed_count, 'to fix' if dry_run else 'fixed'))
+
+    def reconcile(self, lock, batch_size, dry_run):
+        fixed_count, last_id = 0, 0
+        while True:
+            # 每个 batch 重新计算锁的过期时间，运行时间很长的时候锁也不会自动释放
+            lock.reacquire()
+            tweets = list(
+                Tweet.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values('id', 'likes_count', 'comments_count')[:batch_size]
+            )
+            if not tweets:
+                break
+            last_id = tweets[-1]['id']
+            for tweet_id, updates in self.get_updates(tweets).items():
+                fixed_count += 1
+                self.stdout.write('tweet {}: {}'.format(tweet_id, updates))
+                if dry_run:
+                    continue
+                Tweet.objects.filter(id=tweet_id).update(**updates)
+                # 删掉 count 的 cache，并且取消正在进行的 load，下次读取的时候重新 load
+                count_keys = [RedisHelper.get_count_key(Tweet.__name__, tweet_id, attr) for attr in updates]
+                RedisClient.get_connection('counters').delete(
+                    *count_keys,
+                    *[CounterHelper.get_fill_key(count_key) for count_key in count_keys],
+                )
+        return fixed_count
+
+    def get_updates(self, tweets):
+        """
+        Returns {tweet_id: {attr: correct value}} of the tweets whose counts are wrong.
+        """
+        tweet_ids = [tweet['id'] for tweet in tweets]
+        likes_counts = dict(
+            Like.objects.filter(
+                content_type=ContentType.objects.get_for_model(Tweet),
+                object_id__in=tweet_ids,
+            ).order_by().values('object_id').annotate(count=Count('id')).values_list('object_id', 'count')
+        )
+        comments_counts = dict(
+            Comment.objects.filter(tweet_id__in=tweet_ids)
+            .order_by().values('tweet_id').annotate(count=Count('id')).values_list('tweet_id', 'count')
+        )
+        attrs = ('likes_count', 'comments_count')
+        # 还没有写回数据库的增量，数据库里的值加上它才等于实际的数量
+        pending_deltas = CounterHelper.get_pending_deltas(
+            Tweet.__name__,
+            [(tweet_id, attr) for tweet_id in tweet_ids for attr in attrs],
+        )
+
+        updates = {}
+        for tweet in tweets:
+            actual_counts = {
+                'likes_count': likes_counts.get(tweet['id'], 0),
+                'comments_count': comments_counts.get(tweet['id'], 0),
+            }
+            tweet_updates = {}
+            for attr in attrs:
+                expected = actual_counts[attr] - pending_deltas[(tweet['id'], attr)]
+                if tweet[attr] != expected:
+                    tweet_updates[attr] = expected
+            if tweet_updates:
+                updates[tweet['id']] = tweet_updates
+        return updates
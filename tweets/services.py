@@ -1,7 +1,16 @@
+from gatekeeper.models import GateKeeper
 from tweets.models import Tweet
 from tweets.models import TweetPhoto
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import USER_TWEETS_PATTERNS
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
+from utils.redis_serializers import (
+    CompactModelSerializer,
+    DjangoModelSerializer,
+    IdOnlySerializer,
+    TimelineRef,
+)
+from utils.redis_stores import RedisListStore, RedisSortedSetStore
 
 
 def lazy_load_tweets(user_id):
@@ -25,15 +34,73 @@ class TweetService:
             photos.append(photo)
         TweetPhoto.objects.bulk_create(photos)
 
+    @classmethod
+    def get_cache_layout(cls, user_id):
+        """
+        Returns (key, store, serializer) of the tweets timeline of {user_id}.
+        """
+        use_zset = GateKeeper.is_switch_on('switch_timeline_to_zset')
+        store = RedisSortedSetStore if use_zset else RedisListStore
+        if GateKeeper.is_switch_on('switch_timeline_to_id_only'):
+            cache_format, serializer = 'id_only', IdOnlySerializer()
+        elif GateKeeper.is_switch_on('switch_timeline_to_compact'):
+            cache_format, serializer = 'compact', CompactModelSerializer.for_model(Tweet)
+        else:
+            cache_format, serializer = 'full', DjangoModelSerializer
+        pattern = USER_TWEETS_PATTERNS[(cache_format, use_zset)]
+        return pattern.format(user_id=user_id), store, serializer
+
     @classmethod
     def get_cached_tweets(cls, user_id):
         """
-        Returns a list of Tweet objects.
+        Returns a list-like of Tweet objects, or of TimelineRef in id-only mode.
+        On cache hit it is a CachedList which reads from redis only the part being accessed.
+        Use hydrate_tweets on the paginated result to get Tweet objects.
         """
-        key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, lazy_load_tweets(user_id))
+        key, store, serializer = cls.get_cache_layout(user_id)
+        return RedisHelper.load_objects(
+            key,
+            lazy_load_tweets(user_id),
+            serializer=serializer,
+            store=store,
+            shard_key=user_id,
+        )
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
-        key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, lazy_load_tweets(tweet.user_id))
+        key, store, serializer = cls.get_cache_layout(tweet.user_id)
+        RedisHelper.push_object(
+            key,
+            tweet,
+            lazy_load_tweets(tweet.user_id),
+            store=store,
+            serializer=serializer,
+            shard_key=tweet.user_id,
+        )
+        # 其他 layout 的 key 不会被 push，切换 gatekeeper 再切回来的时候会缺少这期间发的 tweets，直接删掉
+        RedisHelper.invalidate_cache(
+            *[
+                pattern.format(user_id=tweet.user_id)
+                for pattern in USER_TWEETS_PATTERNS.values()
+                if pattern.format(user_id=tweet.user_id) != key
+            ],
+            shard_key=tweet.user_id,
+        )
+
+    @classmethod
+    def hydrate_tweets(cls, tweets):
+        """
+        把一页里的 TimelineRef 换成 Tweet，所有 tweet 用一次 memcached get_many 读取
+        已经是 Tweet 的直接保留，已经被删除的 tweet 会被跳过
+        """
+        tweet_ids = [tweet.object_id for tweet in tweets if isinstance(tweet, TimelineRef)]
+        if not tweet_ids:
+            return list(tweets)
+        tweet_map = MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+        hydrated_tweets = []
+        for tweet in tweets:
+            if isinstance(tweet, TimelineRef):
+                tweet = tweet_map.get(tweet.object_id)
+            if tweet is not None:
+                hydrated_tweets.append(tweet)
+        return hydrated_tweets
@@ -0,0 +1,12 @@
+from celery import shared_task
+from utils.counter_helper import CounterHelper
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_tweet_counters_task():
+    # import placed inside to avoid circular dependency
+    from tweets.models import Tweet
+
+    flushed_count = CounterHelper.flush(Tweet)
+    return "{} tweets' counters flushed.".format(flushed_count)
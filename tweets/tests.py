@@ -1,11 +1,23 @@
 from datetime import timedelta
+from django.core.management import call_command
+from gatekeeper.models import GateKeeper
+from io import StringIO
+from likes.models import Like
 from testing.testcases import TestCase
 from tweets.constants import TweetPhotoStatus
-from tweets.models import TweetPhoto
+from tweets.models import Tweet, TweetPhoto
 from tweets.services import TweetService
-from twitter.cache import USER_TWEETS_PATTERN
+from tweets.tasks import flush_tweet_counters_task
+from twitter.cache import (
+    USER_TWEETS_PATTERN,
+    USER_TWEETS_ZSET_PATTERN,
+    USER_TWEET_IDS_PATTERN,
+    USER_TWEETS_COMPACT_PATTERN,
+)
+from utils.counter_helper import CounterHelper
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+from utils.redis_helper import RedisHelper
+from utils.redis_serializers import DjangoModelSerializer, TimelineRef
 from utils.time_helpers import utc_now
 
 
@@ -98,3 +110,161 @@ class TweetServiceTests(TestCase):
 
         tweets = TweetService.get_cached_tweets(self.linghu.id)
         self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+
+    def test_cached_tweets_in_sorted_set(self):
+        tweet1 = self.create_tweet(self.linghu, 'tweet1')
+
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        GateKeeper.turn_on('switch_timeline_to_zset')
+
+        key = USER_TWEETS_ZSET_PATTERN.format(user_id=self.linghu.id)
+        self.assertEqual(conn.exists(key), False)
+        tweet2 = self.create_tweet(self.linghu, 'tweet2')
+        self.assertEqual(conn.type(key), b'zset')
+        # list 版本的 key 不会被写入
+        self.assertEqual(conn.exists(USER_TWEETS_PATTERN.format(user_id=self.linghu.id)), False)
+
+        tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id, self.tweet.id])
+
+        # 重复 push 同一条 tweet 不会产生重复数据
+        TweetService.push_tweet_to_cache(tweet2)
+        tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id, self.tweet.id])
+        self.assertEqual(
+            [t.id for t in tweets.range_by_created_at(created_at__lt=tweet2.created_at)],
+            [tweet1.id, self.tweet.id],
+        )
+
+    def test_cached_tweets_id_only(self):
+        GateKeeper.turn_on('switch_timeline_to_id_only')
+        tweet1 = self.create_tweet(self.linghu, 'tweet1')
+        tweet2 = self.create_tweet(self.linghu, 'tweet2')
+
+        conn = RedisClient.get_connection()
+        key = USER_TWEET_IDS_PATTERN.format(user_id=self.linghu.id)
+        tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual(conn.exists(key), True)
+        self.assertEqual(
+            list(tweets),
+            [TimelineRef(t.id, t.created_at) for t in [tweet2, tweet1, self.tweet]],
+        )
+        # 每一项只有几十个字节，而不是整个 tweet 的 json
+        for serialized_data in conn.lrange(key, 0, -1):
+            self.assertEqual(len(serialized_data) < 40, True)
+
+        tweet1.content = 'updated'
+        tweet1.save()
+        tweets = TweetService.hydrate_tweets(list(tweets))
+        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id, self.tweet.id])
+        self.assertEqual(tweets[1].content, 'updated')
+
+        # api 返回的是完整的 tweet
+        response = self.anonymous_client.get('/api/tweets/', {'user_id': self.linghu.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [t['id'] for t in response.data['results']],
+            [tweet2.id, tweet1.id, self.tweet.id],
+        )
+        self.assertEqual(response.data['results'][1]['content'], 'updated')
+
+    def test_cached_tweets_compact(self):
+        GateKeeper.turn_on('switch_timeline_to_compact')
+        tweet1 = self.create_tweet(self.linghu, 'tweet1')
+        tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual([t.id for t in tweets], [tweet1.id, self.tweet.id])
+
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_COMPACT_PATTERN.format(user_id=self.linghu.id)
+        self.assertEqual(conn.llen(key), 2)
+
+        tweet2 = self.create_tweet(self.linghu, 'tweet2')
+        tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id, self.tweet.id])
+        self.assertEqual([t.content for t in tweets], ['tweet2', 'tweet1', self.tweet.content])
+        self.assertEqual(tweets[0].created_at, tweet2.created_at)
+
+    def test_switch_cache_layout_back(self):
+        tweet1 = self.create_tweet(self.linghu, 'tweet1')
+        tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual([t.id for t in tweets], [tweet1.id, self.tweet.id])
+
+        # 切换到 compact 的时候发的 tweet 只 push 到 compact 的 key 里，旧的 key 会被删掉
+        GateKeeper.turn_on('switch_timeline_to_compact')
+        tweet2 = self.create_tweet(self.linghu, 'tweet2')
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.exists(USER_TWEETS_PATTERN.format(user_id=self.linghu.id)), False)
+
+        # 切换回来之后不会读到缺少 tweet2 的旧数据
+        GateKeeper.set_kv('switch_timeline_to_compact', 'percent', 0)
+        tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id, self.tweet.id])
+
+    def test_write_behind_counters(self):
+        GateKeeper.turn_on('switch_counter_write_behind')
+        conn = RedisClient.get_connection()
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        for user in users:
+            self.create_like(user, self.tweet)
+        self.create_comment(users[0], self.tweet)
+
+        # 数据库还没有更新，读取 count 的时候会加上还没有写回的增量
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 3)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'comments_count'), 1)
+        # count 的 cache 存在的时候同步更新
+        self.create_like(self.linghu, self.tweet)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 4)
+
+        flush_tweet_counters_task.delay()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 4)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(conn.exists(CounterHelper.get_deltas_key(Tweet)), False)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 4)
+
+        # 上一次 flush 中途失败留下的增量会在下一次 flush 的时候写回
+        Like.objects.filter(user=self.linghu).delete()
+        conn.rename(CounterHelper.get_deltas_key(Tweet), CounterHelper.get_flushing_key(Tweet))
+        self.create_comment(users[1], self.tweet)
+        self.assertEqual(CounterHelper.flush(Tweet), 1)
+        self.assertEqual(CounterHelper.flush(Tweet), 1)
+        self.assertEqual(CounterHelper.flush(Tweet), 0)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 3)
+        self.assertEqual(self.tweet.comments_count, 2)
+
+        # reconcile 用 likes 和 comments 表修复错误的 counts
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=100)
+        call_command('reconcile_tweet_counts', stdout=StringIO())
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 3)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 3)
+
+        # load count 的 cache 不需要 flush 的锁，reconcile 持有锁的时候也可以写入 cache
+        counts_conn = RedisClient.get_connection('counters')
+        key = RedisHelper.get_count_key(Tweet.__name__, self.tweet.id, 'likes_count')
+        counts_conn.delete(key)
+        lock = CounterHelper.lock_flush(Tweet)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 3)
+        self.assertEqual(counts_conn.exists(key), True)
+        RedisHelper.release_lock(lock)
+
+        # load 期间 count 被修改过，load 的结果不写入 cache
+        counts_conn.delete(key)
+        fill_state = CounterHelper.start_fill(Tweet.__name__, [key])
+        CounterHelper.incr(Tweet, self.tweet.id, 'likes_count')
+        self.assertEqual(CounterHelper.finish_fill(fill_state, {key: 3}), 0)
+        self.assertEqual(counts_conn.exists(key), False)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 4)
+
+        # load 期间有 flush 写回增量，load 的结果不写入 cache
+        counts_conn.delete(key)
+        fill_state = CounterHelper.start_fill(Tweet.__name__, [key])
+        self.assertEqual(CounterHelper.flush(Tweet), 1)
+        self.assertEqual(CounterHelper.finish_fill(fill_state, {key: 5}), 0)
+        self.assertEqual(counts_conn.exists(key), False)
+        self.assertEqual(RedisHelper.get_counts([self.tweet], ['likes_count'])[self.tweet.id]['likes_count'], 4)
+        self.assertEqual(counts_conn.exists(key), True)
@@ -3,5 +3,58 @@ FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
 
 # redis
+FOLLOWERS_COUNT_PATTERN = 'followers_count:{user_id}'
+SUPERSTAR_MIGRATION_PATTERN = 'superstar_migration:{user_id}'
+# 用户关注的 superstar 的 id，set 里总有一个 0，用来区分空集合和 cache miss
+FOLLOWED_SUPERSTARS_PATTERN = 'followed_superstars:{user_id}'
+# 每次修改 followed superstars 的时候加一，重建 cache 的时候用来判断期间有没有被修改过
+FOLLOWED_SUPERSTARS_VERSION_PATTERN = 'followed_superstars_version:{user_id}'
+# fan-out 的进度：cursor，是否读完了所有粉丝等等
+FANOUT_CHECKPOINT_PATTERN = 'fanout:{tweet_id}'
+# 已经读取但是还没有写完的 batches，{batch index: follower ids}
+FANOUT_BATCHES_PATTERN = 'fanout_batches:{tweet_id}'
+# 正在进行中的 fan-out 的 tweet ids
+FANOUT_ACTIVE_KEY = 'fanouts:active'
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
 USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# sorted set 版本的 timeline，和 list 版本使用不同的 key，避免切换时出现 WRONGTYPE 错误
+USER_TWEETS_ZSET_PATTERN = 'user_tweets_zset:{user_id}'
+USER_NEWSFEEDS_ZSET_PATTERN = 'user_newsfeeds_zset:{user_id}'
+# ID-only 的 timeline，只存 id 和 created_at，数据格式不同因此也使用不同的 key
+USER_TWEET_IDS_PATTERN = 'user_tweet_ids:{user_id}'
+USER_TWEET_IDS_ZSET_PATTERN = 'user_tweet_ids_zset:{user_id}'
+USER_NEWSFEED_IDS_PATTERN = 'user_newsfeed_ids:{user_id}'
+USER_NEWSFEED_IDS_ZSET_PATTERN = 'user_newsfeed_ids_zset:{user_id}'
+# 使用 CompactModelSerializer 的 timeline
+USER_TWEETS_COMPACT_PATTERN = 'user_tweets_compact:{user_id}'
+USER_TWEETS_COMPACT_ZSET_PATTERN = 'user_tweets_compact_zset:{user_id}'
+USER_NEWSFEEDS_COMPACT_PATTERN = 'user_newsfeeds_compact:{user_id}'
+USER_NEWSFEEDS_COMPACT_ZSET_PATTERN = 'user_newsfeeds_compact_zset:{user_id}'
+# {(数据格式, 是否使用 sorted set): key pattern}，不同格式的数据不能放在同一个 key 里
+USER_TWEETS_PATTERNS = {
+    ('full', False): USER_TWEETS_PATTERN,
+    ('full', True): USER_TWEETS_ZSET_PATTERN,
+    ('id_only', False): USER_TWEET_IDS_PATTERN,
+    ('id_only', True): USER_TWEET_IDS_ZSET_PATTERN,
+    ('compact', False): USER_TWEETS_COMPACT_PATTERN,
+    ('compact', True): USER_TWEETS_COMPACT_ZSET_PATTERN,
+}
+# HBase 的 newsfeeds 用 HBaseModelSerializer 序列化，id-only 的 created_at 是时间戳，和 MySQL 的数据格式不同
+# 用户被切换到另一个 backend 之后不能读到旧的数据，因此使用不同的 key
+USER_NEWSFEEDS_HBASE_PATTERN = 'user_newsfeeds_hbase:{user_id}'
+USER_NEWSFEEDS_HBASE_ZSET_PATTERN = 'user_newsfeeds_hbase_zset:{user_id}'
+USER_NEWSFEED_IDS_HBASE_PATTERN = 'user_newsfeed_ids_hbase:{user_id}'
+USER_NEWSFEED_IDS_HBASE_ZSET_PATTERN = 'user_newsfeed_ids_hbase_zset:{user_id}'
+# {(数据格式, 是否使用 sorted set, backend): key pattern}，HBase 不支持 compact
+USER_NEWSFEEDS_PATTERNS = {
+    ('full', False, 'db'): USER_NEWSFEEDS_PATTERN,
+    ('full', True, 'db'): USER_NEWSFEEDS_ZSET_PATTERN,
+    ('id_only', False, 'db'): USER_NEWSFEED_IDS_PATTERN,
+    ('id_only', True, 'db'): USER_NEWSFEED_IDS_ZSET_PATTERN,
+    ('compact', False, 'db'): USER_NEWSFEEDS_COMPACT_PATTERN,
+    ('compact', True, 'db'): USER_NEWSFEEDS_COMPACT_ZSET_PATTERN,
+    ('full', False, 'hbase'): USER_NEWSFEEDS_HBASE_PATTERN,
+    ('full', True, 'hbase'): USER_NEWSFEEDS_HBASE_ZSET_PATTERN,
+    ('id_only', False, 'hbase'): USER_NEWSFEED_IDS_HBASE_PATTERN,
+    ('id_only', True, 'hbase'): USER_NEWSFEED_IDS_HBASE_ZSET_PATTERN,
+}
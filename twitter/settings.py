@@ -72,6 +72,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'gatekeeper.middleware.GateKeeperSnapshotMiddleware',
 ]
 
 ROOT_URLCONF = 'twitter.urls'
@@ -111,6 +112,11 @@ DATABASES = {
 
 # HBase Database
 HBASE_HOST = '127.0.0.1'
+# 每个进程最多同时持有多少个 HBase 连接，以及借不到连接时最多等待多少秒
+HBASE_POOL_SIZE = 10
+HBASE_POOL_TIMEOUT = 5
+# 连接空闲超过这么多秒之后，下次借出前才做一次探活
+HBASE_POOL_IDLE_CHECK_INTERVAL = 30
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -224,8 +230,47 @@ CACHES = {
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
+# 每个 redis 连接池的默认配置，可以在 REDIS_CLIENTS 的每个 shard 里覆盖
+REDIS_POOL_OPTIONS = {
+    'max_connections': 50,
+    'timeout': 5,  # 连接池用完的时候最多等待多久，in seconds
+    'socket_timeout': 2,
+    'socket_connect_timeout': 2,
+    'health_check_interval': 30,  # 连接空闲超过这个时间之后先 PING 一下，in seconds
+}
+# 按照用途分开的 redis，每个用途是一个 shard 的列表，每个 shard 是 redis 连接的参数
+# timeline 有多个 shard 的时候按照 user_id 做一致性 hash 分片，其他用途只使用第一个 shard
+# 可以把 counters 放到单独的实例上，和 timeline 以及 celery broker 隔离开
+REDIS_CLIENTS = {
+    'default': [{'host': REDIS_HOST, 'port': REDIS_PORT, 'db': REDIS_DB}],
+    'timeline': [{'host': REDIS_HOST, 'port': REDIS_PORT, 'db': REDIS_DB}],
+    'counters': [{'host': REDIS_HOST, 'port': REDIS_PORT, 'db': REDIS_DB}],
+    'gatekeeper': [{'host': REDIS_HOST, 'port': REDIS_PORT, 'db': REDIS_DB}],
+    'metrics': [{'host': REDIS_HOST, 'port': REDIS_PORT, 'db': REDIS_DB}],
+}
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
+# REDIS_KEY_EXPIRE_TIME 之后 cache 逻辑上过期，但是数据还会再保留 REDIS_STALE_TIME 秒
+# 这段时间内只有拿到锁的请求去重建 cache，其他请求继续返回旧数据
+REDIS_STALE_TIME = 3600  # in seconds
+# cache 重建的 single-flight 锁，超过这个时间自动释放，避免重建的进程挂掉之后一直锁住
+REDIS_LOCK_TIMEOUT = 10  # in seconds
+# 没有拿到锁的请求等待重建完成的最长时间，超时之后直接读数据库
+REDIS_LOCK_WAIT_TIME = 3  # in seconds
+# XFetch 提前重建的系数，越大越早重建，1.0 是论文中推荐的默认值
+REDIS_XFETCH_BETA = 1.0
+
+# GateKeeper
+# 进程内缓存的 gatekeeper 最多每隔这么久检查一次 redis 里的 version，测试的时候每次都检查
+GATEKEEPER_CACHE_TTL = 1 if not TESTING else 0  # in seconds
+
+# Superstar
+# 粉丝数达到 SUPERSTAR_FOLLOWERS_THRESHOLD 的用户自动变成 superstar，发 tweet 的时候不再 fan-out，粉丝读取的时候再 pull
+# 粉丝数降到 SUPERSTAR_DEMOTE_THRESHOLD 以下才变回普通用户，中间留一段距离，避免在阈值附近反复迁移
+SUPERSTAR_FOLLOWERS_THRESHOLD = 10000
+SUPERSTAR_DEMOTE_THRESHOLD = 8000
+# 变回普通用户的时候给每个粉丝回填最近多少条 tweet 的 newsfeed
+SUPERSTAR_BACKFILL_LIMIT = 1000 if not TESTING else 20
 
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
@@ -237,6 +282,20 @@ CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
 )
+# 定时任务，需要单独运行 beat 进程
+#   celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    # 把 write-behind 计数器累积的增量写回数据库
+    'flush-tweet-counters': {
+        'task': 'tweets.tasks.flush_tweet_counters_task',
+        'schedule': 10.0,  # in seconds
+    },
+    # 重新发出超时没有进展的 fan-out 的 batches
+    'resume-stalled-fanouts': {
+        'task': 'newsfeeds.tasks.resume_stalled_fanouts_task',
+        'schedule': 60.0,  # in seconds
+    },
+}
 
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
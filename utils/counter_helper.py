@@ -0,0 +1,279 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Coalesce
+from utils.redis_client import RedisClient
+from utils.redis_stores import get_script
+
+import uuid
+
+# 每个 model 一个 hash，field 是 '{object_id}:{attr}'，value 是还没有写回数据库的增量
+DELTAS_KEY_PATTERN = 'counter_deltas:{model_name}'
+# flush 的时候先把 deltas rename 成这个 key，写回数据库之后再删除
+FLUSHING_KEY_PATTERN = 'counter_deltas:{model_name}:flushing'
+# 每次 flush 删除 flushing 的时候加 1，load count 的 cache 的时候用来判断这期间有没有 flush 写回过增量
+FLUSH_GENERATION_KEY_PATTERN = 'counter_flush_generation:{model_name}'
+# 正在从数据库 load 的 count，value 是 load 的请求的随机 token，count 被修改的时候删除，这次 load 的结果就不会写入 cache
+FILL_KEY_PATTERN = 'counter_fill:{count_key}'
+# load 一个 count 最多需要多久，超时之后这次 load 的结果不写入 cache
+FILL_TIMEOUT = 60
+# 每条 UPDATE ... CASE WHEN 语句最多更新多少个 objects
+FLUSH_BATCH_SIZE = 500
+# flush 的锁的超时时间，要比一次 flush 花费的时间长，否则可能有两个 flush 同时处理 flushing
+FLUSH_LOCK_TIMEOUT = 10 * 60
+
+# 记录增量，并且在 count 的 cache 存在的时候同步更新，在同一个原子操作里执行
+# count 的 cache 不存在的时候不 load，下次读取的时候会用数据库的值加上还没有写回的增量
+# 同时取消正在进行的 load，它可能没有读到这个增量
+# KEYS[1]: deltas hash, KEYS[2]: count key, KEYS[3]: fill key, ARGV[1]: hash field, ARGV[2]: delta
+INCR_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.call('INCRBY', KEYS[2], ARGV[2])
+end
+redis.call('DEL', KEYS[3])
+return nil
+"""
+
+# 数据库已经更新之后，count 的 cache 存在的时候同步更新，不存在的时候取消正在进行的 load
+# KEYS[1]: count key, KEYS[2]: fill key, ARGV[1]: delta
+INCR_CACHED_COUNT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+redis.call('DEL', KEYS[2])
+return nil
+"""
+
+# 把 load 出来的 counts 写入 cache，只有下面的条件都满足的时候才写入
+#  - 开始 load 的时候和现在都没有 flush 在进行（flushing 不存在），并且这期间没有 flush 完成过
+#  - 这个 count 的 fill key 还是这次 load 的 token，也就是这期间 count 没有被修改过
+# KEYS[1]: flush generation, KEYS[2]: flushing hash, KEYS[3..2+n]: count keys, KEYS[3+n..2+2n]: fill keys
+# ARGV[1]: token, ARGV[2]: flush generation when the load started, ARGV[3..2+n]: counts
+FINISH_FILL_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[2] then
+    return 0
+end
+local n = (#KEYS - 2) / 2
+local filled = 0
+for i = 1, n do
+    local fill_key = KEYS[2 + n + i]
+    if redis.call('GET', fill_key) == ARGV[1] then
+        redis.call('SET', KEYS[2 + i], ARGV[2 + i], 'NX')
+        redis.call('DEL', fill_key)
+        filled = filled + 1
+    end
+end
+return filled
+"""
+
+
+class CounterHelper:
+    """
+    write-behind 计数器：like / comment 的时候只在 redis 里用 HINCRBY 记录增量，
+    由 celery 定时任务把增量合并之后批量写回数据库，避免热门 tweet 的同一行被频繁 UPDATE 而产生锁竞争
+    增量要么在 deltas hash 里，要么在 flushing hash 里，要么已经写回数据库，进程崩溃不会丢失
+    """
+
+    @classmethod
+    def get_deltas_key(cls, model_class):
+        return DELTAS_KEY_PATTERN.format(model_name=model_class.__name__)
+
+    @classmethod
+    def get_flushing_key(cls, model_class):
+        return FLUSHING_KEY_PATTERN.format(model_name=model_class.__name__)
+
+    @classmethod
+    def get_field(cls, object_id, attr):
+        return '{}:{}'.format(object_id, attr)
+
+    @classmethod
+    def incr(cls, model_class, object_id, attr, delta=1):
+        # import placed inside to avoid circular dependency
+        from utils.redis_helper import RedisHelper
+
+        conn = RedisClient.get_connection('counters')
+        count_key = RedisHelper.get_count_key(model_class.__name__, object_id, attr)
+        incr_script = get_script(conn, INCR_SCRIPT)
+        return incr_script(
+            keys=[cls.get_deltas_key(model_class), count_key, cls.get_fill_key(count_key)],
+            args=[cls.get_field(object_id, attr), delta],
+            client=conn,
+        )
+
+    @classmethod
+    def incr_cached_count(cls, count_key, delta=1):
+        """
+        数据库里的 count 已经更新之后调用，cache 存在的时候返回更新之后的值，不存在的时候返回 None
+        """
+        conn = RedisClient.get_connection('counters')
+        incr_script = get_script(conn, INCR_CACHED_COUNT_SCRIPT)
+        return incr_script(keys=[count_key, cls.get_fill_key(count_key)], args=[delta], client=conn)
+
+    @classmethod
+    def get_fill_key(cls, count_key):
+        return FILL_KEY_PATTERN.format(count_key=count_key)
+
+    @classmethod
+    def start_fill(cls, model_name, count_keys):
+        """
+        从数据库 load counts 之前调用，之后用 finish_fill 写入 cache
+        不持有任何锁，load 期间 count 被修改或者有 flush 写回增量的时候，finish_fill 不会写入过期的值
+        Returns the fill state, or None if a flush is in progress and the counts should not be cached.
+        """
+        conn = RedisClient.get_connection('counters')
+        token = uuid.uuid4().hex
+        pipe = conn.pipeline(transaction=True)
+        for count_key in count_keys:
+            pipe.set(cls.get_fill_key(count_key), token, ex=FILL_TIMEOUT)
+        pipe.get(FLUSH_GENERATION_KEY_PATTERN.format(model_name=model_name))
+        pipe.exists(FLUSHING_KEY_PATTERN.format(model_name=model_name))
+        *_, generation, flushing = pipe.execute()
+        if flushing:
+            return None
+        return model_name, token, (generation or b'0').decode()
+
+    @classmethod
+    def finish_fill(cls, state, counts):
+        """
+        counts: {count_key: count}，只包含 start_fill 里的 keys
+        Returns how many counts are written to the cache.
+        """
+        if state is None or not counts:
+            return 0
+        model_name, token, generation = state
+        count_keys = list(counts)
+        conn = RedisClient.get_connection('counters')
+        finish_fill_script = get_script(conn, FINISH_FILL_SCRIPT)
+        return finish_fill_script(
+            keys=[
+                FLUSH_GENERATION_KEY_PATTERN.format(model_name=model_name),
+                FLUSHING_KEY_PATTERN.format(model_name=model_name),
+                *count_keys,
+                *[cls.get_fill_key(count_key) for count_key in count_keys],
+            ],
+            args=[token, generation, *[counts[count_key] for count_key in count_keys]],
+            client=conn,
+        )
+
+    @classmethod
+    def decr(cls, model_class, object_id, attr, delta=1):
+        return cls.incr(model_class, object_id, attr, -delta)
+
+    @classmethod
+    def get_pending_deltas(cls, model_name, object_ids_and_attrs):
+        """
+        Returns {(object_id, attr): delta} of the deltas not written back to the database yet.
+        load count 的 cache 的时候需要加上这部分
+        """
+        object_ids_and_attrs = list(object_ids_and_attrs)
+        if not object_ids_and_attrs:
+            return {}
+        fields = [cls.get_field(object_id, attr) for object_id, attr in object_ids_and_attrs]
+        conn = RedisClient.get_connection('counters')
+        pipe = conn.pipeline(transaction=True)
+        pipe.hmget(DELTAS_KEY_PATTERN.format(model_name=model_name), fields)
+        pipe.hmget(FLUSHING_KEY_PATTERN.format(model_name=model_name), fields)
+        deltas, flushing_deltas = pipe.execute()
+        return {
+            key: int(delta or 0) + int(flushing_delta or 0)
+            for key, delta, flushing_delta in zip(object_ids_and_attrs, deltas, flushing_deltas)
+        }
+
+    @classmethod
+    def build_updates(cls, deltas, object_ids):
+        """
+        {attr: {object_id: delta}} => update(**kwargs) 的参数，每个 attr 一个 CASE WHEN
+        """
+        updates = {}
+        for attr, attr_deltas in deltas.items():
+            whens = [
+                When(id=object_id, then=Value(attr_deltas[object_id]))
+                for object_id in object_ids
+                if object_id in attr_deltas
+            ]
+            if not whens:
+                continue
+            updates[attr] = Coalesce(F(attr), 0) + Case(
+                *whens,
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        return updates
+
+    @classmethod
+    def lock_flush(cls, model_class, blocking_timeout=0):
+        """
+        拿到 flush 的锁，持有锁的时候不会有 flush 在写回增量，数据库里的值加上 get_pending_deltas 就是准确的数量
+        只有 flush 和 reconcile_tweet_counts 使用，load count 的 cache 用的是 start_fill / finish_fill
+        Returns the Lock, or None if it is not acquired in {blocking_timeout} seconds.
+        """
+        # import placed inside to avoid circular dependency
+        from utils.redis_helper import RedisHelper
+
+        conn = RedisClient.get_connection('counters')
+        if blocking_timeout == 0:
+            return RedisHelper.try_lock(conn, cls.get_flushing_key(model_class), timeout=FLUSH_LOCK_TIMEOUT)
+        lock = conn.lock(
+            RedisHelper.get_lock_key(cls.get_flushing_key(model_class)),
+            timeout=FLUSH_LOCK_TIMEOUT,
+        )
+        if lock.acquire(blocking=True, blocking_timeout=blocking_timeout):
+            return lock
+        return None
+
+    @classmethod
+    def flush(cls, model_class, batch_size=FLUSH_BATCH_SIZE):
+        """
+        把累积的增量合并之后写回数据库，返回更新了多少个 objects
+         1. RENAME deltas => flushing，之后新的增量写到新的 deltas hash 里
+         2. 每 batch_size 个 objects 一条 UPDATE ... SET attr = attr + CASE WHEN id = ... END
+         3. 数据库事务提交之后删除 flushing
+        如果进程在 3 之前崩溃，flushing 还在，下次 flush 的时候会先处理它，因此增量不会丢失
+        在事务提交和删除 flushing 之间崩溃会导致重复写入，可以用 reconcile_tweet_counts 修复
+        """
+        # import placed inside to avoid circular dependency
+        from utils.redis_helper import RedisHelper
+
+        conn = RedisClient.get_connection('counters')
+        deltas_key = cls.get_deltas_key(model_class)
+        flushing_key = cls.get_flushing_key(model_class)
+        # 没有开启 write-behind 的时候没有增量，不需要拿锁
+        if not conn.exists(deltas_key, flushing_key):
+            return 0
+        # 同一时间只有一个 flush 在处理 flushing
+        lock = cls.lock_flush(model_class)
+        if lock is None:
+            return 0
+        try:
+            # 上一次 flush 中途失败留下的 flushing 先处理
+            if not conn.exists(flushing_key):
+                if not conn.exists(deltas_key):
+                    return 0
+                conn.rename(deltas_key, flushing_key)
+
+            deltas, object_ids = {}, set()
+            for field, delta in conn.hgetall(flushing_key).items():
+                object_id, attr = field.decode().split(':')
+                if int(delta) == 0:
+                    continue
+                deltas.setdefault(attr, {})[int(object_id)] = int(delta)
+                object_ids.add(int(object_id))
+
+            object_ids = sorted(object_ids)
+            with transaction.atomic():
+                for start in range(0, len(object_ids), batch_size):
+                    batch_ids = object_ids[start: start + batch_size]
+                    model_class.objects.filter(id__in=batch_ids).update(
+                        **cls.build_updates(deltas, batch_ids)
+                    )
+            # 同一个原子操作里增加 generation，这次 flush 期间开始的 load 都不会写入 cache
+            pipe = conn.pipeline(transaction=True)
+            pipe.delete(flushing_key)
+            pipe.incr(FLUSH_GENERATION_KEY_PATTERN.format(model_name=model_class.__name__))
+            pipe.execute()
+            return len(object_ids)
+        finally:
+            RedisHelper.release_lock(lock)
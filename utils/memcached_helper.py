@@ -28,3 +28,27 @@ class MemcachedHelper:
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
         cache.delete(key)
+
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        get_object_through_cache 的批量版本，memcached 和数据库各最多一次 round trip
+        返回 {object_id: object}，数据库里不存在的 id 不会出现在返回值里
+        """
+        keys = {object_id: cls.get_key(model_class, object_id) for object_id in object_ids}
+        cached_objects = cache.get_many(list(keys.values()))
+
+        objects, missing_ids = {}, []
+        for object_id, key in keys.items():
+            if key in cached_objects:
+                objects[object_id] = cached_objects[key]
+            else:
+                missing_ids.append(object_id)
+        if not missing_ids:
+            return objects
+
+        # cache miss
+        loaded_objects = model_class.objects.in_bulk(missing_ids)
+        cache.set_many({keys[object_id]: obj for object_id, obj in loaded_objects.items()})
+        objects.update(loaded_objects)
+        return objects
@@ -0,0 +1,38 @@
+from utils.redis_client import RedisClient
+
+METRICS_KEY_PATTERN = 'metrics:{name}'
+
+
+class MetricsHelper:
+    """
+    简单的累加型 metrics，每个 metric 是 redis 里的一个 hash，例如
+    metrics:shadow:friendship_follower_ids => {calls: 10, mismatches: 1, primary_seconds: 0.12, ...}
+    多个进程可以同时累加，平均值用 sum / calls 计算
+    """
+
+    @classmethod
+    def get_key(cls, name):
+        return METRICS_KEY_PATTERN.format(name=name)
+
+    @classmethod
+    def record(cls, name, **fields):
+        """
+        把每个 field 的值累加到 {name} 上，int 用 HINCRBY，float 用 HINCRBYFLOAT，在同一个 pipeline 里执行
+        """
+        key = cls.get_key(name)
+        conn = RedisClient.get_connection('metrics')
+        pipe = conn.pipeline(transaction=False)
+        for field, value in fields.items():
+            if isinstance(value, float):
+                pipe.hincrbyfloat(key, field, value)
+            else:
+                pipe.hincrby(key, field, value)
+        pipe.execute()
+
+    @classmethod
+    def get(cls, name):
+        conn = RedisClient.get_connection('metrics')
+        return {
+            field.decode(): float(value)
+            for field, value in conn.hgetall(cls.get_key(name)).items()
+        }
@@ -12,6 +12,71 @@ import pytz
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 
 
+def parse_created_at(value):
+    # 兼容 iso 格式和 int 格式的时间戳
+    try:
+        return parser.isoparse(value)
+    except ValueError:
+        return int(value)
+
+
+def bisect_created_at(reverse_ordered_list, created_at__lt):
+    """
+    list 按照 created_at 倒序排列，二分查找第一个 created_at < created_at__lt 的位置
+    没找到任何满足条件的 objects 时返回 len
+    对于 redis 里的 CachedList，只需要读取 log(n) 个 objects 而不是整个 list
+    """
+    low, high = 0, len(reverse_ordered_list)
+    while low < high:
+        middle = (low + high) // 2
+        if reverse_ordered_list[middle].created_at < created_at__lt:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def iter_by_created_at(reverse_ordered_list, created_at__gt=None, created_at__lt=None):
+    """
+    Yields the objects with created_at in (created_at__gt, created_at__lt), newest first.
+    按顺序一个一个返回，用到哪里才从 redis 读到哪里（CachedList 顺序访问的时候按 chunk 读取）
+    用于多个 timeline 的 k-way merge，事先不知道每个 timeline 需要读多少个
+    """
+    start = 0
+    if created_at__lt is not None:
+        start = bisect_created_at(reverse_ordered_list, created_at__lt)
+    for index in range(start, len(reverse_ordered_list)):
+        try:
+            obj = reverse_ordered_list[index]
+        except IndexError:
+            # 读取过程中 redis list 被 trim 或者过期了
+            return
+        if created_at__gt is not None and obj.created_at <= created_at__gt:
+            return
+        yield obj
+
+
+def iter_with_fallback(cached_list, load_older, created_at__gt=None, created_at__lt=None):
+    """
+    和 iter_by_created_at 一样，但是 cached_list 只保留了最新的 REDIS_LIST_LENGTH_LIMIT 个 objects，
+    读到头之后调用 load_older(created_at__gt, created_at__lt) 从数据库继续按 -created_at 读取更早的 objects
+    """
+    yield from iter_by_created_at(cached_list, created_at__gt, created_at__lt)
+    # 长度不足最大限制，说明 cached_list 里已经是所有数据了
+    if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
+        return
+    try:
+        oldest_created_at = cached_list[len(cached_list) - 1].created_at
+    except IndexError:
+        return
+    # 在 cached_list 里已经读到了 created_at__gt，不需要再读数据库
+    if created_at__gt is not None and oldest_created_at <= created_at__gt:
+        return
+    if created_at__lt is None or oldest_created_at < created_at__lt:
+        created_at__lt = oldest_created_at
+    yield from load_older(created_at__gt, created_at__lt)
+
+
 class EndlessPagination(BasePagination):
     page_size = 20
 
@@ -22,13 +87,28 @@ class EndlessPagination(BasePagination):
     def to_html(self):
         pass
 
+    def paginate_sorted_set(self, cached_set, request):
+        """
+        直接用 ZREVRANGEBYSCORE 在 redis 上按照 created_at 翻页
+        """
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = parse_created_at(request.query_params['created_at__gt'])
+            self.has_next_page = False
+            return cached_set.range_by_created_at(created_at__gt=created_at__gt)
+
+        created_at__lt = None
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parse_created_at(request.query_params['created_at__lt'])
+        objects = cached_set.range_by_created_at(created_at__lt=created_at__lt, limit=self.page_size + 1)
+        self.has_next_page = len(objects) > self.page_size
+        return objects[:self.page_size]
+
     def paginate_ordered_list(self, reverse_ordered_list, request):
+        if hasattr(reverse_ordered_list, 'range_by_created_at'):
+            return self.paginate_sorted_set(reverse_ordered_list, request)
+
         if 'created_at__gt' in request.query_params:
-            # 兼容 iso 格式和 int 格式的时间戳
-            try:
-                created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            except ValueError:
-                created_at__gt = int(request.query_params['created_at__gt'])
+            created_at__gt = parse_created_at(request.query_params['created_at__gt'])
             objects = []
             for obj in reverse_ordered_list:
                 if obj.created_at > created_at__gt:
@@ -40,19 +120,11 @@ class EndlessPagination(BasePagination):
 
         index = 0
         if 'created_at__lt' in request.query_params:
-            # 兼容 iso 格式和 int 格式的时间戳
-            try:
-                created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            except ValueError:
-                created_at__lt = int(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # 没找到任何满足条件的 objects，返回空数组
-                reverse_ordered_list = []
+            created_at__lt = parse_created_at(request.query_params['created_at__lt'])
+            # 没找到任何满足条件的 objects 时 index == len，返回空数组
+            index = bisect_created_at(reverse_ordered_list, created_at__lt)
         self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
+        return list(reverse_ordered_list[index: index + self.page_size])
 
     def paginate_queryset(self, queryset, request, view=None):
         if 'created_at__gt' in request.query_params:
@@ -1,25 +1,82 @@
 from django.conf import settings
+
+import hashlib
 import redis
+import threading
+
+
+def jump_consistent_hash(key, num_buckets):
+    """
+    Jump Consistent Hash (Lamping & Veach)，把 64 位的 key 映射到 [0, num_buckets)
+    增加一个 bucket 的时候只有 1 / num_buckets 的 key 会移动到新的 bucket 上，不需要维护 hash 环
+    """
+    bucket, candidate = -1, 0
+    while candidate < num_buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def get_shard_index(shard_key, num_shards):
+    if num_shards == 1 or shard_key is None:
+        return 0
+    # user_id 是连续的，先 hash 一下再分片
+    digest = hashlib.md5(str(shard_key).encode()).digest()
+    return jump_consistent_hash(int.from_bytes(digest[:8], 'big'), num_shards)
 
 
 class RedisClient:
-    conn = None
+    """
+    按照用途（settings.REDIS_CLIENTS 的 key）分开的 redis 连接，每个用途有自己的连接池
+     - timeline: 用户的 tweets / newsfeeds cache，可以配置多个 shard，按照 user_id 分片
+     - counters: likes / comments 的 counts 和 write-behind 的增量
+     - gatekeeper: gatekeeper 的开关
+     - metrics: MetricsHelper 累加的 metrics
+    没有配置的用途使用 default
+    """
+    # {(purpose, shard index): redis.Redis}
+    conns = {}
+    lock = threading.Lock()
 
     @classmethod
-    def get_connection(cls):
+    def get_shards(cls, purpose):
+        if purpose in settings.REDIS_CLIENTS:
+            return settings.REDIS_CLIENTS[purpose]
+        return settings.REDIS_CLIENTS['default']
+
+    @classmethod
+    def get_connection(cls, purpose='default', shard_key=None):
         """
-        Creates one single connection shared globally
-        using singleton design pattern.
+        Returns the redis.Redis of {purpose}, shared globally in the process.
+        shard_key: 有多个 shard 的时候用来选择 shard，例如 user_id，同一个 key 每次都要传同样的 shard_key
+        redis.Redis 本身是线程安全的，每个命令从连接池里借一个连接，fork 之后连接池会自动重建
         """
-        if cls.conn:
-            return cls.conn
+        shards = cls.get_shards(purpose)
+        return cls.get_shard_connection(purpose, get_shard_index(shard_key, len(shards)))
+
+    @classmethod
+    def get_shard_connection(cls, purpose, shard_index):
+        conn_key = (purpose, shard_index)
+        if conn_key in cls.conns:
+            return cls.conns[conn_key]
 
-        cls.conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-        )
-        return cls.conn
+        with cls.lock:
+            if conn_key not in cls.conns:
+                options = dict(settings.REDIS_POOL_OPTIONS)
+                options.update(cls.get_shards(purpose)[shard_index])
+                cls.conns[conn_key] = redis.Redis(
+                    connection_pool=redis.BlockingConnectionPool(**options),
+                )
+        return cls.conns[conn_key]
+
+    @classmethod
+    def get_all_connections(cls):
+        return [
+            cls.get_shard_connection(purpose, shard_index)
+            for purpose, shards in settings.REDIS_CLIENTS.items()
+            for shard_index in range(len(shards))
+        ]
 
     @classmethod
     def clear(cls):
@@ -28,5 +85,5 @@ class RedisClient:
         """
         if not settings.TESTING:
             raise Exception("You cannot flush redis in production environment")
-        conn = cls.get_connection()
-        conn.flushdb()
+        for conn in cls.get_all_connections():
+            conn.flushdb()
@@ -1,115 +1,302 @@
 from django.conf import settings
 from django_hbase.models import HBaseModel
+from redis.exceptions import LockError
+from utils.counter_helper import CounterHelper
+from utils.paginations import EndlessPagination
 from utils.redis_client import RedisClient
 from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.redis_stores import RedisListStore
+
+import math
+import random
+import time
+
+# 等待其他请求重建 cache 的时候，每次检查锁是否释放的间隔
+LOCK_POLL_INTERVAL = 0.05
 
 
 class RedisHelper:
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects, serializer):
-        conn = RedisClient.get_connection()
+    def get_timeline_connection(cls, shard_key=None):
+        return RedisClient.get_connection('timeline', shard_key)
+
+    @classmethod
+    def get_lock_key(cls, key):
+        return 'lock:{}'.format(key)
+
+    @classmethod
+    def get_meta_key(cls, key):
+        return 'meta:{}'.format(key)
+
+    @classmethod
+    def try_lock(cls, conn, key, timeout=None):
+        """
+        single-flight: 同一个 key 同时只有一个请求去数据库重建 cache
+        拿到锁返回 Lock，没拿到返回 None，不会阻塞
+        """
+        if timeout is None:
+            timeout = settings.REDIS_LOCK_TIMEOUT
+        lock = conn.lock(cls.get_lock_key(key), timeout=timeout)
+        if lock.acquire(blocking=False):
+            return lock
+        return None
+
+    @classmethod
+    def release_lock(cls, lock):
+        try:
+            lock.release()
+        except LockError:
+            # 重建的时间超过了 REDIS_LOCK_TIMEOUT，锁已经自动释放或者被别人拿走了
+            pass
+
+    @classmethod
+    def wait_for_lock(cls, conn, key):
+        # 等待拿到锁的请求重建完成，最多等待 REDIS_LOCK_WAIT_TIME 秒
+        lock_key = cls.get_lock_key(key)
+        deadline = time.time() + settings.REDIS_LOCK_WAIT_TIME
+        while conn.exists(lock_key) and time.time() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    @classmethod
+    def parse_meta(cls, meta):
+        """
+        meta 的格式是 '{逻辑过期时间}:{上次重建花费的秒数}'
+        """
+        expire_at, delta = meta.decode().split(':')
+        return float(expire_at), float(delta)
 
-        serialized_list = []
+    @classmethod
+    def should_recompute(cls, meta):
+        """
+        XFetch (probabilistic early expiration)：越接近过期时间、重建越慢，越有可能提前重建
+        这样在过期之前就会有一个请求重建好 cache，而不是过期的瞬间所有请求一起去数据库
+        没有 meta 的 key 不会提前重建
+        """
+        if meta is None:
+            return False
+        expire_at, delta = cls.parse_meta(meta)
+        # 1 - random() 的范围是 (0, 1]，避免 log(0)
+        gap = -delta * settings.REDIS_XFETCH_BETA * math.log(1 - random.random())
+        return time.time() + gap >= expire_at
+
+    @classmethod
+    def _load_objects_to_cache(cls, key, objects, serializer, store=RedisListStore, delta=0, shard_key=None):
+        conn = cls.get_timeline_connection(shard_key)
         # 最多只 cache REDIS_LIST_LENGTH_LIMIT 那么多个 objects
         # 超过这个限制的 objects，就去数据库里读取。一般这个限制会比较大，比如 1000
         # 因此翻页翻到 1000 的用户访问量会比较少，从数据库读取也不是大问题
-        for obj in objects:
-            serialized_data = serializer.serialize(obj)
-            serialized_list.append(serialized_data)
+        meta = '{}:{}'.format(time.time() + settings.REDIS_KEY_EXPIRE_TIME, delta)
+        store.save(conn, key, objects, serializer, meta_key=cls.get_meta_key(key), meta=meta)
 
-        if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+    @classmethod
+    def _rebuild_cache(cls, key, lazy_load_objects, serializer, store, shard_key):
+        # 只有拿到锁的请求才会调用，记录重建花费的时间给 XFetch 使用
+        start = time.time()
+        objects = list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT))
+        delta = time.time() - start
+        cls._load_objects_to_cache(key, objects, serializer, store, delta, shard_key)
+        return objects
 
     @classmethod
-    def load_objects(cls, key, lazy_load_objects, serializer=DjangoModelSerializer):
-        conn = RedisClient.get_connection()
+    def load_objects(
+        cls,
+        key,
+        lazy_load_objects,
+        serializer=DjangoModelSerializer,
+        store=RedisListStore,
+        serve_stale=True,
+        shard_key=None,
+    ):
+        """
+        cache hit 的时候返回 CachedList，只预先读取第一页，其余部分在被访问的时候才读取
+        cache miss 的时候从数据库 load 并写入 cache，返回 list
+        store: RedisListStore 或者 RedisSortedSetStore，同一个 key 需要一直使用同一种 store
+        serve_stale: cache 逻辑过期之后，没有拿到锁的请求是否直接返回旧数据，否则等待重建完成
+        shard_key: timeline 按照它分片，一般是 user_id，同一个 key 的所有操作都要传同样的值
+        同一个 key 同时只有一个请求会去数据库重建 cache
+        """
+        conn = cls.get_timeline_connection(shard_key)
+        meta_key = cls.get_meta_key(key)
+        chunk_size = EndlessPagination.page_size + 1
+        cached_list = store.load(conn, key, serializer, chunk_size, meta_key=meta_key)
 
         # If {key} exists in cache, get the values and return.
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = serializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            # print(f'cache hit {key}, len(objects)={len(objects)}')
-            return objects
+        if cached_list is not None:
+            if not cls.should_recompute(cached_list.meta):
+                # print(f'cache hit {key}, len(objects)={len(cached_list)}')
+                return cached_list
+            lock = cls.try_lock(conn, key)
+            if lock is not None:
+                try:
+                    return cls._rebuild_cache(key, lazy_load_objects, serializer, store, shard_key)
+                finally:
+                    cls.release_lock(lock)
+            expire_at, _ = cls.parse_meta(cached_list.meta)
+            # 还没有真正过期（XFetch 提前重建），或者允许返回旧数据
+            if serve_stale or time.time() < expire_at:
+                return cached_list
+            cls.wait_for_lock(conn, key)
+            rebuilt_list = store.load(conn, key, serializer, chunk_size)
+            return cached_list if rebuilt_list is None else rebuilt_list
 
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
+        lock = cls.try_lock(conn, key)
+        if lock is not None:
+            try:
+                # transform it to list to make sure that the return type is always list
+                # print(f'cache miss {key}')
+                return cls._rebuild_cache(key, lazy_load_objects, serializer, store, shard_key)
+            finally:
+                cls.release_lock(lock)
 
-        # transform it to list to make sure that the return type is always list
-        # print(f'cache miss {key}, len(objects)={len(objects)}')
-        return list(objects)
+        # 其他请求正在重建 cache，等它完成之后再读取 cache
+        cls.wait_for_lock(conn, key)
+        cached_list = store.load(conn, key, serializer, chunk_size)
+        if cached_list is not None:
+            return cached_list
+        # 等待超时了，直接读数据库，但是不写入 cache
+        return list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT))
 
     @classmethod
-    def push_object(cls, key, obj, lazy_load_objects):
-        if isinstance(obj, HBaseModel):
+    def push_object(
+        cls,
+        key,
+        obj,
+        lazy_load_objects,
+        store=RedisListStore,
+        serializer=None,
+        shard_key=None,
+    ):
+        # 没有指定 serializer 的时候按照 obj 的类型选择
+        if serializer is None and isinstance(obj, HBaseModel):
             serializer = HBaseModelSerializer
-        else:
+        elif serializer is None:
             serializer = DjangoModelSerializer
-        conn = RedisClient.get_connection()
-        # 如果在 cache 里存在，直接把 obj 放在 list 的最前面，然后 trim 一下长度
-        if conn.exists(key):
+        conn = cls.get_timeline_connection(shard_key)
+        # 如果在 cache 里存在，直接把 obj 放在最前面，然后 trim 一下长度
+        # 检查存在和 push 在同一个 lua 脚本里原子地执行
+        if store.push(conn, key, obj, serializer):
             # print(f'push cache hit {key}')
-            serialized_data = serializer.serialize(obj)
-            conn.lpush(key, serialized_data)
-            conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
             return
 
         # 如果 key 不存在， 直接从数据库里 load
         # 就不走单个 push 的方式加到 cache 里了
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
-        # print(f'push cache miss {key}, len={len(objects)}')
+        lock = cls.try_lock(conn, key)
+        if lock is not None:
+            try:
+                cls._rebuild_cache(key, lazy_load_objects, serializer, store, shard_key)
+            finally:
+                cls.release_lock(lock)
+            # print(f'push cache miss {key}')
+            return
+
+        # 其他请求正在重建 cache，它不一定读到了 obj，等它完成之后再 push 一次
+        # list 会跳过和第一个元素相同的 obj，sorted set 本身就是幂等的，因此不会重复
+        cls.wait_for_lock(conn, key)
+        store.push(conn, key, obj, serializer)
 
     @classmethod
-    def invalidate_cache(cls, key):
-        conn = RedisClient.get_connection()
-        conn.delete(key)
+    def invalidate_cache(cls, *keys, shard_key=None):
+        # 多个 key 需要在同一个 shard 上，一次 DEL 删除
+        conn = cls.get_timeline_connection(shard_key)
+        conn.delete(*keys, *[cls.get_meta_key(key) for key in keys])
 
     @classmethod
     def get_count_key(cls, model_name, object_id, attr):
         return '{}.{}:{}'.format(model_name, attr, object_id)
 
     @classmethod
-    def _load_count_to_cache(cls, obj, attr, key, conn):
+    def _load_count_to_cache(cls, obj, attr, key):
+        # load 期间 count 被修改或者有 flush 写回增量的时候，算出来的值不写入 cache，下次读取的时候再 load
+        fill_state = CounterHelper.start_fill(obj.__class__.__name__, [key])
         obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
+        # 加上 CounterHelper 里还没有写回数据库的增量
+        pending_deltas = CounterHelper.get_pending_deltas(obj.__class__.__name__, [(obj.id, attr)])
+        count = getattr(obj, attr) + pending_deltas[(obj.id, attr)]
         # We wish the counts to exist in redis forever.
         # It does not take up to much space anyway.
-        # conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        CounterHelper.finish_fill(fill_state, {key: count})
         return count
 
     @classmethod
-    def incr_count(cls, queryset_of_one, model_name, object_id, attr):
-        conn = RedisClient.get_connection()
+    def incr_count(cls, queryset_of_one, model_name, object_id, attr, delta=1):
         key = cls.get_count_key(model_name, object_id, attr)
-        if not conn.exists(key):
+        count = CounterHelper.incr_cached_count(key, delta)
+        if count is None:
             obj = queryset_of_one.first()
-            cls._load_count_to_cache(obj, attr, key, conn)
+            cls._load_count_to_cache(obj, attr, key)
             return
-        return conn.incr(key)
+        return count
 
     @classmethod
     def decr_count(cls, queryset_of_one, model_name, object_id, attr):
-        conn = RedisClient.get_connection()
-        key = cls.get_count_key(model_name, object_id, attr)
-        if not conn.exists(key):
-            obj = queryset_of_one.first()
-            cls._load_count_to_cache(obj, attr, key, conn)
-            return
-        return conn.decr(key)
+        return cls.incr_count(queryset_of_one, model_name, object_id, attr, delta=-1)
+
+    @classmethod
+    def get_counts(cls, objs, attrs):
+        """
+        get_count 的批量版本，所有 objs 的所有 attrs 用一次 MGET 读取
+        cache miss 的部分用一次数据库查询读出来，再用一个 pipeline 写回 redis
+        objs 需要是同一个 model 的 objects
+        Returns {object_id: {attr: count}}
+        """
+        objs = {obj.id: obj for obj in objs}
+        if not objs:
+            return {}
+        model_class = next(iter(objs.values())).__class__
+        keys = [
+            (object_id, attr, cls.get_count_key(model_class.__name__, object_id, attr))
+            for object_id in objs
+            for attr in attrs
+        ]
+        conn = RedisClient.get_connection('counters')
+        values = conn.mget([key for _, _, key in keys])
+
+        counts = {object_id: {} for object_id in objs}
+        missing_keys = []
+        for (object_id, attr, key), value in zip(keys, values):
+            if value is None:
+                missing_keys.append((object_id, attr, key))
+            else:
+                counts[object_id][attr] = int(value)
+        if not missing_keys:
+            return counts
+
+        missing_ids = {object_id for object_id, _, _ in missing_keys}
+        # 和 _load_count_to_cache 一样，load 期间被修改过的 count 不写入 cache
+        fill_state = CounterHelper.start_fill(model_class.__name__, [key for _, _, key in missing_keys])
+        rows = model_class.objects.filter(id__in=missing_ids).values('id', *attrs)
+        rows = {row['id']: row for row in rows}
+        pending_deltas = CounterHelper.get_pending_deltas(
+            model_class.__name__,
+            [(object_id, attr) for object_id, attr, _ in missing_keys],
+        )
+        loaded_counts = {}
+        for object_id, attr, key in missing_keys:
+            if object_id not in rows:
+                # 数据库里已经没有了，用 object 上的值，不写 cache
+                counts[object_id][attr] = getattr(objs[object_id], attr)
+                continue
+            count = (rows[object_id][attr] or 0) + pending_deltas[(object_id, attr)]
+            counts[object_id][attr] = count
+            loaded_counts[key] = count
+        CounterHelper.finish_fill(fill_state, loaded_counts)
+        return counts
 
     @classmethod
     def get_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
+        conn = RedisClient.get_connection('counters')
         key = cls.get_count_key(obj.__class__.__name__, obj.id, attr)
         count = conn.get(key)
         if count is not None:
             return int(count)
 
-        count = cls._load_count_to_cache(obj, attr, key, conn)
+        lock = cls.try_lock(conn, key)
+        if lock is None:
+            # 其他请求正在从数据库 load，直接返回 obj 上的值，不再去查询数据库
+            return getattr(obj, attr)
+        try:
+            count = cls._load_count_to_cache(obj, attr, key)
+        finally:
+            cls.release_lock(lock)
         return count
@@ -1,6 +1,8 @@
 from django.core import serializers
+from django.db import models, router
 from django_hbase.models import HBaseModel
 from utils.json_encoder import JSONEncoder
+from utils.time_helpers import from_timestamp, to_timestamp
 
 import json
 
@@ -21,6 +23,54 @@ class DjangoModelSerializer:
         return list(serializers.deserialize('json', serialized_data))[0].object
 
 
+class CompactModelSerializer:
+    """
+    schema-aware 的 Django model serializer，只存按照 model 字段顺序排列的字段值，例如
+    '[1,2,"content",1634567890123456,null,0,0]'，不存字段名和 model 名
+     - datetime 存成微秒时间戳，读写都是整数运算
+     - 反序列化的时候用 Model.from_db 直接构造 object，和从数据库读出来的 object 一样
+     - 只支持 json 能表示的字段类型和 DateTimeField
+    不经过 django.core.serializers，也不会为每个 object 创建 DeserializedObject
+    数据格式和 DjangoModelSerializer 不兼容，需要使用单独的 key
+    和 IdOnlySerializer 一样需要实例化，用 for_model 获取
+    """
+    instances = {}
+
+    def __init__(self, model_class):
+        self.model_class = model_class
+        fields = model_class._meta.concrete_fields
+        self.field_names = tuple(field.attname for field in fields)
+        self.datetime_indexes = tuple(
+            index
+            for index, field in enumerate(fields)
+            if isinstance(field, models.DateTimeField)
+        )
+
+    @classmethod
+    def for_model(cls, model_class):
+        if model_class not in cls.instances:
+            cls.instances[model_class] = cls(model_class)
+        return cls.instances[model_class]
+
+    def serialize(self, instance):
+        values = [getattr(instance, field_name) for field_name in self.field_names]
+        for index in self.datetime_indexes:
+            if values[index] is not None:
+                values[index] = to_timestamp(values[index])
+        return json.dumps(values, separators=(',', ':'))
+
+    def deserialize(self, serialized_data):
+        values = json.loads(serialized_data)
+        for index in self.datetime_indexes:
+            if values[index] is not None:
+                values[index] = from_timestamp(values[index])
+        return self.model_class.from_db(
+            router.db_for_read(self.model_class),
+            self.field_names,
+            values,
+        )
+
+
 class HBaseModelSerializer:
 
     @classmethod
@@ -44,3 +94,51 @@ class HBaseModelSerializer:
         model_class = cls.get_model_class(json_data['model_class_name'])
         del json_data['model_class_name']
         return model_class(**json_data)
+
+
+class TimelineRef:
+    """
+    ID-only timeline 里的一项，只有 object id 和 created_at
+    分页只需要 created_at，分页之后再用 hydrate 批量换成完整的 object
+    """
+    __slots__ = ('object_id', 'created_at')
+
+    def __init__(self, object_id, created_at):
+        self.object_id = object_id
+        self.created_at = created_at
+
+    def __eq__(self, other):
+        if not isinstance(other, TimelineRef):
+            return NotImplemented
+        return (self.object_id, self.created_at) == (other.object_id, other.created_at)
+
+    def __repr__(self):
+        return 'TimelineRef({}, {})'.format(self.object_id, self.created_at)
+
+
+class IdOnlySerializer:
+    """
+    timeline cache 里只存 '{id}:{created_at 微秒时间戳}'，而不是整个 object 的 json
+     - 同一条 tweet 出现在上千个 follower 的 timeline 里时，每份只占几十个字节
+     - tweet 被修改之后 timeline 不会过期，hydrate 的时候读到的总是最新的 tweet
+    和 DjangoModelSerializer 不同，需要实例化之后使用
+    """
+
+    def __init__(self, id_field='id', created_at_as_timestamp=False):
+        # newsfeed 的 timeline 里存的是 tweet_id
+        self.id_field = id_field
+        # HBase 的 created_at 是 int，MySQL 的是 datetime，翻页时要和请求里的 created_at 比较
+        self.created_at_as_timestamp = created_at_as_timestamp
+
+    def serialize(self, instance):
+        return '{}:{}'.format(getattr(instance, self.id_field), to_timestamp(instance.created_at))
+
+    def deserialize(self, serialized_data):
+        if isinstance(serialized_data, bytes):
+            serialized_data = serialized_data.decode()
+        object_id, timestamp = serialized_data.split(':')
+        if self.created_at_as_timestamp:
+            created_at = int(timestamp)
+        else:
+            created_at = from_timestamp(timestamp)
+        return TimelineRef(int(object_id), created_at)
@@ -0,0 +1,239 @@
+from django.conf import settings
+from utils.time_helpers import to_timestamp
+
+
+# 只有 key 存在的时候才 push，并且在同一个原子操作里 trim 长度和刷新过期时间
+# 如果最前面已经是同一个 object（例如重建 cache 的时候已经读到了它），就不再重复 push
+# KEYS[1]: key, ARGV[1]: serialized data, ARGV[2]: list length limit, ARGV[3]: expire time
+PUSH_TO_LIST_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if redis.call('LINDEX', KEYS[1], 0) == ARGV[1] then
+    return 1
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# sorted set 版本，ZADD NX 保证同一个 object 重复 push（例如 fanout 重试）不会产生重复的数据
+# 按照 score 从小到大排列，trim 的时候删掉最旧的
+# KEYS[1]: key, ARGV[1]: serialized data, ARGV[2]: score, ARGV[3]: length limit, ARGV[4]: expire time
+PUSH_TO_SORTED_SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], 'NX', ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+scripts = {}
+
+
+def get_expire_time():
+    # 数据本身多保留 REDIS_STALE_TIME，逻辑上的过期时间由 RedisHelper 记录在 meta key 里
+    return settings.REDIS_KEY_EXPIRE_TIME + settings.REDIS_STALE_TIME
+
+
+def get_script(conn, script):
+    # register_script 只是在本地计算 sha，执行的时候用 EVALSHA，脚本不存在时自动 fallback 到 EVAL
+    if script not in scripts:
+        scripts[script] = conn.register_script(script)
+    return scripts[script]
+
+
+class CachedList:
+    """
+    像 list 一样按下标访问 redis 里的 list，只有被访问到的部分才会用 LRANGE 读取并反序列化
+    分页的时候一般只需要读取一页，而不是把整个 list（最多 REDIS_LIST_LENGTH_LIMIT 个）都读出来
+    注意多次读取之间 list 可能被 push 了新的数据，因此不保证是同一个快照，按照 created_at 翻页可以容忍这一点
+    """
+
+    def __init__(self, conn, key, serializer, length, head, chunk_size):
+        self.conn = conn
+        self.key = key
+        self.serializer = serializer
+        self.length = length
+        self.chunk_size = chunk_size
+        # RedisStore.load 的时候一起读出来的 meta，没有的话是 None
+        self.meta = None
+        # {index: deserialized object}
+        self._objects = {}
+        self._store(0, head)
+
+    def _store(self, start, serialized_list):
+        for offset, serialized_data in enumerate(serialized_list):
+            self._objects[start + offset] = self.serializer.deserialize(serialized_data)
+
+    def _read(self, start, stop):
+        # stop is inclusive, the same as LRANGE
+        return self.conn.lrange(self.key, start, stop)
+
+    def _fetch(self, start, stop):
+        if all(index in self._objects for index in range(start, stop)):
+            return
+        self._store(start, self._read(start, stop - 1))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.length)
+            if step != 1 or start >= stop:
+                return [self[index] for index in range(start, stop, step)]
+            self._fetch(start, stop)
+            return [self._objects[index] for index in range(start, stop) if index in self._objects]
+
+        if item < 0:
+            item += self.length
+        if not 0 <= item < self.length:
+            raise IndexError('CachedList index out of range')
+        if item not in self._objects:
+            # 顺序访问的时候一次读取一个 chunk，随机访问（例如二分查找）的时候只读取一个
+            stop = item + self.chunk_size if item - 1 in self._objects else item + 1
+            self._fetch(item, min(stop, self.length))
+        if item not in self._objects:
+            # 读取过程中 list 被 trim 或者过期了
+            raise IndexError('CachedList index out of range')
+        return self._objects[item]
+
+    def __iter__(self):
+        for start in range(0, self.length, self.chunk_size):
+            objects = self[start: start + self.chunk_size]
+            yield from objects
+            if len(objects) < self.chunk_size:
+                return
+
+
+class CachedSortedSet(CachedList):
+    """
+    redis sorted set 按照 created_at 的微秒时间戳作为 score，下标 0 是最新的
+    除了按下标访问，还可以用 range_by_created_at 直接按照 created_at 翻页，redis 上的复杂度是 O(log(n) + page)
+    """
+
+    def _read(self, start, stop):
+        return self.conn.zrevrange(self.key, start, stop)
+
+    def range_by_created_at(self, created_at__lt=None, created_at__gt=None, limit=None):
+        max_score = '+inf' if created_at__lt is None else '({}'.format(to_timestamp(created_at__lt))
+        min_score = '-inf' if created_at__gt is None else '({}'.format(to_timestamp(created_at__gt))
+        if limit is None:
+            serialized_list = self.conn.zrevrangebyscore(self.key, max_score, min_score)
+        else:
+            serialized_list = self.conn.zrevrangebyscore(self.key, max_score, min_score, start=0, num=limit)
+        return [self.serializer.deserialize(serialized_data) for serialized_data in serialized_list]
+
+
+class RedisListStore:
+    """
+    用 redis list 存储按 created_at 倒序排列的 objects，push 的时候放在最前面
+    """
+    cached_list_class = CachedList
+
+    @classmethod
+    def load(cls, conn, key, serializer, chunk_size, meta_key=None):
+        """
+        key 不存在的时候返回 None
+        meta_key 不为 None 的时候在同一个 MULTI 里读取 meta，放在返回值的 meta 属性上
+        """
+        # EXISTS + LLEN + 第一页的 LRANGE 在一个 MULTI 里执行，只有一次 RTT，并且不会在调用之间过期
+        pipe = conn.pipeline(transaction=True)
+        pipe.exists(key)
+        pipe.llen(key)
+        pipe.lrange(key, 0, chunk_size - 1)
+        return cls._execute_load(conn, pipe, key, serializer, chunk_size, meta_key)
+
+    @classmethod
+    def _execute_load(cls, conn, pipe, key, serializer, chunk_size, meta_key):
+        if meta_key is not None:
+            pipe.get(meta_key)
+        exists, length, head, *meta = pipe.execute()
+        if not exists:
+            return None
+        cached_list = cls.cached_list_class(conn, key, serializer, length, head, chunk_size)
+        cached_list.meta = meta[0] if meta else None
+        return cached_list
+
+    @classmethod
+    def save(cls, conn, key, objects, serializer, meta_key=None, meta=None):
+        serialized_list = [serializer.serialize(obj) for obj in objects]
+        if not serialized_list:
+            return
+        # DEL + RPUSH + EXPIRE 在一个 MULTI 里执行，只有一次 RTT
+        # 并发 load 同一个 key 的时候，后写入的会完整覆盖先写入的，而不是 append 出重复的数据
+        pipe = conn.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.rpush(key, *serialized_list)
+        cls._execute_save(pipe, key, meta_key, meta)
+
+    @classmethod
+    def _execute_save(cls, pipe, key, meta_key, meta):
+        pipe.expire(key, get_expire_time())
+        if meta_key is not None:
+            pipe.set(meta_key, meta, ex=get_expire_time())
+        pipe.execute()
+
+    @classmethod
+    def push(cls, conn, key, obj, serializer):
+        """
+        key 存在的时候 push 并返回 True，不存在的时候返回 False，由调用者从数据库 load
+        """
+        push_to_list = get_script(conn, PUSH_TO_LIST_SCRIPT)
+        return bool(push_to_list(
+            keys=[key],
+            args=[
+                serializer.serialize(obj),
+                settings.REDIS_LIST_LENGTH_LIMIT,
+                get_expire_time(),
+            ],
+            client=conn,
+        ))
+
+
+class RedisSortedSetStore(RedisListStore):
+    """
+    用 redis sorted set 存储，score 是 created_at 的微秒时间戳
+     - 按照 created_at 翻页不需要扫描整个 list
+     - 同一个 object 重复写入是幂等的
+    """
+    cached_list_class = CachedSortedSet
+
+    @classmethod
+    def load(cls, conn, key, serializer, chunk_size, meta_key=None):
+        pipe = conn.pipeline(transaction=True)
+        pipe.exists(key)
+        pipe.zcard(key)
+        pipe.zrevrange(key, 0, chunk_size - 1)
+        return cls._execute_load(conn, pipe, key, serializer, chunk_size, meta_key)
+
+    @classmethod
+    def save(cls, conn, key, objects, serializer, meta_key=None, meta=None):
+        mapping = {
+            serializer.serialize(obj): to_timestamp(obj.created_at)
+            for obj in objects
+        }
+        if not mapping:
+            return
+        pipe = conn.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.zadd(key, mapping)
+        cls._execute_save(pipe, key, meta_key, meta)
+
+    @classmethod
+    def push(cls, conn, key, obj, serializer):
+        push_to_sorted_set = get_script(conn, PUSH_TO_SORTED_SET_SCRIPT)
+        return bool(push_to_sorted_set(
+            keys=[key],
+            args=[
+                serializer.serialize(obj),
+                to_timestamp(obj.created_at),
+                settings.REDIS_LIST_LENGTH_LIMIT,
+                get_expire_time(),
+            ],
+            client=conn,
+        ))
@@ -0,0 +1,82 @@
+from django.db import transaction
+from utils.metrics_helper import MetricsHelper
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ShadowHelper:
+    """
+    迁移存储的时候同时访问新旧两个 backend，返回的总是 primary 的结果
+     - compare_reads: 同时读取两边，比较结果是否一致
+     - dual_write: 同时写入两边
+    shadow 一边的失败只记录到 metrics 里，不影响请求本身
+    metrics 记录在 shadow:{name} 上：calls, mismatches, errors, primary_seconds, shadow_seconds
+    shadow_seconds - primary_seconds 就是两个 backend 的延迟差
+    """
+
+    @classmethod
+    def get_metrics_name(cls, name):
+        return 'shadow:{}'.format(name)
+
+    @classmethod
+    def timed(cls, func):
+        start = time.perf_counter()
+        result = func()
+        return result, time.perf_counter() - start
+
+    @classmethod
+    def run_shadow(cls, name, func):
+        """
+        Returns (result, seconds), or None if {func} failed.
+        在 savepoint 里执行，shadow 写入 mysql 失败（例如违反唯一约束）不会破坏 primary 所在的事务
+        """
+        try:
+            with transaction.atomic():
+                return cls.timed(func)
+        except Exception:
+            logger.exception('Shadow %s failed', name)
+            return None
+
+    @classmethod
+    def compare_reads(cls, name, primary, shadow, normalize=None):
+        result, primary_seconds = cls.timed(primary)
+        shadow_result = cls.run_shadow(name, shadow)
+        if shadow_result is None:
+            MetricsHelper.record(cls.get_metrics_name(name), calls=1, errors=1)
+            return result
+
+        shadow_result, shadow_seconds = shadow_result
+        if normalize is not None:
+            matched = normalize(result) == normalize(shadow_result)
+        else:
+            matched = result == shadow_result
+        if not matched:
+            logger.warning('Shadow read %s mismatched: %r != %r', name, result, shadow_result)
+        MetricsHelper.record(
+            cls.get_metrics_name(name),
+            calls=1,
+            mismatches=0 if matched else 1,
+            primary_seconds=primary_seconds,
+            shadow_seconds=shadow_seconds,
+        )
+        return result
+
+    @classmethod
+    def dual_write(cls, name, primary, shadow):
+        result, primary_seconds = cls.timed(primary)
+        shadow_result = cls.run_shadow(name, shadow)
+        if shadow_result is None:
+            MetricsHelper.record(cls.get_metrics_name(name), calls=1, errors=1)
+            return result
+
+        _, shadow_seconds = shadow_result
+        MetricsHelper.record(
+            cls.get_metrics_name(name),
+            calls=1,
+            primary_seconds=primary_seconds,
+            shadow_seconds=shadow_seconds,
+        )
+        return result
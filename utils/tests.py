@@ -1,5 +1,17 @@
+from django.conf import settings
+from newsfeeds.models import HBaseNewsFeed
 from testing.testcases import TestCase
-from utils.redis_client import RedisClient
+from tweets.models import Tweet
+from utils.redis_client import RedisClient, get_shard_index, jump_consistent_hash
+from utils.redis_helper import RedisHelper
+from utils.redis_serializers import (
+    CompactModelSerializer,
+    DjangoModelSerializer,
+    HBaseModelSerializer,
+)
+from utils.redis_stores import CachedList, CachedSortedSet, RedisSortedSetStore
+
+import time
 
 
 class UtilsTests(TestCase):
@@ -17,3 +29,194 @@ class UtilsTests(TestCase):
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [])
+
+    def test_redis_client_purposes(self):
+        timeline_conn = RedisClient.get_connection('timeline')
+        self.assertEqual(RedisClient.get_connection('timeline') is timeline_conn, True)
+        # 不同用途使用不同的连接池
+        self.assertEqual(RedisClient.get_connection('counters') is timeline_conn, False)
+        # 没有配置的用途使用 default
+        conn = RedisClient.get_connection('not_configured')
+        self.assertEqual(conn.connection_pool.connection_kwargs['db'], settings.REDIS_DB)
+
+        # 同一个 user_id 总是在同一个 shard 上，int 和 str 的 user_id 一样
+        self.assertEqual(get_shard_index(42, 4), get_shard_index('42', 4))
+        self.assertEqual(get_shard_index(42, 1), 0)
+        self.assertEqual(get_shard_index(None, 4), 0)
+        shard_sizes = [0] * 4
+        for user_id in range(1000):
+            shard_sizes[get_shard_index(user_id, 4)] += 1
+        self.assertEqual(min(shard_sizes) > 200, True)
+        # 从 4 个 shard 扩容到 5 个的时候，只有大约 1/5 的 user 会移动，并且只会移动到新的 shard 上
+        moved = [user_id for user_id in range(1000) if get_shard_index(user_id, 4) != get_shard_index(user_id, 5)]
+        self.assertEqual(len(moved) < 300, True)
+        self.assertEqual({get_shard_index(user_id, 5) for user_id in moved}, {4})
+        self.assertEqual(jump_consistent_hash(0, 1), 0)
+
+    def test_push_and_load_objects(self):
+        conn = RedisClient.get_connection()
+        key = 'redis_helper_key'
+        limit = settings.REDIS_LIST_LENGTH_LIMIT
+        newsfeeds = [
+            HBaseNewsFeed(user_id=1, created_at=i, tweet_id=i)
+            for i in range(limit, 0, -1)
+        ]
+
+        # cache miss, load from the lazy loader
+        RedisHelper.push_object(key, newsfeeds[0], lambda n: newsfeeds[:n])
+        self.assertEqual(conn.llen(key), limit)
+        self.assertEqual(conn.ttl(key) > 0, True)
+
+        # cache hit, push to the front and trim to the limit
+        new_newsfeed = HBaseNewsFeed(user_id=1, created_at=limit + 1, tweet_id=limit + 1)
+        RedisHelper.push_object(key, new_newsfeed, lambda n: [])
+        objects = RedisHelper.load_objects(key, lambda n: [], serializer=HBaseModelSerializer)
+        self.assertEqual(len(objects), limit)
+        self.assertEqual(objects[0].tweet_id, limit + 1)
+        self.assertEqual(objects[-1].tweet_id, 2)
+
+        # loading again replaces the list instead of appending to it
+        RedisHelper.invalidate_cache(key)
+        RedisHelper.load_objects(key, lambda n: newsfeeds[:n], serializer=HBaseModelSerializer)
+        RedisHelper._load_objects_to_cache(key, newsfeeds, HBaseModelSerializer)
+        self.assertEqual(conn.llen(key), limit)
+
+    def test_cached_list(self):
+        key = 'redis_helper_key'
+        limit = settings.REDIS_LIST_LENGTH_LIMIT
+        newsfeeds = [
+            HBaseNewsFeed(user_id=1, created_at=i, tweet_id=i)
+            for i in range(limit, 0, -1)
+        ]
+        RedisHelper.load_objects(key, lambda n: newsfeeds[:n], serializer=HBaseModelSerializer)
+
+        cached_list = RedisHelper.load_objects(key, lambda n: [], serializer=HBaseModelSerializer)
+        self.assertEqual(isinstance(cached_list, CachedList), True)
+        self.assertEqual(len(cached_list), limit)
+        self.assertEqual(cached_list[0].tweet_id, limit)
+        self.assertEqual(cached_list[-1].tweet_id, 1)
+        self.assertEqual([f.tweet_id for f in cached_list[2:5]], [limit - 2, limit - 3, limit - 4])
+        self.assertEqual([f.tweet_id for f in cached_list], list(range(limit, 0, -1)))
+        self.assertEqual(cached_list[limit:limit + 5], [])
+
+    def test_cached_sorted_set(self):
+        key = 'redis_helper_key'
+        limit = settings.REDIS_LIST_LENGTH_LIMIT
+        newsfeeds = [
+            HBaseNewsFeed(user_id=1, created_at=i * 10, tweet_id=i)
+            for i in range(limit, 0, -1)
+        ]
+        RedisHelper.push_object(key, newsfeeds[0], lambda n: newsfeeds[:n], store=RedisSortedSetStore)
+
+        # pushing the same object twice does not duplicate it
+        new_newsfeed = HBaseNewsFeed(user_id=1, created_at=(limit + 1) * 10, tweet_id=limit + 1)
+        RedisHelper.push_object(key, new_newsfeed, lambda n: [], store=RedisSortedSetStore)
+        RedisHelper.push_object(key, new_newsfeed, lambda n: [], store=RedisSortedSetStore)
+
+        cached_set = RedisHelper.load_objects(
+            key,
+            lambda n: [],
+            serializer=HBaseModelSerializer,
+            store=RedisSortedSetStore,
+        )
+        self.assertEqual(isinstance(cached_set, CachedSortedSet), True)
+        # trimmed to the limit, the oldest one is removed
+        self.assertEqual(len(cached_set), limit)
+        self.assertEqual([f.tweet_id for f in cached_set], list(range(limit + 1, 1, -1)))
+
+        objects = cached_set.range_by_created_at(created_at__lt=100, limit=3)
+        self.assertEqual([f.tweet_id for f in objects], [9, 8, 7])
+        objects = cached_set.range_by_created_at(created_at__gt=(limit - 2) * 10)
+        self.assertEqual([f.tweet_id for f in objects], [limit + 1, limit, limit - 1])
+
+    def test_compact_model_serializer(self):
+        user = self.create_user('linghu')
+        tweet = self.create_tweet(user, 'compact')
+        tweet.refresh_from_db()
+
+        serializer = CompactModelSerializer.for_model(Tweet)
+        self.assertEqual(CompactModelSerializer.for_model(Tweet) is serializer, True)
+        serialized_data = serializer.serialize(tweet)
+        self.assertEqual(len(serialized_data) < len(DjangoModelSerializer.serialize(tweet)), True)
+
+        # 和从数据库读出来的 object 一样
+        cached_tweet = serializer.deserialize(serialized_data.encode())
+        self.assertEqual(cached_tweet._state.adding, False)
+        for field in Tweet._meta.concrete_fields:
+            self.assertEqual(getattr(cached_tweet, field.attname), getattr(tweet, field.attname))
+        self.assertEqual(cached_tweet.user, user)
+
+    def test_cache_stampede_protection(self):
+        conn = RedisClient.get_connection()
+        key = 'redis_helper_key'
+        newsfeeds = [HBaseNewsFeed(user_id=1, created_at=i, tweet_id=i) for i in range(3, 0, -1)]
+        load_count = []
+
+        def lazy_load(n):
+            load_count.append(n)
+            return newsfeeds[:n]
+
+        # 其他请求正在重建的时候不会重复写 cache，等待超时之后直接读数据库
+        lock = RedisHelper.try_lock(conn, key)
+        self.assertEqual(RedisHelper.try_lock(conn, key), None)
+        with self.settings(REDIS_LOCK_WAIT_TIME=0.1):
+            objects = RedisHelper.load_objects(key, lazy_load, serializer=HBaseModelSerializer)
+        self.assertEqual([f.tweet_id for f in objects], [3, 2, 1])
+        self.assertEqual(conn.exists(key), False)
+        RedisHelper.release_lock(lock)
+
+        # 拿到锁的请求重建 cache，并记录逻辑过期时间
+        RedisHelper.load_objects(key, lazy_load, serializer=HBaseModelSerializer)
+        self.assertEqual(conn.exists(key), True)
+        self.assertEqual(len(load_count), 2)
+        meta_key = RedisHelper.get_meta_key(key)
+        expire_at, _ = RedisHelper.parse_meta(conn.get(meta_key))
+        self.assertEqual(expire_at > time.time(), True)
+        self.assertEqual(RedisHelper.should_recompute(conn.get(meta_key)), False)
+
+        # 逻辑过期之后，没拿到锁的请求返回旧数据
+        conn.set(meta_key, '{}:0.01'.format(time.time() - 1))
+        self.assertEqual(RedisHelper.should_recompute(conn.get(meta_key)), True)
+        lock = RedisHelper.try_lock(conn, key)
+        objects = RedisHelper.load_objects(key, lazy_load, serializer=HBaseModelSerializer)
+        self.assertEqual([f.tweet_id for f in objects], [3, 2, 1])
+        self.assertEqual(len(load_count), 2)
+        RedisHelper.release_lock(lock)
+
+        # 拿到锁的请求重建 cache
+        RedisHelper.load_objects(key, lazy_load, serializer=HBaseModelSerializer)
+        self.assertEqual(len(load_count), 3)
+        self.assertEqual(RedisHelper.should_recompute(conn.get(meta_key)), False)
+
+        # count 的 cache 正在被其他请求 load 的时候直接返回 object 上的值
+        user = self.create_user('linghu')
+        tweet = self.create_tweet(user)
+        tweet.likes_count = 5
+        count_key = RedisHelper.get_count_key('Tweet', tweet.id, 'likes_count')
+        lock = RedisHelper.try_lock(conn, count_key)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 5)
+        self.assertEqual(conn.exists(count_key), False)
+        RedisHelper.release_lock(lock)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 0)
+
+    def test_get_counts(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('linghu')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        Tweet.objects.filter(id=tweets[0].id).update(likes_count=2, comments_count=1)
+        Tweet.objects.filter(id=tweets[1].id).update(likes_count=4)
+        conn.set(RedisHelper.get_count_key('Tweet', tweets[2].id, 'likes_count'), 7)
+
+        attrs = ('likes_count', 'comments_count')
+        counts = RedisHelper.get_counts(tweets, attrs)
+        self.assertEqual(counts, {
+            tweets[0].id: {'likes_count': 2, 'comments_count': 1},
+            tweets[1].id: {'likes_count': 4, 'comments_count': 0},
+            tweets[2].id: {'likes_count': 7, 'comments_count': 0},
+        })
+        # cache miss 的部分写回了 redis
+        for tweet in tweets:
+            for attr in attrs:
+                key = RedisHelper.get_count_key('Tweet', tweet.id, attr)
+                self.assertEqual(int(conn.get(key)), counts[tweet.id][attr])
+        self.assertEqual(RedisHelper.get_counts([], attrs), {})
@@ -1,6 +1,23 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
 
 def utc_now():
-    return datetime.now(pytz.utc)
\ No newline at end of file
+    return datetime.now(pytz.utc)
+
+
+def to_timestamp(created_at):
+    """
+    datetime 或者 int 形式的 created_at 统一转成 int 形式的微秒时间戳
+    用整数运算而不是 datetime.timestamp()，避免浮点数的误差
+    """
+    if isinstance(created_at, datetime):
+        return (created_at - EPOCH) // timedelta(microseconds=1)
+    return int(created_at)
+
+
+def from_timestamp(timestamp):
+    # to_timestamp 的逆运算，得到带 utc 时区的 datetime
+    return EPOCH + timedelta(microseconds=int(timestamp))